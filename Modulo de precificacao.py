@@ -2,9 +2,18 @@ import streamlit as st
 import pandas as pd
 import plotly.express as px
 import numpy as np
-from io import BytesIO
-from pricing.db import Database
-from pricing.engine import import_planilha_processos, suggest_sale_price, get_base_cost
+import os
+import tempfile
+from pricing.db import Database, COST_TABLES, SCENARIO_TARGETS, SCENARIO_TYPES
+from pricing.cache import RollupCache
+from pricing.engine import suggest_sale_price, get_base_cost, TaxResolver
+from pricing.erp_import import preview_erp_file, import_erp_file
+from pricing.frames import load_frame, version_stamp
+from pricing.editor import paged_editor
+from pricing.export import EXPORTERS
+from pricing.reprice import create_job, job_status, start_background
+from pricing.scenarios import compare_scenarios
+from pricing.sensitivity import sensitivity_grid
 
 st.set_page_config(page_title="Módulo de Precificação", layout="wide")
 
@@ -14,133 +23,175 @@ def get_db():
     db.seed_demo()
     return db
 
+@st.cache_resource
+def get_rollup_cache():
+    return RollupCache(maxsize=20000)
+
+@st.cache_resource
+def get_tax_resolver():
+    return TaxResolver()
+
+@st.cache_data(max_entries=512, show_spinner=False)
+def cached_frame(name, stamp, params=()):
+    return load_frame(get_db().connection(), name, params)
+
 db = get_db()
-db.init_schema()
-conn = db.connect()
-conn.execute("CREATE TABLE IF NOT EXISTS product_clients (id INTEGER PRIMARY KEY AUTOINCREMENT, product_id INTEGER, client_id INTEGER)")
+
+def frame(name, *params):
+    return cached_frame(name, version_stamp(db.connection())(name), params)
+
+@st.cache_data(max_entries=16, show_spinner="Avaliando cenários...")
+def cached_scenarios(scenario_ids, stamp):
+    # stamp = generations of the cost tables and scenarios: any price,
+    # composition or adjustment change makes a new key
+    return compare_scenarios(get_db().connection(), scenario_ids)
+
+SCENARIO_STAMP_TABLES = COST_TABLES + ("scenarios", "scenario_adjustments")
+
+PICKER_PAGE = 50  # options a product picker offers, with or without a search
+
+def product_labels(df):
+    return (df["codigo"].fillna("").astype(str) + " - " + df["nome"].astype(str)).tolist()
+
+def product_options(q, limit=PICKER_PAGE):
+    # Picker rows: ranked FTS5 prefix search (db.search) for typed text,
+    # else the first page in id order; never the whole catalog
+    if q:
+        return pd.DataFrame([dict(r) for r in db.search("products", q, k=limit)], columns=["id", "codigo", "nome", "grupo", "subgrupo"])
+    return frame("products_page", limit)
+
+def salvo(msg):
+    # A write changes what other sections show: rerun the whole app (not just
+    # the fragment) and show the message at the top of that run
+    st.session_state.aviso = msg
+    st.rerun()
+
+if db.quarantined_links:
+    st.warning("Vínculos de composição que formavam ciclo foram movidos para product_components_quarantine: " + ", ".join(f"{pai} → {comp}" for _id, pai, comp, _q in db.quarantined_links[:20]))
 
 st.title("Módulo de Precificação")
-tab1, tab2, tab_prod, tab3, tab4 = st.tabs(["UpLoad de arquivos", "DB Vertical & Clientes", "Produtos", "Precificação", "Análise"])
+if st.session_state.get("aviso"):
+    st.success(st.session_state.pop("aviso"))
+tab1, tab2, tab_prod, tab3, tab_cen, tab4 = st.tabs(["UpLoad de arquivos", "DB Vertical & Clientes", "Produtos", "Precificação", "Cenários", "Análise"])
 
-with tab1:
+@st.fragment
+def secao_upload():
+    conn = db.connection()
     c1, c2 = st.columns(2)
     with c1:
         f = st.file_uploader("Anexe arquivo ERP (XLSX/CSV)", type=["xlsx", "csv"], key="upl_file")
         if f:
-            df = pd.read_excel(f) if f.name.endswith(".xlsx") else pd.read_csv(f)
-            cols = [str(c) for c in df.columns]
-            lc = [c.lower() for c in cols]
-            def pick(colset):
-                for k in colset:
-                    for i, c in enumerate(lc):
-                        if k in c:
-                            return cols[i]
-                return None
-            is_materials = any("insumo" in x or "matéria" in x or "materia" in x for x in lc) or (pick({"nome_insumo","insumo"}) is not None and pick({"custo_unit","custo_unitario","preco_unitario"}) is not None)
-            if is_materials:
-                nome_c = pick({"nome_insumo","insumo","nome"})
-                preco_c = pick({"custo_unitario","preco_unitario","valor_unitario"})
-                qtd_c = pick({"quantidade","qtde","qtd"})
-                forn_c = pick({"fornecedor"})
-                grupo_c = pick({"grupo"})
-                subgrupo_c = pick({"subgrupo"})
-                unidade_c = pick({"unidade","unit"})
-                ncm_c = pick({"ncm"})
-                mdf = pd.DataFrame({
-                    "grupo": df[grupo_c] if grupo_c else "",
-                    "subgrupo": df[subgrupo_c] if subgrupo_c else "",
-                    "nome": df[nome_c] if nome_c else df[cols[0]],
-                    "ncm": df[ncm_c] if ncm_c else "",
-                    "unidade": df[unidade_c] if unidade_c else "un",
-                    "preco_unitario": df[preco_c] if preco_c else 0.0,
-                    "fornecedor": df[forn_c] if forn_c else "",
-                })
-            mdf_edit = st.data_editor(mdf, num_rows="dynamic", column_config={"preco_unitario": st.column_config.NumberColumn("preco_unitario", format="%.2f")})
-            if st.button("Salvar e importar materiais"):
-                cur = conn.cursor()
-                for _, r in mdf_edit.fillna("").iterrows():
-                    cur.execute("INSERT INTO vertical_materials (grupo, subgrupo, nome, ncm, unidade, preco_unitario, fornecedor, data_atualizacao) VALUES (?,?,?,?,?,?,?,?)",
-                                    (r["grupo"], r["subgrupo"], r["nome"], r["ncm"], r["unidade"], round(float(r["preco_unitario"]) if r["preco_unitario"] != "" else 0.0, 2), r["fornecedor"], pd.Timestamp.now().strftime("%Y-%m-%d")))
-                conn.commit()
-                st.success("Materiais importados")
+            tipo, previa = preview_erp_file(f, f.name)
+            if tipo is None:
+                st.warning("Arquivo sem linhas para importar")
             else:
-                nome_c = pick({"nome","processo","operacao"})
-                preco_h_c = pick({"preco_hora","valor_hora","custo_hora"})
-                preco_min_c = pick({"preco_minuto","valor_minuto","custo_minuto"})
-                grupo_c = pick({"grupo"})
-                subgrupo_c = pick({"subgrupo"})
-                unidade_c = pick({"unidade","unit"})
-                if preco_h_c is None and preco_min_c is not None:
-                    df["__preco_hora__"] = df[preco_min_c].astype(float) * 60.0
-                    preco_h_c = "__preco_hora__"
-                pdf = pd.DataFrame({
-                    "grupo": df[grupo_c] if grupo_c else "",
-                    "subgrupo": df[subgrupo_c] if subgrupo_c else "",
-                    "nome": df[nome_c] if nome_c else df[cols[0]],
-                    "preco_unitario_hora": df[preco_h_c] if preco_h_c else 0.0,
-                    "unidade": df[unidade_c] if unidade_c else "hora"
-                })
-                pdf_edit = st.data_editor(pdf, num_rows="dynamic", column_config={"preco_unitario_hora": st.column_config.NumberColumn("preco_unitario_hora", format="%.2f")})
-                if st.button("Salvar e importar processos"):
-                    rows = []
-                    for _, r in pdf_edit.fillna("").iterrows():
-                        rows.append({
-                            "grupo": r["grupo"],
-                            "subgrupo": r["subgrupo"],
-                            "nome": r["nome"],
-                            "preco_unitario_hora": round(float(r["preco_unitario_hora"]) if r["preco_unitario_hora"] != "" else 0.0, 2),
-                            "unidade": r["unidade"]
-                        })
-                    import_planilha_processos(conn, rows)
-                    st.success("Processos importados")
+                st.caption(f"Layout detectado: {tipo} — prévia das primeiras {len(previa)} linhas")
+                st.dataframe(previa, hide_index=True)
+                if st.button("Salvar e importar materiais" if tipo == "materiais" else "Salvar e importar processos"):
+                    barra = st.progress(0.0)
+                    status = st.empty()
+                    def mostrar_progresso(linhas, fracao, taxa):
+                        if fracao is not None:
+                            barra.progress(fracao)
+                        status.text(f"{linhas:,} linhas importadas ({taxa:,.0f} linhas/s)")
+                    res = import_erp_file(db, f, f.name, progress=mostrar_progresso)
+                    barra.progress(1.0)
+                    salvo(f"{'Materiais' if tipo == 'materiais' else 'Processos'} importados: {res['linhas']:,} linhas em {res['segundos']:.1f} s ({res['linhas_por_s']:,.0f} linhas/s)")
     with c2:
-        buf = BytesIO()
-        for t in ["vertical_materials", "vertical_processes", "clients"]:
-            pd.read_sql(f"SELECT * FROM {t}", conn).to_csv(buf, index=False)
-        st.download_button("Exportar DB Vertical e Clientes", buf.getvalue(), "db_export.csv")
+        formato = st.radio("Exportar DB Vertical e Clientes", ["XLSX (uma aba por tabela)", "ZIP de CSVs (mais rápido)"], key="export_formato")
+        ext = "xlsx" if formato.startswith("XLSX") else "zip"
+        if st.button("Gerar exportação", key="btn_exportar"):
+            # Streamed to a temporary file, then offered for download
+            barra = st.progress(0.0)
+            status = st.empty()
+            def mostrar_progresso(tabela, linhas, fracao):
+                barra.progress(fracao)
+                status.text(f"{tabela}: {linhas:,} linhas exportadas")
+            anterior = st.session_state.pop("export_arquivo", None)
+            if anterior and os.path.exists(anterior[0]):
+                os.remove(anterior[0])
+            with tempfile.NamedTemporaryFile(suffix="." + ext, delete=False) as tmp:
+                totais = EXPORTERS[ext](conn, tmp, progress=mostrar_progresso)
+            st.session_state.export_arquivo = (tmp.name, ext, sum(totais.values()))
+        arquivo = st.session_state.get("export_arquivo")
+        if arquivo and os.path.exists(arquivo[0]):
+            with open(arquivo[0], "rb") as fh:
+                st.download_button(f"Baixar exportação ({arquivo[2]:,} linhas)", fh, f"db_export.{arquivo[1]}", key="btn_baixar_export")
 
-with tab2:
+    st.divider()
+    st.subheader("Reprecificação de vínculos")
+    st.caption("Recalcula o preço final de cada vínculo produto-cliente na margem negociada, com os custos atuais (após importar tabelas de preço), e grava o histórico de custos.")
+    job = job_status(conn)
+    ativo = job is not None and job["status"] in ("pendente", "executando") and not job["interrompido"]
+    clis = frame("clients")
+    grupos = frame("products")["grupo"].cat.categories.tolist()
+    r1, r2 = st.columns(2)
+    sel_clis = r1.multiselect("Clientes (vazio = todos)", clis["nome"].tolist(), key="reprice_clientes")
+    sel_grupos = r2.multiselect("Grupos de produto (vazio = todos)", grupos, key="reprice_grupos")
+    b1, b2 = st.columns(2)
+    if b1.button("Reprecificar vínculos", disabled=ativo, key="btn_reprice"):
+        ids = clis.loc[clis["nome"].isin(sel_clis), "id"].tolist()
+        job_id = create_job(db, clientes=ids, grupos=sel_grupos)
+        start_background(db, job_id)
+        st.session_state.reprice_job = job_id
+        st.rerun()
+    if job is not None and job["interrompido"] and job["status"] != "concluido":
+        if b2.button(f"Retomar job {job['id']}", key="btn_reprice_retomar"):
+            start_background(db, job["id"])
+            st.session_state.reprice_job = job["id"]
+            st.rerun()
+    # Polls the job every 2 s while it runs; the rest of the app is not rerun
+    st.fragment(progresso_reprecificacao, run_every=2 if ativo else None)()
+
+def progresso_reprecificacao():
+    job = job_status(db.connection())
+    if job is None:
+        return
+    st.progress(job["progresso"])
+    texto = f"Job {job['id']} ({job['status']}): {job['feitos']:,} de {job['total_links']:,} vínculos reprecificados"
+    if job["ignorados"]:
+        texto += f", {job['ignorados']:,} ignorados (sem margem ou margem + impostos ≥ 100%)"
+    if job["eta_s"] is not None:
+        texto += f" — faltam ~{job['eta_s'] / 60:.0f} min" if job["eta_s"] >= 90 else f" — faltam ~{job['eta_s']:.0f} s"
+    st.caption(texto)
+    if job["interrompido"]:
+        st.warning(f"Job interrompido{': ' + job['erro'] if job['erro'] else ''}. Use 'Retomar' para continuar dos lotes pendentes.")
+    if job["status"] == "concluido" and st.session_state.get("reprice_job") == job["id"]:
+        # Finished while polled: stop polling and refresh the sections showing prices
+        del st.session_state.reprice_job
+        salvo(f"Reprecificação concluída: {job['feitos']:,} vínculos atualizados")
+
+with tab1:
+    secao_upload()
+
+@st.fragment
+def secao_cadastros():
     st.subheader("Materiais")
-    mat_df = pd.read_sql("SELECT * FROM vertical_materials", conn)
-    mat_edit = st.data_editor(mat_df, num_rows="dynamic", column_config={"preco_unitario": st.column_config.NumberColumn("preco_unitario", format="%.2f")})
+    mat_df, mat_edit = paged_editor(db, "vertical_materials", "editor_materiais", column_config={"preco_unitario": st.column_config.NumberColumn("preco_unitario", format="%.2f")})
     st.subheader("Processos")
-    proc_df = pd.read_sql("SELECT * FROM vertical_processes", conn)
-    proc_edit = st.data_editor(proc_df, num_rows="dynamic", column_config={"preco_unitario_hora": st.column_config.NumberColumn("preco_unitario_hora", format="%.2f")})
+    proc_df, proc_edit = paged_editor(db, "vertical_processes", "editor_processos", column_config={"preco_unitario_hora": st.column_config.NumberColumn("preco_unitario_hora", format="%.2f")})
     st.subheader("Terceiros")
-    th_df = pd.read_sql("SELECT * FROM third_party_items", conn)
-    th_edit = st.data_editor(th_df, num_rows="dynamic", column_config={"preco_unitario": st.column_config.NumberColumn("preco_unitario", format="%.2f"), "quantidade_padrao": st.column_config.NumberColumn("quantidade_padrao", format="%.2f")})
+    th_df, th_edit = paged_editor(db, "third_party_items", "editor_terceiros", column_config={"preco_unitario": st.column_config.NumberColumn("preco_unitario", format="%.2f"), "quantidade_padrao": st.column_config.NumberColumn("quantidade_padrao", format="%.2f")})
     st.subheader("Custos Administrativos")
-    adm_df = pd.read_sql("SELECT * FROM admin_costs", conn)
+    adm_df = frame("admin_editor")
     adm_edit = st.data_editor(adm_df, num_rows="dynamic", column_config={"valor": st.column_config.NumberColumn("valor", format="%.2f")})
     st.subheader("Clientes")
-    cli_df = pd.read_sql("SELECT * FROM clients", conn)
-    cli_edit = st.data_editor(cli_df, num_rows="dynamic")
+    cli_df, cli_edit = paged_editor(db, "clients", "editor_clientes")
     if st.button("Salvar alterações"):
-        cur = conn.cursor()
-        cur.execute("DELETE FROM vertical_materials")
-        for _, r in mat_edit.fillna("").iterrows():
-            cur.execute("INSERT INTO vertical_materials (id, grupo, subgrupo, nome, ncm, unidade, preco_unitario, fornecedor, data_atualizacao) VALUES (?,?,?,?,?,?,?,?,?)",
-                        (int(r["id"]) if pd.notna(r["id"]) else None, r["grupo"], r["subgrupo"], r["nome"], r["ncm"], r["unidade"], float(r["preco_unitario"]), r["fornecedor"], r["data_atualizacao"]))
-        cur.execute("DELETE FROM vertical_processes")
-        for _, r in proc_edit.fillna("").iterrows():
-            cur.execute("INSERT INTO vertical_processes (id, grupo, subgrupo, nome, preco_unitario_hora, unidade, origem) VALUES (?,?,?,?,?,?,?)",
-                        (int(r["id"]) if pd.notna(r["id"]) else None, r["grupo"], r["subgrupo"], r["nome"], float(r["preco_unitario_hora"]), r["unidade"], r["origem"]))
-        cur.execute("DELETE FROM third_party_items")
-        for _, r in th_edit.fillna("").iterrows():
-            cur.execute("INSERT INTO third_party_items (id, nome, preco_unitario, quantidade_padrao, fornecedor) VALUES (?,?,?,?,?)",
-                        (int(r["id"]) if pd.notna(r["id"]) else None, r["nome"], float(r["preco_unitario"]), float(r["quantidade_padrao"]), r["fornecedor"]))
-        cur.execute("DELETE FROM admin_costs")
-        for _, r in adm_edit.fillna("").iterrows():
-            cur.execute("INSERT INTO admin_costs (id, nome, valor) VALUES (?,?,?)",
-                        (int(r["id"]) if pd.notna(r["id"]) else None, r["nome"], float(r["valor"])))
-        cur.execute("DELETE FROM clients")
-        for _, r in cli_edit.fillna("").iterrows():
-            cur.execute("INSERT INTO clients (id, nome, planta, uf, cidade, regime, pis, cofins, icms, fator) VALUES (?,?,?,?,?,?,?,?,?,?)",
-                        (int(r["id"]) if pd.notna(r["id"]) else None, r["nome"], r["planta"], r["uf"], r["cidade"], r["regime"], float(r["pis"]), float(r["cofins"]), float(r["icms"]), float(r["fator"])))
-        conn.commit()
-        st.success("Dados salvos")
+        with db.transaction():
+            db.apply_changes("vertical_materials", mat_df, mat_edit)
+            db.apply_changes("vertical_processes", proc_df, proc_edit)
+            db.apply_changes("third_party_items", th_df, th_edit)
+            db.apply_changes("admin_costs", adm_df, adm_edit)
+            db.apply_changes("clients", cli_df, cli_edit)
+        salvo("Dados salvos")
 
-with tab_prod:
+with tab2:
+    secao_cadastros()
+
+@st.fragment
+def secao_produtos():
+    conn = db.connection()
     st.subheader("Criar produto")
     codigo = st.text_input("Código")
     nome_p = st.text_input("Nome")
@@ -150,9 +201,9 @@ with tab_prod:
     origem_uf_p = st.text_input("UF fabricação")
     if st.button("Criar produto"):
         pid = db.add_product(codigo, nome_p, quantidade_p, destino_uf_p, ncm_p, origem_uf_p)
-        st.success(f"Produto criado: ID {pid}")
+        salvo(f"Produto criado: ID {pid}")
     st.subheader("Editar produtos (planilha)")
-    produtos_orig = pd.read_sql("SELECT id, codigo, nome, quantidade, destino_uf, ncm, local_fabricacao_uf FROM products", conn)
+    produtos_orig = frame("products_editor").drop(columns=["grupo", "subgrupo"])
     produtos_edit = st.data_editor(produtos_orig, num_rows="dynamic", column_config={"quantidade": st.column_config.NumberColumn("quantidade", format="%.2f")})
     if st.button("Salvar produtos"):
         ids_orig = set(produtos_orig["id"].tolist())
@@ -165,25 +216,18 @@ with tab_prod:
                 db.update_product(int(r["id"]), r["codigo"], r["nome"], float(r["quantidade"]) if r["quantidade"] != "" else 0.0, r["destino_uf"], r["ncm"], r["local_fabricacao_uf"])
             else:
                 db.add_product(r["codigo"], r["nome"], float(r["quantidade"]) if r["quantidade"] != "" else 0.0, r["destino_uf"], r["ncm"], r["local_fabricacao_uf"])
-        st.success("Produtos salvos")
+        salvo("Produtos salvos")
     st.subheader("Composição do produto")
-    try:
-        prods_df = pd.read_sql("SELECT id, codigo, nome FROM products", conn)
-    except Exception:
-        prods_df = pd.read_sql("SELECT id, nome FROM products", conn)
-        prods_df["codigo"] = ""
+    prods_df = product_options(st.text_input("Pesquisar produto por nome/código", key="busca_prod_comp"))
     if len(prods_df) > 0:
-        labels = [f"{str(r['codigo']) if r['codigo'] else ''} - {r['nome']}" for _, r in prods_df.iterrows()]
+        labels = product_labels(prods_df)
         sel_label = st.selectbox("Selecione produto", labels, index=0, key="sel_prod_comp")
         sel_idx = labels.index(sel_label)
         p_id_sel = int(prods_df.iloc[sel_idx]["id"])
         st.caption(f"ID selecionado: {p_id_sel}")
-        mat_names = pd.read_sql("SELECT id, nome FROM vertical_materials", conn)
-        proc_names = pd.read_sql("SELECT id, nome FROM vertical_processes", conn)
-        th_names = pd.read_sql("SELECT id, nome FROM third_party_items", conn)
-        df_mat = pd.read_sql(f"SELECT vm.nome, mu.quantidade FROM materials_usage mu JOIN vertical_materials vm ON mu.material_id=vm.id WHERE mu.product_id={p_id_sel}", conn)
-        df_proc = pd.read_sql(f"SELECT vp.nome, pu.horas FROM processes_usage pu JOIN vertical_processes vp ON pu.process_id=vp.id WHERE pu.product_id={p_id_sel}", conn)
-        df_th = pd.read_sql(f"SELECT tp.nome, tu.quantidade FROM third_usage tu JOIN third_party_items tp ON tu.third_id=tp.id WHERE tu.product_id={p_id_sel}", conn)
+        df_mat = frame("product_materials", p_id_sel)
+        df_proc = frame("product_processes", p_id_sel)
+        df_th = frame("product_thirds", p_id_sel)
         df_mat_edit = st.data_editor(
             df_mat,
             num_rows="dynamic",
@@ -212,90 +256,49 @@ with tab_prod:
             key="edit_third"
         )
         if st.button("Salvar composição"):
-            db.clear_composition(p_id_sel)
-            for _, r in df_mat_edit.fillna({"quantidade": 0}).iterrows():
-                nome = str(r.get("nome") or "").strip()
-                if nome == "":
-                    continue
-                qty = float(r.get("quantidade") or 0)
-                if nome in mat_names["nome"].tolist():
-                    mid = int(mat_names[mat_names["nome"] == nome]["id"].iloc[0])
-                else:
-                    cur = conn.cursor()
-                    cur.execute("INSERT INTO vertical_materials (grupo, subgrupo, nome, ncm, unidade, preco_unitario, fornecedor, data_atualizacao) VALUES (?,?,?,?,?,?,?,?)",
-                                ("", "", nome, "", "un", 0.0, "", pd.Timestamp.now().strftime("%Y-%m-%d")))
-                    conn.commit()
-                    mid = int(cur.lastrowid)
-                    mat_names = pd.read_sql("SELECT id, nome FROM vertical_materials", conn)
-                db.add_material_usage(p_id_sel, mid, round(qty, 2))
-            for _, r in df_proc_edit.fillna({"horas": 0}).iterrows():
-                nome = str(r.get("nome") or "").strip()
-                if nome == "":
-                    continue
-                hrs = float(r.get("horas") or 0)
-                if nome in proc_names["nome"].tolist():
-                    pidp = int(proc_names[proc_names["nome"] == nome]["id"].iloc[0])
-                else:
-                    cur = conn.cursor()
-                    cur.execute("INSERT INTO vertical_processes (grupo, subgrupo, nome, preco_unitario_hora, unidade, origem) VALUES (?,?,?,?,?,?)",
-                                ("", "", nome, 0.0, "hora", "Manual"))
-                    conn.commit()
-                    pidp = int(cur.lastrowid)
-                    proc_names = pd.read_sql("SELECT id, nome FROM vertical_processes", conn)
-                db.add_process_usage(p_id_sel, pidp, round(hrs, 2))
-            for _, r in df_th_edit.fillna({"quantidade": 0}).iterrows():
-                nome = str(r.get("nome") or "").strip()
-                if nome == "":
-                    continue
-                qty = float(r.get("quantidade") or 0)
-                if nome in th_names["nome"].tolist():
-                    tid = int(th_names[th_names["nome"] == nome]["id"].iloc[0])
-                else:
-                    cur = conn.cursor()
-                    cur.execute("INSERT INTO third_party_items (nome, preco_unitario, quantidade_padrao, fornecedor) VALUES (?,?,?,?)",
-                                (nome, 0.0, 1.0, ""))
-                    conn.commit()
-                    tid = int(cur.lastrowid)
-                    th_names = pd.read_sql("SELECT id, nome FROM third_party_items", conn)
-                db.add_third_usage(p_id_sel, tid, round(qty, 2))
-            st.success("Composição salva")
+            mats = df_mat_edit.fillna({"quantidade": 0})
+            procs = df_proc_edit.fillna({"horas": 0})
+            ths = df_th_edit.fillna({"quantidade": 0})
+            db.replace_composition(
+                p_id_sel,
+                materials=[(n, round(float(q or 0), 2)) for n, q in zip(mats["nome"].fillna(""), mats["quantidade"])],
+                processes=[(n, round(float(h or 0), 2)) for n, h in zip(procs["nome"].fillna(""), procs["horas"])],
+                thirds=[(n, round(float(q or 0), 2)) for n, q in zip(ths["nome"].fillna(""), ths["quantidade"])],
+            )
+            salvo("Composição salva")
         st.subheader("Vincular produto a cliente")
-        cli_df_all = pd.read_sql("SELECT id, nome FROM clients", conn)
+        cli_df_all = frame("clients")
         cli_sel = st.selectbox("Cliente", cli_df_all["nome"].tolist(), key="cliente_vinculo")
         cli_id_sel = int(cli_df_all[cli_df_all["nome"] == cli_sel]["id"].iloc[0])
         if st.button("Vincular"):
             db.link_product_client(p_id_sel, cli_id_sel)
-            st.success("Produto vinculado ao cliente")
+            salvo("Produto vinculado ao cliente")
         if st.button("Desvincular"):
             db.unlink_product_client(p_id_sel, cli_id_sel)
-            st.success("Produto desvinculado do cliente")
+            salvo("Produto desvinculado do cliente")
         try:
             links = pd.read_sql(f"SELECT c.nome FROM product_clients pc JOIN clients c ON c.id=pc.client_id WHERE pc.product_id={p_id_sel}", conn)
             st.dataframe(links)
         except Exception:
             st.dataframe(pd.DataFrame(columns=["nome"]))
 
-with tab3:
-    clis = pd.read_sql("SELECT id, nome FROM clients", conn)
-    c_opt = st.selectbox("Cliente", clis["nome"].tolist(), index=0, key="cliente_precificacao")
-    c_id = int(clis[clis["nome"] == c_opt]["id"].iloc[0])
-    prods_all = pd.read_sql("SELECT id, codigo, nome FROM products", conn)
-    only_linked = st.checkbox("Mostrar apenas produtos vinculados ao cliente", value=False)
-    if only_linked:
-        prods_link = pd.read_sql(f"SELECT p.id, p.codigo, p.nome FROM products p JOIN product_clients pc ON pc.product_id=p.id WHERE pc.client_id={c_id}", conn)
-        df_p = prods_link
-    else:
-        df_p = prods_all
-    q = st.text_input("Pesquisar produto por nome/código")
-    if q:
-        mask = df_p["nome"].str.contains(q, case=False, na=False) | df_p["codigo"].astype(str).str.contains(q, case=False, na=False)
-        df_p = df_p[mask]
-    labels_p = [f"{str(r['codigo']) if r['codigo'] else ''} - {r['nome']}" for _, r in df_p.iterrows()] if len(df_p) > 0 else []
-    p_opt = st.selectbox("Produto", labels_p, index=0 if len(labels_p) > 0 else None, key="produto_precificacao")
-    p_id = int(df_p.iloc[labels_p.index(p_opt)]["id"]) if len(labels_p) > 0 else None
+with tab_prod:
+    secao_produtos()
+
+@st.fragment
+def calculo_preco(p_id, c_id):
+    # Nested in secao_precificacao: the margin slider reruns only this part
+    conn = db.connection()
     margem = st.slider("Margem desejada (%)", 10.0, 50.0, 25.0)
     if p_id and st.button("Calcular preço e margens"):
-        res = suggest_sale_price(conn, p_id, c_id, margem)
+        st.session_state.calc_alvo = (p_id, c_id)
+    # Once calculated, the result follows the margin
+    if p_id and st.session_state.get("calc_alvo") == (p_id, c_id):
+        rollup_cache = get_rollup_cache()
+        rollup_cache.sync(conn)
+        tax_resolver = get_tax_resolver()
+        tax_resolver.check(conn)
+        res = suggest_sale_price(conn, p_id, c_id, margem, rollup=rollup_cache, taxes=tax_resolver)
         st.metric("Preço de Venda Sugerido", f"R$ {float(res['preco_venda']):.2f}")
         st.metric("Margem Real", f"{float(res['margem_real_percent']):.2f}%")
         base = res["base"]
@@ -313,17 +316,162 @@ with tab3:
         st.dataframe(df)
         st.caption(f"PIS {float(res['taxas']['pis'])*100:.2f}% • COFINS {float(res['taxas']['cofins'])*100:.2f}% • ICMS {float(res['taxas']['icms'])*100:.2f}%")
 
-with tab4:
-    base = get_base_cost(conn, 1)
+@st.fragment
+def secao_precificacao():
+    clis = frame("clients")
+    c_opt = st.selectbox("Cliente", clis["nome"].tolist(), index=0, key="cliente_precificacao")
+    c_id = int(clis[clis["nome"] == c_opt]["id"].iloc[0])
+    only_linked = st.checkbox("Mostrar apenas produtos vinculados ao cliente", value=False)
+    q = st.text_input("Pesquisar produto por nome/código")
+    if only_linked:
+        df_p = frame("client_products", c_id)
+        if q:
+            df_p = df_p[df_p["id"].isin(product_options(q)["id"])]
+        df_p = df_p.head(PICKER_PAGE)
+    else:
+        df_p = product_options(q)
+    labels_p = product_labels(df_p)
+    p_opt = st.selectbox("Produto", labels_p, index=0 if len(labels_p) > 0 else None, key="produto_precificacao")
+    p_id = int(df_p.iloc[labels_p.index(p_opt)]["id"]) if len(labels_p) > 0 else None
+    calculo_preco(p_id, c_id)
+
+with tab3:
+    secao_precificacao()
+
+@st.fragment
+def secao_cenarios():
+    conn = db.connection()
+    st.subheader("Cenários de preço")
+    st.caption("Ajustes percentuais (pct) ou em R$ por unidade/hora (abs) sobre materiais, processos e terceiros, por id, grupo ou fornecedor. Avaliados em memória: as tabelas de preço não são alteradas.")
+    cens = frame("scenarios")
+    with st.expander("Criar ou editar cenário", expanded=cens.empty):
+        base_opts = ["(novo)"] + cens["nome"].tolist()
+        editar = st.selectbox("Cenário", base_opts, key="cen_editar")
+        atual = cens[cens["nome"] == editar]
+        if atual.empty:
+            ajustes_df = pd.DataFrame({"categoria": pd.Series(dtype=str), "alvo": pd.Series(dtype=str), "valor": pd.Series(dtype=str), "tipo": pd.Series(dtype=str), "ajuste": pd.Series(dtype=float)})
+        else:
+            ajustes_df = frame("scenario_adjustments", int(atual["id"].iloc[0]))
+        nome = st.text_input("Nome", value="" if atual.empty else editar, key=f"cen_nome_{editar}")
+        descricao = st.text_input("Descrição", value="" if atual.empty else (atual["descricao"].iloc[0] or ""), key=f"cen_desc_{editar}")
+        ajustes = st.data_editor(
+            ajustes_df, num_rows="dynamic", hide_index=True, use_container_width=True, key=f"cen_ajustes_{editar}",
+            column_config={
+                "categoria": st.column_config.SelectboxColumn("categoria", options=list(SCENARIO_TARGETS), required=True),
+                "alvo": st.column_config.SelectboxColumn("alvo", options=["id", "grupo", "fornecedor"], required=True, help="processos: id ou grupo; terceiros: id ou fornecedor"),
+                "valor": st.column_config.TextColumn("valor", required=True, help="id do item, nome do grupo ou do fornecedor"),
+                "tipo": st.column_config.SelectboxColumn("tipo", options=list(SCENARIO_TYPES), required=True),
+                "ajuste": st.column_config.NumberColumn("ajuste", required=True, help="% (pct) ou R$ por unidade/hora (abs)"),
+            },
+        )
+        b1, b2 = st.columns(2)
+        if b1.button("Salvar cenário", key="btn_cen_salvar"):
+            if not nome.strip():
+                st.warning("Informe o nome do cenário")
+            else:
+                try:
+                    db.save_scenario(nome.strip(), ajustes.dropna().to_dict("records"), descricao)
+                except ValueError as e:
+                    st.error(str(e))
+                else:
+                    salvo(f"Cenário '{nome.strip()}' salvo")
+        if not atual.empty and b2.button("Excluir cenário", key="btn_cen_excluir"):
+            db.delete_scenario(int(atual["id"].iloc[0]))
+            salvo(f"Cenário '{editar}' excluído")
+
+    sel = st.multiselect("Comparar cenários", cens["nome"].tolist(), key="cen_comparar")
+    if sel:
+        ids = tuple(int(cens.loc[cens["nome"] == n, "id"].iloc[0]) for n in sel)
+        por_produto, resumo = cached_scenarios(ids, version_stamp(conn).of(SCENARIO_STAMP_TABLES))
+        st.dataframe(
+            resumo.rename(columns={"cenario": "Cenário", "produtos_afetados": "Produtos afetados", "custo_total": "Custo total (R$)", "delta_total": "Δ total (R$)", "maior_delta": "Maior Δ (R$)", "delta_pct": "Δ %"}),
+            hide_index=True, use_container_width=True,
+            column_config={c: st.column_config.NumberColumn(c, format="%.2f") for c in ("Custo total (R$)", "Δ total (R$)", "Maior Δ (R$)", "Δ %")},
+        )
+        # Side by side: cost per scenario for the products that move the most
+        lado = por_produto.pivot(index="product_id", columns="cenario", values="custo")
+        delta = por_produto.pivot(index="product_id", columns="cenario", values="delta").drop(columns="Base")
+        top = delta.abs().max(axis=1).nlargest(50)
+        top = top[top > 0].index
+        if len(top):
+            prods = frame("products").set_index("id")
+            tabela = lado.loc[top]
+            tabela.columns = [f"{c} (R$)" for c in tabela.columns]
+            tabela.insert(0, "Produto", prods["codigo"].astype(str).reindex(top) + " - " + prods["nome"].reindex(top))
+            st.caption(f"{len(top)} produtos com maior variação de custo (sem impostos)")
+            st.dataframe(tabela.reset_index(drop=True), hide_index=True, use_container_width=True,
+                         column_config={c: st.column_config.NumberColumn(c, format="%.2f") for c in tabela.columns[1:]})
+        else:
+            st.info("Nenhum produto muda de custo nos cenários selecionados")
+
+with tab_cen:
+    secao_cenarios()
+
+@st.fragment
+def secao_analise():
+    conn = db.connection()
+    clis = frame("clients")
+    a1, a2 = st.columns(2)
+    c_opt = a1.selectbox("Cliente", clis["nome"].tolist(), index=0, key="cliente_analise")
+    c_id = int(clis[clis["nome"] == c_opt]["id"].iloc[0])
+    q = a2.text_input("Pesquisar produto por nome/código", key="busca_analise")
+    df_p = product_options(q)
+    labels_p = product_labels(df_p)
+    p_opt = st.selectbox("Produto", labels_p, index=0 if labels_p else None, key="produto_analise")
+    if not labels_p or p_opt is None:
+        st.info("Nenhum produto encontrado")
+        return
+    p_id = int(df_p.iloc[labels_p.index(p_opt)]["id"])
+
+    b1, b2, b3, b4 = st.columns(4)
+    faixa = b1.slider("Faixa de margem (%)", 0.0, 80.0, (5.0, 50.0), step=0.5, key="faixa_margem_analise")
+    vol_max = b2.number_input("Volume máximo do pedido", min_value=1, value=1000, step=100, key="volume_analise")
+    frete = b3.number_input("Frete (%)", min_value=0.0, value=0.0, step=0.5, key="frete_analise")
+    outros = b4.number_input("Outros (%)", min_value=0.0, value=0.0, step=0.5, key="outros_analise")
+    admin_opts = [0.0, 2.5, 5.0, 10.0]
+    admins = st.multiselect("Administrativo (%) — com todos os percentuais em 0, os custos administrativos fixos são rateados pelo volume", admin_opts, default=[0.0], key="admin_analise") or [0.0]
+
+    rollup_cache = get_rollup_cache()
+    rollup_cache.sync(conn)
+    tax_resolver = get_tax_resolver()
+    tax_resolver.check(conn)
+    margens = np.arange(faixa[0], faixa[1] + 0.25, 0.5)
+    volumes = np.unique(np.round(np.geomspace(1, vol_max, 40)))
+    grid = sensitivity_grid(conn, p_id, c_id, margens, admin_pcts=admins, frete_pcts=[frete], outros_pcts=[outros], volumes=volumes, rollup=rollup_cache, taxes=tax_resolver)
+    if grid["preco_venda"].isna().all():
+        st.warning("Margem + impostos ≥ 100% em toda a faixa: sem preço possível")
+        return
+
+    # Pareto of the unit price at the middle of the margin range and volume 1
+    ref = grid[(grid["volume"] == 1) & (grid["admin_pct"] == admins[0])].dropna(subset=["preco_venda"])
+    ref = ref.iloc[(ref["margem"] - (faixa[0] + faixa[1]) / 2).abs().argmin()]
+    base = get_base_cost(conn, p_id, rollup_cache)
+    admin_ref = float(ref["custo_unitario"]) - float(base["materiais"] + base["processos"] + base["terceiros"])
     dados_pareto = pd.DataFrame({
-        "Categoria": ["Insumos", "Processos", "Impostos", "Outros"],
-        "Custo_%": [float(base["materiais"]/base["sem_impostos"]*100) if base["sem_impostos"] > 0 else 0, float(base["processos"]/base["sem_impostos"]*100) if base["sem_impostos"] > 0 else 0, 20, float(base["administrativos"]/base["sem_impostos"]*100) if base["sem_impostos"] > 0 else 0]
+        "Categoria": ["Insumos", "Processos", "Terceiros", "Administrativos", "Impostos", "Margem"],
+        "Valor": [float(base["materiais"]), float(base["processos"]), float(base["terceiros"]), admin_ref, ref["impostos_valor"], ref["preco_venda"] - ref["custo_unitario"] - ref["impostos_valor"]],
     })
-    fig1 = px.pie(dados_pareto.round(2), values="Custo_%", names="Categoria", title="Pareto de Custos")
+    fig1 = px.pie(dados_pareto.round(2), values="Valor", names="Categoria", title=f"Composição do preço (margem {ref['margem']:.1f}%, R$ {ref['preco_venda']:,.2f})")
     st.plotly_chart(fig1, width='stretch')
-    volumes = np.array([100, 200, 500, 1000])
-    margens = np.round(25 - 0.01 * volumes, 2)
-    fig2 = px.line(x=volumes, y=margens, title="Sensibilidade: Volume x Margem")
-    fig2.update_xaxes(title="Volume Mensal")
+
+    plano = grid[grid["admin_pct"] == admins[0]]
+    fig2 = px.density_heatmap(
+        plano, x="volume", y="margem", z="preco_venda", histfunc="avg", log_x=True,
+        nbinsx=len(volumes), nbinsy=len(margens), title="Sensibilidade: Volume x Margem — preço unitário (R$)",
+    )
+    fig2.update_xaxes(title="Volume do pedido")
     fig2.update_yaxes(title="Margem %")
     st.plotly_chart(fig2, width='stretch')
+
+    # Price per unit along the volume axis, a few margins, one line per admin option
+    cortes = np.unique(np.round(np.linspace(margens[0], margens[-1], 4) * 2) / 2)
+    linhas = grid[grid["margem"].isin(cortes)].assign(serie=lambda d: "margem " + d["margem"].map("{:.1f}%".format) + " / adm " + d["admin_pct"].map("{:.1f}%".format))
+    fig3 = px.line(linhas, x="volume", y="preco_venda", color="serie", log_x=True, title="Preço unitário por volume")
+    fig3.update_xaxes(title="Volume do pedido")
+    fig3.update_yaxes(title="Preço (R$)")
+    st.plotly_chart(fig3, width='stretch')
+    st.caption(f"{len(grid):,} combinações calculadas numa avaliação (margens × administrativo × volumes); receita e lucro totais na planilha abaixo.")
+    st.dataframe(grid, hide_index=True, use_container_width=True)
+
+with tab4:
+    secao_analise()
@@ -1,11 +1,22 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
+import plotly.graph_objects as go
 import numpy as np
 from io import BytesIO
-from pricing.db import Database
-from pricing.engine import import_planilha_processos, suggest_sale_price, get_base_cost
+import tempfile
+from pricing.db import Database, COST_TABLES, SCENARIO_TARGETS, SCENARIO_TYPES
+from pricing.cache import RollupCache
+from pricing.engine import suggest_sale_price, get_base_cost, TaxResolver
+from pricing.erp_import import preview_erp_file, import_erp_file
+from pricing.frames import load_frame, version_stamp
+from pricing.editor import paged_editor
+from pricing.export import EXPORTERS
+from pricing.history import history_series
+from pricing.reprice import create_job, job_status, start_background
+from pricing.scenarios import compare_scenarios
+from pricing.snapshot import refresh_snapshot
 from pricing.auth import hash_password, verify_password, is_master_password
+from pricing import instrument
 import os
 
 st.set_page_config(page_title="Módulo de Precificação", layout="wide")
@@ -16,15 +27,69 @@ def get_db():
     db.seed_demo()
     return db
 
+@st.cache_resource
+def get_rollup_cache():
+    return RollupCache(maxsize=20000)
+
+@st.cache_resource
+def get_tax_resolver():
+    return TaxResolver()
+
+@st.cache_data(max_entries=512, show_spinner=False)
+def cached_frame(name, stamp, params=()):
+    # stamp = table_versions of the frame's tables: any write makes a new key
+    return load_frame(get_db().connection(), name, params)
+
 db = get_db()
-db.init_schema()
-conn = db.connect()
-conn.execute("CREATE TABLE IF NOT EXISTS product_clients (id INTEGER PRIMARY KEY AUTOINCREMENT, product_id INTEGER, client_id INTEGER)")
+
+def frame(name, *params):
+    return cached_frame(name, version_stamp(db.connection())(name), params)
+
+@st.cache_data(max_entries=16, show_spinner="Avaliando cenários...")
+def cached_scenarios(scenario_ids, stamp):
+    # stamp = generations of the cost tables and scenarios: any price,
+    # composition or adjustment change makes a new key
+    return compare_scenarios(get_db().connection(), scenario_ids)
+
+SCENARIO_STAMP_TABLES = COST_TABLES + ("scenarios", "scenario_adjustments")
+
+PORTFOLIO_COLUNAS = {
+    "codigo": "Código", "nome": "Produto", "margem": "Margem Negociada(%)", "preco_final": "Preço Final(R$)",
+    "preco_atual": "Preço Atual(R$)", "custo_atual": "Custo Atual(R$)", "data_vinculo": "Data da Negociação",
+}
+
+# Column formats instead of a Styler: rendered by the frontend, no HTML built per rerun
+FORMATO_2CASAS = {c: st.column_config.NumberColumn(c, format="%.2f") for c in ("Qtd", "Unit(R$)", "Total(R$)", "% do Custo")}
+
+PICKER_PAGE = 50  # options a product picker offers, with or without a search
+
+def product_labels(df):
+    return (df["codigo"].fillna("").astype(str) + " - " + df["nome"].astype(str)).tolist()
+
+def product_options(q, limit=PICKER_PAGE):
+    # Picker rows: ranked FTS5 prefix search (db.search) for typed text,
+    # else the first page in id order; never the whole catalog
+    if q:
+        return pd.DataFrame([dict(r) for r in db.search("products", q, k=limit)], columns=["id", "codigo", "nome", "grupo", "subgrupo"])
+    return frame("products_page", limit)
+
+def salvo(msg):
+    # A write changes what other sections show: rerun the whole app (not just
+    # the fragment) and show the message at the top of that run
+    st.session_state.aviso = msg
+    st.rerun()
+
+if db.quarantined_links:
+    st.warning("Vínculos de composição que formavam ciclo foram movidos para product_components_quarantine: " + ", ".join(f"{pai} → {comp}" for _id, pai, comp, _q in db.quarantined_links[:20]))
 
 st.title("Módulo de Precificação")
-tab_access, tab_cli, tab2, tab_prod, tab3, tab_upload = st.tabs(["Acesso & Agendamentos", "Gestão de Clientes", "Cadastros Gerais", "Produtos", "Precificação", "UpLoad de arquivos"])
+if st.session_state.get("aviso"):
+    st.success(st.session_state.pop("aviso"))
+tab_access, tab_cli, tab2, tab_prod, tab3, tab_cen, tab_upload = st.tabs(["Acesso & Agendamentos", "Gestão de Clientes", "Cadastros Gerais", "Produtos", "Precificação", "Cenários", "UpLoad de arquivos"])
 
-with tab_upload:
+@st.fragment
+def secao_upload():
+    conn = db.connection()
     if not st.session_state.get("usuario"):
         st.warning("Acesso restrito. Faça login na aba 'Acesso & Agendamentos'.")
     else:
@@ -32,157 +97,149 @@ with tab_upload:
         with c1:
             f = st.file_uploader("Anexe arquivo ERP (XLSX/CSV)", type=["xlsx", "csv"], key="upl_file")
             if f:
-                df = pd.read_excel(f) if f.name.endswith(".xlsx") else pd.read_csv(f)
-                cols = [str(c) for c in df.columns]
-                lc = [c.lower() for c in cols]
-                def pick(colset):
-                    for k in colset:
-                        for i, c in enumerate(lc):
-                            if k in c:
-                                return cols[i]
-                    return None
-                is_materials = any("insumo" in x or "matéria" in x or "materia" in x for x in lc) or (pick({"nome_insumo","insumo"}) is not None and pick({"custo_unit","custo_unitario","preco_unitario"}) is not None)
-                if is_materials:
-                    nome_c = pick({"nome_insumo","insumo","nome"})
-                    preco_c = pick({"custo_unitario","preco_unitario","valor_unitario"})
-                    qtd_c = pick({"quantidade","qtde","qtd"})
-                    forn_c = pick({"fornecedor"})
-                    grupo_c = pick({"grupo"})
-                    subgrupo_c = pick({"subgrupo"})
-                    unidade_c = pick({"unidade","unit"})
-                    ncm_c = pick({"ncm"})
-                    mdf = pd.DataFrame({
-                        "grupo": df[grupo_c] if grupo_c else "",
-                        "subgrupo": df[subgrupo_c] if subgrupo_c else "",
-                        "nome": df[nome_c] if nome_c else df[cols[0]],
-                        "ncm": df[ncm_c] if ncm_c else "",
-                        "unidade": df[unidade_c] if unidade_c else "un",
-                        "preco_unitario": df[preco_c] if preco_c else 0.0,
-                        "fornecedor": df[forn_c] if forn_c else "",
-                    })
-                mdf_edit = st.data_editor(mdf, num_rows="dynamic", column_config={"preco_unitario": st.column_config.NumberColumn("preco_unitario", format="%.2f")})
-                if st.button("Salvar e importar materiais"):
-                    cur = conn.cursor()
-                    for _, r in mdf_edit.fillna("").iterrows():
-                        cur.execute("INSERT INTO vertical_materials (grupo, subgrupo, nome, ncm, unidade, preco_unitario, fornecedor, data_atualizacao) VALUES (?,?,?,?,?,?,?,?)",
-                                        (r["grupo"], r["subgrupo"], r["nome"], r["ncm"], r["unidade"], round(float(r["preco_unitario"]) if r["preco_unitario"] != "" else 0.0, 2), r["fornecedor"], pd.Timestamp.now().strftime("%Y-%m-%d")))
-                    conn.commit()
-                    st.success("Materiais importados")
+                tipo, previa = preview_erp_file(f, f.name)
+                if tipo is None:
+                    st.warning("Arquivo sem linhas para importar")
                 else:
-                    nome_c = pick({"nome","processo","operacao"})
-                    preco_h_c = pick({"preco_hora","valor_hora","custo_hora"})
-                    preco_min_c = pick({"preco_minuto","valor_minuto","custo_minuto"})
-                    grupo_c = pick({"grupo"})
-                    subgrupo_c = pick({"subgrupo"})
-                    unidade_c = pick({"unidade","unit"})
-                    if preco_h_c is None and preco_min_c is not None:
-                        df["__preco_hora__"] = df[preco_min_c].astype(float) * 60.0
-                        preco_h_c = "__preco_hora__"
-                    pdf = pd.DataFrame({
-                        "grupo": df[grupo_c] if grupo_c else "",
-                        "subgrupo": df[subgrupo_c] if subgrupo_c else "",
-                        "nome": df[nome_c] if nome_c else df[cols[0]],
-                        "preco_unitario_hora": df[preco_h_c] if preco_h_c else 0.0,
-                        "unidade": df[unidade_c] if unidade_c else "hora"
-                    })
-                    pdf_edit = st.data_editor(pdf, num_rows="dynamic", column_config={"preco_unitario_hora": st.column_config.NumberColumn("preco_unitario_hora", format="%.2f")})
-                    if st.button("Salvar e importar processos"):
-                        rows = []
-                        for _, r in pdf_edit.fillna("").iterrows():
-                            rows.append({
-                                "grupo": r["grupo"],
-                                "subgrupo": r["subgrupo"],
-                                "nome": r["nome"],
-                                "preco_unitario_hora": round(float(r["preco_unitario_hora"]) if r["preco_unitario_hora"] != "" else 0.0, 2),
-                                "unidade": r["unidade"]
-                            })
-                        import_planilha_processos(conn, rows)
-                        st.success("Processos importados")
+                    st.caption(f"Layout detectado: {tipo} — prévia das primeiras {len(previa)} linhas")
+                    st.dataframe(previa, hide_index=True)
+                    if st.button("Salvar e importar materiais" if tipo == "materiais" else "Salvar e importar processos"):
+                        barra = st.progress(0.0)
+                        status = st.empty()
+                        def mostrar_progresso(linhas, fracao, taxa):
+                            if fracao is not None:
+                                barra.progress(fracao)
+                            status.text(f"{linhas:,} linhas importadas ({taxa:,.0f} linhas/s)")
+                        res = import_erp_file(db, f, f.name, progress=mostrar_progresso)
+                        barra.progress(1.0)
+                        salvo(f"{'Materiais' if tipo == 'materiais' else 'Processos'} importados: {res['linhas']:,} linhas em {res['segundos']:.1f} s ({res['linhas_por_s']:,.0f} linhas/s)")
         with c2:
-            buf = BytesIO()
-            for t in ["vertical_materials", "vertical_processes", "clients"]:
-                pd.read_sql(f"SELECT * FROM {t}", conn).to_csv(buf, index=False)
-            st.download_button("Exportar DB Vertical e Clientes", buf.getvalue(), "db_export.csv")
+            formato = st.radio("Exportar DB Vertical e Clientes", ["XLSX (uma aba por tabela)", "ZIP de CSVs (mais rápido)"], key="export_formato")
+            ext = "xlsx" if formato.startswith("XLSX") else "zip"
+            if st.button("Gerar exportação", key="btn_exportar"):
+                # Streamed to a temporary file, then offered for download
+                barra = st.progress(0.0)
+                status = st.empty()
+                def mostrar_progresso(tabela, linhas, fracao):
+                    barra.progress(fracao)
+                    status.text(f"{tabela}: {linhas:,} linhas exportadas")
+                anterior = st.session_state.pop("export_arquivo", None)
+                if anterior and os.path.exists(anterior[0]):
+                    os.remove(anterior[0])
+                with tempfile.NamedTemporaryFile(suffix="." + ext, delete=False) as tmp:
+                    totais = EXPORTERS[ext](conn, tmp, progress=mostrar_progresso)
+                st.session_state.export_arquivo = (tmp.name, ext, sum(totais.values()))
+            arquivo = st.session_state.get("export_arquivo")
+            if arquivo and os.path.exists(arquivo[0]):
+                with open(arquivo[0], "rb") as fh:
+                    st.download_button(f"Baixar exportação ({arquivo[2]:,} linhas)", fh, f"db_export.{arquivo[1]}", key="btn_baixar_export")
 
-with tab_cli:
+        st.divider()
+        st.subheader("Reprecificação de vínculos")
+        st.caption("Recalcula o preço final de cada vínculo produto-cliente na margem negociada, com os custos atuais (após importar tabelas de preço), e grava o histórico de custos.")
+        job = job_status(conn)
+        ativo = job is not None and job["status"] in ("pendente", "executando") and not job["interrompido"]
+        clis = frame("clients")
+        grupos = frame("products")["grupo"].cat.categories.tolist()
+        r1, r2 = st.columns(2)
+        sel_clis = r1.multiselect("Clientes (vazio = todos)", clis["nome"].tolist(), key="reprice_clientes")
+        sel_grupos = r2.multiselect("Grupos de produto (vazio = todos)", grupos, key="reprice_grupos")
+        b1, b2 = st.columns(2)
+        if b1.button("Reprecificar vínculos", disabled=ativo, key="btn_reprice"):
+            ids = clis.loc[clis["nome"].isin(sel_clis), "id"].tolist()
+            job_id = create_job(db, clientes=ids, grupos=sel_grupos)
+            start_background(db, job_id)
+            st.session_state.reprice_job = job_id
+            st.rerun()
+        if job is not None and job["interrompido"] and job["status"] != "concluido":
+            if b2.button(f"Retomar job {job['id']}", key="btn_reprice_retomar"):
+                start_background(db, job["id"])
+                st.session_state.reprice_job = job["id"]
+                st.rerun()
+        # Polls the job every 2 s while it runs; the rest of the app is not rerun
+        st.fragment(progresso_reprecificacao, run_every=2 if ativo else None)()
+
+def progresso_reprecificacao():
+    job = job_status(db.connection())
+    if job is None:
+        return
+    st.progress(job["progresso"])
+    texto = f"Job {job['id']} ({job['status']}): {job['feitos']:,} de {job['total_links']:,} vínculos reprecificados"
+    if job["ignorados"]:
+        texto += f", {job['ignorados']:,} ignorados (sem margem ou margem + impostos ≥ 100%)"
+    if job["eta_s"] is not None:
+        texto += f" — faltam ~{job['eta_s'] / 60:.0f} min" if job["eta_s"] >= 90 else f" — faltam ~{job['eta_s']:.0f} s"
+    st.caption(texto)
+    if job["interrompido"]:
+        st.warning(f"Job interrompido{': ' + job['erro'] if job['erro'] else ''}. Use 'Retomar' para continuar dos lotes pendentes.")
+    if job["status"] == "concluido" and st.session_state.get("reprice_job") == job["id"]:
+        # Finished while polled: stop polling and refresh the sections showing prices
+        del st.session_state.reprice_job
+        salvo(f"Reprecificação concluída: {job['feitos']:,} vínculos atualizados")
+
+with tab_upload:
+    secao_upload()
+
+@st.fragment
+def secao_clientes():
     if not st.session_state.get("usuario"):
         st.warning("Acesso restrito. Faça login na aba 'Acesso & Agendamentos'.")
     else:
         st.subheader("Gerenciar Clientes")
-        cli_df = pd.read_sql("SELECT * FROM clients", conn)
-        cli_edit = st.data_editor(
-            cli_df,
-            num_rows="dynamic",
-            key="editor_clientes_main",
-        )
+        cli_df, cli_edit = paged_editor(db, "clients", "editor_clientes_main")
         if st.button("Salvar Clientes", key="btn_save_clientes_main"):
-            cur = conn.cursor()
-            cur.execute("DELETE FROM clients")
-            for _, r in cli_edit.fillna("").iterrows():
-                cur.execute(
-                    "INSERT INTO clients (id, codigo, nome, planta, uf, cidade, regime, pis, cofins, icms, fator) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
-                    (
-                        int(r["id"]) if pd.notna(r["id"]) else None,
-                        str(r.get("codigo") or "").strip(),
-                        r["nome"],
-                        r["planta"],
-                        r["uf"],
-                        r["cidade"],
-                        r["regime"],
-                        float(r["pis"] or 0),
-                        float(r["cofins"] or 0),
-                        float(r["icms"] or 0),
-                        float(r["fator"] or 0),
-                    ),
-                )
-            conn.commit()
-            st.success("Clientes atualizados com sucesso!")
-            st.rerun()
+            db.apply_changes("clients", cli_df, cli_edit)
+            salvo("Clientes atualizados com sucesso!")
 
         st.divider()
         st.subheader("Portfólio do Cliente (Produtos Adquiridos)")
         
         # Reload clients to ensure fresh list
-        clis_fresh = pd.read_sql("SELECT id, nome FROM clients", conn)
+        clis_fresh = frame("clients")
         if not clis_fresh.empty:
             c_sel = st.selectbox("Selecione um cliente para ver o histórico", clis_fresh["nome"].tolist(), key="sel_cli_portfolio")
             cid_sel = int(clis_fresh[clis_fresh["nome"] == c_sel]["id"].iloc[0])
             
-            # Get linked products
-            portfolio = pd.read_sql(f"""
-                SELECT p.codigo as 'Código', p.nome as 'Produto', 
-                       pc.margem as 'Margem Negociada(%)', 
-                       pc.preco_final as 'Preço Final(R$)', 
-                       pc.data_vinculo as 'Data da Negociação'
-                FROM product_clients pc
-                JOIN products p ON pc.product_id = p.id
-                WHERE pc.client_id = {cid_sel}
-                ORDER BY pc.data_vinculo DESC
-            """, conn)
+            # Current cost and quote come from the snapshot tables, refreshed
+            # here only for the products marked since the last run
+            refresh_snapshot(db)
+            portfolio = frame("client_portfolio", cid_sel).rename(columns=PORTFOLIO_COLUNAS)
             
             if not portfolio.empty:
                 st.dataframe(portfolio, use_container_width=True)
                 
-                # Metrics summary
-                col_sum1, col_sum2 = st.columns(2)
+                # Metrics summary: one aggregate query
+                m = frame("client_portfolio_metrics", cid_sel).iloc[0]
+                col_sum1, col_sum2, col_sum3, col_sum4 = st.columns(4)
                 with col_sum1:
-                    st.metric("Total de Produtos Vinculados", len(portfolio))
+                    st.metric("Total de Produtos Vinculados", int(m["produtos"]))
                 with col_sum2:
-                    st.metric("Ticket Médio (Preço Final)", f"R$ {portfolio['Preço Final(R$)'].mean():.2f}")
+                    st.metric("Ticket Médio (Preço Final)", f"R$ {m['ticket_medio']:.2f}")
+                with col_sum3:
+                    st.metric("Valor Negociado Total", f"R$ {m['valor_negociado']:.2f}")
+                with col_sum4:
+                    deriva = m["deriva_custo_pct"]
+                    st.metric(
+                        "Variação do Custo desde o Orçamento",
+                        "—" if pd.isna(deriva) else f"{deriva:+.2f}%",
+                        help=f"{int(m['defasados'])} vínculo(s) com preço atual acima do negociado",
+                    )
             else:
                 st.info(f"O cliente {c_sel} ainda não possui produtos vinculados/negociados.")
         else:
             st.warning("Cadastre clientes acima para visualizar o portfólio.")
 
-with tab2:
+with tab_cli:
+    secao_clientes()
+
+@st.fragment
+def secao_cadastros():
     if not st.session_state.get("usuario"):
         st.warning("Acesso restrito. Faça login na aba 'Acesso & Agendamentos'.")
     else:
         st.subheader("Materiais")
-        mat_df = pd.read_sql("SELECT * FROM vertical_materials", conn)
-        mat_edit = st.data_editor(
-            mat_df,
-            num_rows="dynamic",
+        mat_df, mat_edit = paged_editor(
+            db, "vertical_materials", "editor_materiais",
             column_config={
                 "preco_unitario": st.column_config.NumberColumn("preco_unitario", format="%.2f")
             },
@@ -190,93 +247,41 @@ with tab2:
         if not mat_df.empty:
             col_dup1, col_dup2 = st.columns([3, 1])
             with col_dup1:
-                mat_labels = [
-                    f"{str(r.get('codigo') or '')} - {r['nome']}" if r.get("codigo") else r["nome"]
-                    for _, r in mat_df.iterrows()
-                ]
+                codigos = mat_df["codigo"].fillna("").astype(str)
+                nomes = mat_df["nome"].fillna("").astype(str)
+                mat_labels = (codigos + " - " + nomes).where(codigos != "", nomes).tolist()
                 mat_choice = st.selectbox(
-                    "Selecionar material para duplicar",
+                    "Selecionar material da página para duplicar",
                     mat_labels,
                     key="sel_material_dup",
                 )
                 sel_idx = mat_labels.index(mat_choice) if mat_choice in mat_labels else None
             with col_dup2:
                 if st.button("Duplicar material selecionado", key="btn_dup_material") and sel_idx is not None:
-                    src = mat_df.iloc[sel_idx]
-                    novo_codigo = (str(src.get("codigo") or "").strip() + "_COPY") if src.get("codigo") else ""
-                    cur = conn.cursor()
-                    cur.execute(
-                        "INSERT INTO vertical_materials (codigo, grupo, subgrupo, nome, ncm, unidade, preco_unitario, fornecedor, data_atualizacao) VALUES (?,?,?,?,?,?,?,?,?)",
-                        (
-                            novo_codigo,
-                            src["grupo"],
-                            src["subgrupo"],
-                            src["nome"],
-                            src["ncm"],
-                            src["unidade"],
-                            float(src["preco_unitario"] or 0),
-                            src["fornecedor"],
-                            src["data_atualizacao"],
-                        ),
-                    )
-                    conn.commit()
-                    st.success("Material duplicado com sucesso. Ajuste os dados conforme necessário.")
-                    st.rerun()
+                    db.duplicate_material(int(mat_df.iloc[sel_idx]["id"]))
+                    salvo("Material duplicado com sucesso. Ajuste os dados conforme necessário.")
         st.subheader("Processos")
-        proc_df = pd.read_sql("SELECT * FROM vertical_processes", conn)
-        proc_edit = st.data_editor(
-            proc_df,
-            num_rows="dynamic",
+        proc_df, proc_edit = paged_editor(
+            db, "vertical_processes", "editor_processos",
             column_config={
                 "preco_unitario_hora": st.column_config.NumberColumn("preco_unitario_hora", format="%.2f")
             },
         )
         st.subheader("Terceiros")
-        th_df = pd.read_sql("SELECT * FROM third_party_items", conn)
-        th_edit = st.data_editor(th_df, num_rows="dynamic", column_config={"preco_unitario": st.column_config.NumberColumn("preco_unitario", format="%.2f"), "quantidade_padrao": st.column_config.NumberColumn("quantidade_padrao", format="%.2f")})
+        th_df, th_edit = paged_editor(db, "third_party_items", "editor_terceiros", column_config={"preco_unitario": st.column_config.NumberColumn("preco_unitario", format="%.2f"), "quantidade_padrao": st.column_config.NumberColumn("quantidade_padrao", format="%.2f")})
         
         if st.button("Salvar alterações"):
-            cur = conn.cursor()
-            cur.execute("DELETE FROM vertical_materials")
-            for _, r in mat_edit.fillna("").iterrows():
-                cur.execute(
-                    "INSERT INTO vertical_materials (id, codigo, grupo, subgrupo, nome, ncm, unidade, preco_unitario, fornecedor, data_atualizacao) VALUES (?,?,?,?,?,?,?,?,?,?)",
-                    (
-                        int(r["id"]) if pd.notna(r["id"]) else None,
-                        str(r.get("codigo") or "").strip(),
-                        r["grupo"],
-                        r["subgrupo"],
-                        r["nome"],
-                        r["ncm"],
-                        r["unidade"],
-                        float(r["preco_unitario"]),
-                        r["fornecedor"],
-                        r["data_atualizacao"],
-                    ),
-                )
-            cur.execute("DELETE FROM vertical_processes")
-            for _, r in proc_edit.fillna("").iterrows():
-                cur.execute(
-                    "INSERT INTO vertical_processes (id, grupo, subgrupo, nome, preco_unitario_hora, unidade, origem, maquina) VALUES (?,?,?,?,?,?,?,?)",
-                    (
-                        int(r["id"]) if pd.notna(r["id"]) else None,
-                        r["grupo"],
-                        r["subgrupo"],
-                        r["nome"],
-                        float(r["preco_unitario_hora"]),
-                        r["unidade"],
-                        r["origem"],
-                        r.get("maquina"),
-                    ),
-                )
-            cur.execute("DELETE FROM third_party_items")
-            for _, r in th_edit.fillna("").iterrows():
-                cur.execute("INSERT INTO third_party_items (id, nome, preco_unitario, quantidade_padrao, fornecedor, unidade) VALUES (?,?,?,?,?,?)",
-                            (int(r.get("id")) if pd.notna(r.get("id")) else None, r.get("nome"), float(r.get("preco_unitario") or 0), float(r.get("quantidade_padrao") or 0), r.get("fornecedor") or "", r.get("unidade") or "serviço"))
-            conn.commit()
-            st.success("Dados salvos")
+            with db.transaction():
+                db.apply_changes("vertical_materials", mat_df, mat_edit)
+                db.apply_changes("vertical_processes", proc_df, proc_edit)
+                db.apply_changes("third_party_items", th_df, th_edit)
+            salvo("Dados salvos")
 
-with tab_prod:
+with tab2:
+    secao_cadastros()
+
+@st.fragment
+def secao_produtos():
     if not st.session_state.get("usuario"):
         st.warning("Acesso restrito. Faça login na aba 'Acesso & Agendamentos'.")
     else:
@@ -291,9 +296,9 @@ with tab_prod:
         origem_uf_p = st.text_input("UF fabricação")
         if st.button("Criar produto"):
             pid = db.add_product(codigo, nome_p, quantidade_p, destino_uf_p, ncm_p, origem_uf_p, grupo_p, subgrupo_p)
-            st.success(f"Produto criado: ID {pid}")
+            salvo(f"Produto criado: ID {pid}")
         st.subheader("Editar produtos (planilha)")
-        produtos_orig = pd.read_sql("SELECT id, codigo, nome, quantidade, destino_uf, ncm, local_fabricacao_uf, grupo, subgrupo FROM products", conn)
+        produtos_orig = frame("products_editor")
         produtos_edit = st.data_editor(produtos_orig, num_rows="dynamic", column_config={"quantidade": st.column_config.NumberColumn("quantidade", format="%.2f")})
         if st.button("Salvar produtos"):
             ids_orig = set(produtos_orig["id"].tolist())
@@ -325,68 +330,342 @@ with tab_prod:
                         r.get("grupo"),
                         r.get("subgrupo"),
                     )
-            st.success("Produtos salvos")
+            salvo("Produtos salvos")
         # Removido: composição e vínculo do produto aqui. Agora ficam na aba Precificação.
 
-with tab3:
+with tab_prod:
+    secao_produtos()
+
+@st.fragment
+@instrument.traced("Seção Precificação")
+def calculo_preco(p_id, c_id, c_opt):
+    # Nested in secao_precificacao: margin and percentages rerun only this
+    # part; the panel's etapas show how much of the run is the pricing itself
+    conn = db.connection()
+    margem = st.slider("Margem desejada (%)", 10.0, 50.0, 25.0)
+    colp1, colp2, colp3 = st.columns(3)
+    with colp1:
+        admin_pct = st.number_input("Administrativos (%)", value=0.0, min_value=0.0, step=1.0)
+    with colp2:
+        frete_pct = st.number_input("Frete (%)", value=0.0, min_value=0.0, step=1.0)
+    with colp3:
+        outros_pct = st.number_input("Outros (%)", value=0.0, min_value=0.0, step=1.0)
+    if p_id and st.button("Calcular preço e margens"):
+        st.session_state.calc_alvo = (p_id, c_id)
+
+    # Once calculated, the result follows the margin and percentages
+    res = None
+    if p_id and st.session_state.get("calc_alvo") == (p_id, c_id):
+        with instrument.operation("Calcular preço", f"produto {p_id}, cliente {c_id}"):
+            rollup_cache = get_rollup_cache()
+            with instrument.stage("rollup"):
+                rollup_cache.sync(conn)
+            tax_resolver = get_tax_resolver()
+            with instrument.stage("impostos"):
+                tax_resolver.check(conn)
+            res = suggest_sale_price(conn, p_id, c_id, margem, admin_pct, frete_pct, outros_pct, rollup=rollup_cache, taxes=tax_resolver)
+
+    if res:
+        base = res["base"]
+        
+        st.divider()
+        col_m1, col_m2 = st.columns(2)
+        with col_m1:
+            st.metric("Preço de Venda Sugerido", f"R$ {float(res['preco_venda']):.2f}")
+        with col_m2:
+            st.metric("Margem Real", f"{float(res['margem_real_percent']):.2f}%")
+        
+        # Detailed Breakdown with percentages
+        total_cost = float(base["sem_impostos"])
+        def fmt_pct(val):
+            return f"({(val/total_cost*100) if total_cost > 0 else 0:.1f}%)"
+
+        st.subheader("Detalhamento de Custos")
+        
+        total_mat_recursive = float(base["materiais"])
+        df_mat_det = pd.read_sql(
+            f"SELECT vm.nome as Item, mu.quantidade as Qtd, vm.preco_unitario as 'Unit(R$)', "
+            f"(mu.quantidade * vm.preco_unitario) as 'Total(R$)' "
+            f"FROM materials_usage mu JOIN vertical_materials vm ON mu.material_id=vm.id "
+            f"WHERE mu.product_id={p_id}",
+            conn,
+        )
+        total_mat_direct = df_mat_det["Total(R$)"].sum() if not df_mat_det.empty else 0.0
+        total_mat_indirect = total_mat_recursive - total_mat_direct
+
+        with st.expander(f"Materiais: R$ {total_mat_recursive:.2f} {fmt_pct(total_mat_recursive)}", expanded=False):
+            if not df_mat_det.empty:
+                st.dataframe(df_mat_det, column_config=FORMATO_2CASAS, use_container_width=True)
+            if total_mat_indirect > 0.01:
+                st.info(f"Materiais de Sub-componentes: R$ {total_mat_indirect:.2f}")
+
+        total_proc_recursive = float(base["processos"])
+        df_proc_det = pd.read_sql(
+            f"SELECT vp.nome as Item, pu.horas as Qtd, vp.preco_unitario_hora as 'Unit(R$)', "
+            f"(pu.horas * vp.preco_unitario_hora) as 'Total(R$)' "
+            f"FROM processes_usage pu JOIN vertical_processes vp ON pu.process_id=vp.id "
+            f"WHERE pu.product_id={p_id}",
+            conn,
+        )
+        total_proc_direct = df_proc_det["Total(R$)"].sum() if not df_proc_det.empty else 0.0
+        total_proc_indirect = total_proc_recursive - total_proc_direct
+
+        with st.expander(f"Processos: R$ {total_proc_recursive:.2f} {fmt_pct(total_proc_recursive)}", expanded=False):
+            if not df_proc_det.empty:
+                st.dataframe(df_proc_det, column_config=FORMATO_2CASAS, use_container_width=True)
+            if total_proc_indirect > 0.01:
+                st.info(f"Processos de Sub-componentes: R$ {total_proc_indirect:.2f}")
+
+        total_third_recursive = float(base["terceiros"])
+        df_third_det = pd.read_sql(
+            f"SELECT tp.nome as Item, tu.quantidade as Qtd, tp.preco_unitario as 'Unit(R$)', "
+            f"(tu.quantidade * tp.preco_unitario) as 'Total(R$)' "
+            f"FROM third_usage tu JOIN third_party_items tp ON tu.third_id=tp.id "
+            f"WHERE tu.product_id={p_id}",
+            conn,
+        )
+        total_third_direct = df_third_det["Total(R$)"].sum() if not df_third_det.empty else 0.0
+        total_third_indirect = total_third_recursive - total_third_direct
+
+        with st.expander(f"Terceiros: R$ {total_third_recursive:.2f} {fmt_pct(total_third_recursive)}", expanded=False):
+            if not df_third_det.empty:
+                st.dataframe(df_third_det, column_config=FORMATO_2CASAS, use_container_width=True)
+            if total_third_indirect > 0.01:
+                st.info(f"Terceiros de Sub-componentes: R$ {total_third_indirect:.2f}")
+
+        v_adm = float(base["administrativos"])
+        v_imp = float(res["impostos_valor"])
+        with st.expander(f"Outros Custos & Impostos: R$ {v_adm+v_imp:.2f}", expanded=False):
+            st.markdown(f"**Admin/Frete/Outros**: R$ {v_adm:.2f} {fmt_pct(v_adm)}")
+            st.markdown(f"**Impostos**: R$ {v_imp:.2f} ({float(res['taxas']['total'])*100:.1f}%)")
+
+        planilha_rows = []
+        if not df_mat_det.empty:
+            for _, r in df_mat_det.iterrows():
+                planilha_rows.append(
+                    {
+                        "Categoria": "Materiais",
+                        "Item": r["Item"],
+                        "Qtd": float(r["Qtd"]),
+                        "Unit(R$)": float(r["Unit(R$)"]),
+                        "Total(R$)": float(r["Total(R$)"]),
+                    }
+                )
+        if total_mat_indirect > 0.01:
+            planilha_rows.append(
+                {
+                    "Categoria": "Materiais",
+                    "Item": "Materiais de Sub-componentes",
+                    "Qtd": None,
+                    "Unit(R$)": None,
+                    "Total(R$)": float(total_mat_indirect),
+                }
+            )
+
+        if not df_proc_det.empty:
+            for _, r in df_proc_det.iterrows():
+                planilha_rows.append(
+                    {
+                        "Categoria": "Processos",
+                        "Item": r["Item"],
+                        "Qtd": float(r["Qtd"]),
+                        "Unit(R$)": float(r["Unit(R$)"]),
+                        "Total(R$)": float(r["Total(R$)"]),
+                    }
+                )
+        if total_proc_indirect > 0.01:
+            planilha_rows.append(
+                {
+                    "Categoria": "Processos",
+                    "Item": "Processos de Sub-componentes",
+                    "Qtd": None,
+                    "Unit(R$)": None,
+                    "Total(R$)": float(total_proc_indirect),
+                }
+            )
+
+        if not df_third_det.empty:
+            for _, r in df_third_det.iterrows():
+                planilha_rows.append(
+                    {
+                        "Categoria": "Terceiros",
+                        "Item": r["Item"],
+                        "Qtd": float(r["Qtd"]),
+                        "Unit(R$)": float(r["Unit(R$)"]),
+                        "Total(R$)": float(r["Total(R$)"]),
+                    }
+                )
+        if total_third_indirect > 0.01:
+            planilha_rows.append(
+                {
+                    "Categoria": "Terceiros",
+                    "Item": "Terceiros de Sub-componentes",
+                    "Qtd": None,
+                    "Unit(R$)": None,
+                    "Total(R$)": float(total_third_indirect),
+                }
+            )
+
+        planilha_rows.append(
+            {
+                "Categoria": "Admin/Outros",
+                "Item": "Admin/Frete/Outros",
+                "Qtd": None,
+                "Unit(R$)": None,
+                "Total(R$)": float(v_adm),
+            }
+        )
+        planilha_rows.append(
+            {
+                "Categoria": "Impostos",
+                "Item": "Impostos",
+                "Qtd": None,
+                "Unit(R$)": None,
+                "Total(R$)": float(v_imp),
+            }
+        )
+
+        df_planilha = pd.DataFrame(planilha_rows)
+        if not df_planilha.empty and total_cost > 0:
+            df_planilha["% do Custo"] = df_planilha["Total(R$)"].astype(float) / total_cost * 100.0
+        else:
+            df_planilha["% do Custo"] = 0.0
+
+        resumo_rows = [
+            {
+                "Categoria": "Resumo",
+                "Item": "Total Custo (sem impostos)",
+                "Qtd": None,
+                "Unit(R$)": None,
+                "Total(R$)": float(total_cost),
+                "% do Custo": 100.0,
+            },
+            {
+                "Categoria": "Resumo",
+                "Item": "Preço de Venda",
+                "Qtd": None,
+                "Unit(R$)": None,
+                "Total(R$)": float(res["preco_venda"]),
+                "% do Custo": float(res["preco_venda"]) / total_cost * 100.0 if total_cost > 0 else 0.0,
+            },
+        ]
+        df_planilha = pd.concat([df_planilha, pd.DataFrame(resumo_rows)], ignore_index=True)
+        
+        if st.button(f"💾 Salvar/Atualizar Vínculo com {c_opt}", key="btn_save_quote", type="primary"):
+            db.link_product_client(p_id, c_id, margem, float(res["preco_venda"]))
+            db.add_cost_history(
+                p_id,
+                c_id,
+                float(base["materiais"]),
+                float(base["processos"]),
+                float(base["terceiros"]),
+                float(base["administrativos"]),
+                float(res["impostos_valor"]),
+                float(res["preco_venda"]),
+                float(margem),
+            )
+            salvo(f"Orçamento salvo com sucesso! Produto vinculado a {c_opt}.")
+
+        t_plan, t1, t2 = st.tabs(["Planilha Detalhada", "Gráficos", "Histórico de Vínculos"])
+        with t1:
+            dados_pareto = pd.DataFrame({
+                "Categoria": ["Insumos", "Processos", "Impostos", "Admin/Outros"],
+                "Custo_%": [
+                    float(base["materiais"]/base["sem_impostos"]*100) if base["sem_impostos"] > 0 else 0,
+                    float(base["processos"]/base["sem_impostos"]*100) if base["sem_impostos"] > 0 else 0,
+                    float(res["impostos_valor"]/base["sem_impostos"]*100) if base["sem_impostos"] > 0 else 0,
+                    float(base["administrativos"]/base["sem_impostos"]*100) if base["sem_impostos"] > 0 else 0
+                ]
+            })
+            dados_pareto = dados_pareto.round(2)
+            fig1 = go.Figure(go.Pie(labels=dados_pareto["Categoria"], values=dados_pareto["Custo_%"]), layout_title_text="Pareto de Custos")
+            st.plotly_chart(fig1, use_container_width=True)
+        with t2:
+             try:
+                links = pd.read_sql(f"SELECT c.nome as Cliente, pc.margem as 'Margem(%)', pc.preco_final as 'Preço(R$)', pc.data_vinculo as Data FROM product_clients pc JOIN clients c ON c.id=pc.client_id WHERE pc.product_id={p_id}", conn)
+                st.dataframe(links)
+             except Exception:
+                st.write("Nenhum vínculo encontrado.")
+
+        with t_plan:
+            st.dataframe(df_planilha, column_config=FORMATO_2CASAS, use_container_width=True)
+            buf_xlsx = BytesIO()
+            df_planilha.to_excel(buf_xlsx, index=False, sheet_name="Custos")
+            buf_xlsx.seek(0)
+            st.download_button(
+                "Exportar planilha detalhada para Excel",
+                buf_xlsx,
+                file_name=f"planilha_custos_prod_{p_id}_cli_{c_id}.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            )
+
+            # Aggregated by SQLite: at most a few hundred points however long the history
+            hist = history_series(conn, p_id, c_id)
+            if not hist.empty:
+                series = {
+                    "custo_materiais": "Materiais",
+                    "custo_processos": "Processos",
+                    "custo_terceiros": "Terceiros",
+                    "custos_admin": "Admin/Outros",
+                    "impostos": "Impostos",
+                    "preco_final": "Preço de Venda",
+                }
+                traces = [go.Scatter(x=hist["ts"], y=hist[col], name=nome, mode="lines+markers") for col, nome in series.items()]
+                bucket = hist.attrs["bucket"]
+                if bucket:
+                    # Price range within each bucket, the lines are its last save
+                    traces += [
+                        go.Scatter(x=hist["ts"], y=hist["preco_max"], line_width=0, showlegend=False, hoverinfo="skip"),
+                        go.Scatter(x=hist["ts"], y=hist["preco_min"], line_width=0, fill="tonexty", name="Faixa do preço", hoverinfo="skip"),
+                    ]
+                titulo = "Evolução dos custos e preço de venda" + (f" (último salvamento por {bucket})" if bucket else "")
+                fig_hist = go.Figure(traces, layout_title_text=titulo)
+                st.plotly_chart(fig_hist, use_container_width=True)
+            else:
+                st.info("Ainda não há histórico de custos salvos para este produto e cliente.")
+
+@st.fragment
+def secao_precificacao():
+    conn = db.connection()
     if not st.session_state.get("usuario"):
         st.warning("Acesso restrito. Faça login na aba 'Acesso & Agendamentos'.")
     else:
-        clis = pd.read_sql("SELECT id, nome FROM clients", conn)
+        clis = frame("clients")
         c_opt = st.selectbox("Cliente", clis["nome"].tolist(), index=0, key="cliente_precificacao")
         c_id = int(clis[clis["nome"] == c_opt]["id"].iloc[0])
         
         # --- Área de Vínculos Existentes ---
         with st.expander(f"📦 Ver produtos já vinculados a {c_opt}", expanded=False):
-            existing_links = pd.read_sql(f"""
-                SELECT p.codigo as Código, p.nome as Produto, pc.margem as 'Margem(%)', 
-                       pc.preco_final as 'Preço Negociado(R$)', pc.data_vinculo as 'Data Vínculo'
-                FROM product_clients pc 
-                JOIN products p ON pc.product_id=p.id 
-                WHERE pc.client_id={c_id}
-            """, conn)
+            refresh_snapshot(db)
+            existing_links = frame("client_portfolio", c_id).rename(columns=PORTFOLIO_COLUNAS)
             if not existing_links.empty:
                 st.dataframe(existing_links, use_container_width=True)
             else:
                 st.info("Nenhum produto vinculado a este cliente ainda.")
         # -----------------------------------
 
-        prods_all = pd.read_sql("SELECT id, codigo, nome FROM products", conn)
         only_linked = st.checkbox("Mostrar apenas produtos vinculados ao cliente", value=False)
+        q = st.text_input("Pesquisar produto por nome/código")
         if only_linked:
-            prods_link = pd.read_sql(f"SELECT p.id, p.codigo, p.nome FROM products p JOIN product_clients pc ON pc.product_id=p.id WHERE pc.client_id={c_id}", conn)
-            df_p = prods_link
+            df_p = frame("client_products", c_id)
+            if q:
+                df_p = df_p[df_p["id"].isin(product_options(q)["id"])]
+            df_p = df_p.head(PICKER_PAGE)
         else:
-            df_p = prods_all
-        q = st.text_input("Pesquisar produto por nome/código")
-        if q:
-            mask = df_p["nome"].str.contains(q, case=False, na=False) | df_p["codigo"].astype(str).str.contains(q, case=False, na=False)
-            df_p = df_p[mask]
-        labels_p = [f"{str(r['codigo']) if r['codigo'] else ''} - {r['nome']}" for _, r in df_p.iterrows()] if len(df_p) > 0 else []
+            df_p = product_options(q)
+        labels_p = product_labels(df_p)
         p_opt = st.selectbox("Produto", labels_p, index=0 if len(labels_p) > 0 else None, key="produto_precificacao")
         p_id = int(df_p.iloc[labels_p.index(p_opt)]["id"]) if len(labels_p) > 0 else None
-        margem = st.slider("Margem desejada (%)", 10.0, 50.0, 25.0)
-        colp1, colp2, colp3 = st.columns(3)
-        with colp1:
-            admin_pct = st.number_input("Administrativos (%)", value=0.0, min_value=0.0, step=1.0)
-        with colp2:
-            frete_pct = st.number_input("Frete (%)", value=0.0, min_value=0.0, step=1.0)
-        with colp3:
-            outros_pct = st.number_input("Outros (%)", value=0.0, min_value=0.0, step=1.0)
         if p_id:
             with st.expander("Composição do produto"):
-                mat_names = pd.read_sql("SELECT id, nome FROM vertical_materials", conn)
-                proc_names = pd.read_sql("SELECT id, nome FROM vertical_processes", conn)
-                th_names = pd.read_sql("SELECT id, nome FROM third_party_items", conn)
                 
                 # Load data
-                df_mat = pd.read_sql(f"SELECT vm.nome, mu.quantidade FROM materials_usage mu JOIN vertical_materials vm ON mu.material_id=vm.id WHERE mu.product_id={p_id}", conn)
-                df_proc = pd.read_sql(f"SELECT vp.nome, pu.horas FROM processes_usage pu JOIN vertical_processes vp ON pu.process_id=vp.id WHERE pu.product_id={p_id}", conn)
-                df_th = pd.read_sql(f"SELECT tp.nome, tu.quantidade FROM third_usage tu JOIN third_party_items tp ON tu.third_id=tp.id WHERE tu.product_id={p_id}", conn)
+                df_mat = frame("product_materials", p_id)
+                df_proc = frame("product_processes", p_id)
+                df_th = frame("product_thirds", p_id)
                 
-                # Components (Sub-products)
-                comp_prods = pd.read_sql(f"SELECT id, codigo, nome FROM products WHERE id != {p_id}", conn)
-                df_comp = pd.read_sql(f"SELECT p.codigo || ' - ' || p.nome as nome, pc.quantidade FROM product_components pc JOIN products p ON pc.component_product_id=p.id WHERE pc.parent_product_id={p_id}", conn)
+                # Components (Sub-products): current ones plus a page of search hits
+                df_comp = frame("product_components", p_id)
                 
                 c1, c2 = st.columns(2)
                 with c1:
@@ -410,393 +689,125 @@ with tab3:
                         key="edit_proc_precif"
                     )
                     st.caption("Sub-produtos (Conjuntos)")
-                    comp_opts = [f"{r['codigo']} - {r['nome']}" for _, r in comp_prods.iterrows()]
+                    comp_hits = product_options(st.text_input("Buscar componente por nome/código", key="busca_comp_precif"))
+                    comp_hits = comp_hits[comp_hits["id"] != p_id]
+                    prod_map = dict(zip(df_comp["nome"], df_comp["component_id"].astype(int)))
+                    prod_map.update(zip(product_labels(comp_hits), comp_hits["id"].astype(int)))
                     df_comp_edit = st.data_editor(
                         df_comp, num_rows="dynamic",
                         column_config={
-                            "nome": st.column_config.SelectboxColumn("Componente", options=comp_opts, required=True),
-                            "quantidade": st.column_config.NumberColumn("Qtd", min_value=0.0, format="%.2f")
+                            "nome": st.column_config.SelectboxColumn("Componente", options=list(prod_map), required=True),
+                            "quantidade": st.column_config.NumberColumn("Qtd", min_value=0.0, format="%.2f"),
+                            "component_id": None,
                         },
                         key="edit_comp_precif"
                     )
 
                 if st.button("Salvar composição completa", key="save_comp_precif"):
-                    db.clear_composition(p_id)
-                    # Save Materials
-                    for _, r in df_mat_edit.fillna({"quantidade": 0}).iterrows():
-                        nome = str(r.get("nome") or "").strip()
-                        if not nome: continue
-                        qty = float(r.get("quantidade") or 0)
-                        if nome in mat_names["nome"].tolist():
-                            mid = int(mat_names[mat_names["nome"] == nome]["id"].iloc[0])
-                        else:
-                            cur = conn.cursor()
-                            cur.execute("INSERT INTO vertical_materials (grupo, subgrupo, nome, ncm, unidade, preco_unitario, fornecedor, data_atualizacao) VALUES (?,?,?,?,?,?,?,?)", ("", "", nome, "", "un", 0.0, "", pd.Timestamp.now().strftime("%Y-%m-%d")))
-                            conn.commit()
-                            mid = int(cur.lastrowid)
-                            mat_names = pd.read_sql("SELECT id, nome FROM vertical_materials", conn)
-                        db.add_material_usage(p_id, mid, round(qty, 2))
-                    # Save Processes
-                    for _, r in df_proc_edit.fillna({"horas": 0}).iterrows():
-                        nome = str(r.get("nome") or "").strip()
-                        if not nome: continue
-                        hrs = float(r.get("horas") or 0)
-                        if nome in proc_names["nome"].tolist():
-                            pidp = int(proc_names[proc_names["nome"] == nome]["id"].iloc[0])
-                        else:
-                            cur = conn.cursor()
-                            cur.execute("INSERT INTO vertical_processes (grupo, subgrupo, nome, preco_unitario_hora, unidade, origem) VALUES (?,?,?,?,?,?)", ("", "", nome, 0.0, "hora", "Manual"))
-                            conn.commit()
-                            pidp = int(cur.lastrowid)
-                            proc_names = pd.read_sql("SELECT id, nome FROM vertical_processes", conn)
-                        db.add_process_usage(p_id, pidp, round(hrs, 2))
-                    # Save Third Party
-                    for _, r in df_th_edit.fillna({"quantidade": 0}).iterrows():
-                        nome = str(r.get("nome") or "").strip()
-                        if not nome: continue
-                        qty = float(r.get("quantidade") or 0)
-                        if nome in th_names["nome"].tolist():
-                            tid = int(th_names[th_names["nome"] == nome]["id"].iloc[0])
-                        else:
-                            cur = conn.cursor()
-                            cur.execute("INSERT INTO third_party_items (nome, preco_unitario, quantidade_padrao, fornecedor, unidade) VALUES (?,?,?,?,?)", (nome, 0.0, 1.0, "", "serviço"))
-                            conn.commit()
-                            tid = int(cur.lastrowid)
-                            th_names = pd.read_sql("SELECT id, nome FROM third_party_items", conn)
-                        db.add_third_usage(p_id, tid, round(qty, 2))
-                    # Save Components
-                    prod_map = {f"{r['codigo']} - {r['nome']}": r['id'] for _, r in comp_prods.iterrows()}
-                    for _, r in df_comp_edit.fillna({"quantidade": 0}).iterrows():
-                        nome_full = str(r.get("nome") or "")
-                        cid = prod_map.get(nome_full)
-                        if cid:
-                            db.add_component_usage(p_id, cid, float(r.get("quantidade") or 0))
-                    st.success("Composição salva com sucesso!")
-
-        if "calc_res" not in st.session_state:
-            st.session_state.calc_res = None
-
-        if p_id and st.button("Calcular preço e margens"):
-            res = suggest_sale_price(conn, p_id, c_id, margem, admin_pct, frete_pct, outros_pct)
-            st.session_state.calc_res = res
-        
-        if st.session_state.calc_res:
-            res = st.session_state.calc_res
-            base = res["base"]
-            
-            st.divider()
-            col_m1, col_m2 = st.columns(2)
-            with col_m1:
-                st.metric("Preço de Venda Sugerido", f"R$ {float(res['preco_venda']):.2f}")
-            with col_m2:
-                st.metric("Margem Real", f"{float(res['margem_real_percent']):.2f}%")
-            
-            # Detailed Breakdown with percentages
-            total_cost = float(base["sem_impostos"])
-            def fmt_pct(val):
-                return f"({(val/total_cost*100) if total_cost > 0 else 0:.1f}%)"
-
-            st.subheader("Detalhamento de Custos")
-            
-            total_mat_recursive = float(base["materiais"])
-            df_mat_det = pd.read_sql(
-                f"SELECT vm.nome as Item, mu.quantidade as Qtd, vm.preco_unitario as 'Unit(R$)', "
-                f"(mu.quantidade * vm.preco_unitario) as 'Total(R$)' "
-                f"FROM materials_usage mu JOIN vertical_materials vm ON mu.material_id=vm.id "
-                f"WHERE mu.product_id={p_id}",
-                conn,
-            )
-            total_mat_direct = df_mat_det["Total(R$)"].sum() if not df_mat_det.empty else 0.0
-            total_mat_indirect = total_mat_recursive - total_mat_direct
-
-            with st.expander(f"Materiais: R$ {total_mat_recursive:.2f} {fmt_pct(total_mat_recursive)}", expanded=False):
-                if not df_mat_det.empty:
-                    st.dataframe(
-                        df_mat_det.style.format(
-                            {"Qtd": "{:.2f}", "Unit(R$)": "{:.2f}", "Total(R$)": "{:.2f}"}
-                        ),
-                        use_container_width=True,
-                    )
-                if total_mat_indirect > 0.01:
-                    st.info(f"Materiais de Sub-componentes: R$ {total_mat_indirect:.2f}")
-
-            total_proc_recursive = float(base["processos"])
-            df_proc_det = pd.read_sql(
-                f"SELECT vp.nome as Item, pu.horas as Qtd, vp.preco_unitario_hora as 'Unit(R$)', "
-                f"(pu.horas * vp.preco_unitario_hora) as 'Total(R$)' "
-                f"FROM processes_usage pu JOIN vertical_processes vp ON pu.process_id=vp.id "
-                f"WHERE pu.product_id={p_id}",
-                conn,
-            )
-            total_proc_direct = df_proc_det["Total(R$)"].sum() if not df_proc_det.empty else 0.0
-            total_proc_indirect = total_proc_recursive - total_proc_direct
-
-            with st.expander(f"Processos: R$ {total_proc_recursive:.2f} {fmt_pct(total_proc_recursive)}", expanded=False):
-                if not df_proc_det.empty:
-                    st.dataframe(
-                        df_proc_det.style.format(
-                            {"Qtd": "{:.2f}", "Unit(R$)": "{:.2f}", "Total(R$)": "{:.2f}"}
-                        ),
-                        use_container_width=True,
-                    )
-                if total_proc_indirect > 0.01:
-                    st.info(f"Processos de Sub-componentes: R$ {total_proc_indirect:.2f}")
-
-            total_third_recursive = float(base["terceiros"])
-            df_third_det = pd.read_sql(
-                f"SELECT tp.nome as Item, tu.quantidade as Qtd, tp.preco_unitario as 'Unit(R$)', "
-                f"(tu.quantidade * tp.preco_unitario) as 'Total(R$)' "
-                f"FROM third_usage tu JOIN third_party_items tp ON tu.third_id=tp.id "
-                f"WHERE tu.product_id={p_id}",
-                conn,
-            )
-            total_third_direct = df_third_det["Total(R$)"].sum() if not df_third_det.empty else 0.0
-            total_third_indirect = total_third_recursive - total_third_direct
-
-            with st.expander(f"Terceiros: R$ {total_third_recursive:.2f} {fmt_pct(total_third_recursive)}", expanded=False):
-                if not df_third_det.empty:
-                    st.dataframe(
-                        df_third_det.style.format(
-                            {"Qtd": "{:.2f}", "Unit(R$)": "{:.2f}", "Total(R$)": "{:.2f}"}
-                        ),
-                        use_container_width=True,
-                    )
-                if total_third_indirect > 0.01:
-                    st.info(f"Terceiros de Sub-componentes: R$ {total_third_indirect:.2f}")
+                    mats = df_mat_edit.fillna({"quantidade": 0})
+                    procs = df_proc_edit.fillna({"horas": 0})
+                    ths = df_th_edit.fillna({"quantidade": 0})
+                    comps = df_comp_edit.fillna({"quantidade": 0})
+                    try:
+                        db.replace_composition(
+                            p_id,
+                            materials=[(n, round(float(q or 0), 2)) for n, q in zip(mats["nome"].fillna(""), mats["quantidade"])],
+                            processes=[(n, round(float(h or 0), 2)) for n, h in zip(procs["nome"].fillna(""), procs["horas"])],
+                            thirds=[(n, round(float(q or 0), 2)) for n, q in zip(ths["nome"].fillna(""), ths["quantidade"])],
+                            components=[(int(prod_map[n]), float(q or 0)) for n, q in zip(comps["nome"].fillna("").astype(str), comps["quantidade"]) if prod_map.get(n)],
+                        )
+                        st.success("Composição salva com sucesso!")
+                    except ValueError as e:
+                        st.error(str(e))
+
+            with st.expander("Estrutura completa e onde é usado"):
+                c1, c2 = st.columns(2)
+                with c1:
+                    st.caption("Todos os componentes (quantidade acumulada por unidade)")
+                    st.dataframe(pd.DataFrame([dict(r) for r in db.explode(p_id)], columns=["product_id", "codigo", "nome", "depth", "quantidade"]), hide_index=True)
+                with c2:
+                    st.caption("Produtos que contêm este produto")
+                    st.dataframe(pd.DataFrame([dict(r) for r in db.where_used(p_id)], columns=["product_id", "codigo", "nome", "depth", "quantidade"]), hide_index=True)
 
-            v_adm = float(base["administrativos"])
-            v_imp = float(res["impostos_valor"])
-            with st.expander(f"Outros Custos & Impostos: R$ {v_adm+v_imp:.2f}", expanded=False):
-                st.markdown(f"**Admin/Frete/Outros**: R$ {v_adm:.2f} {fmt_pct(v_adm)}")
-                st.markdown(f"**Impostos**: R$ {v_imp:.2f} ({float(res['taxas']['total'])*100:.1f}%)")
+        calculo_preco(p_id, c_id, c_opt)
 
-            planilha_rows = []
-            if not df_mat_det.empty:
-                for _, r in df_mat_det.iterrows():
-                    planilha_rows.append(
-                        {
-                            "Categoria": "Materiais",
-                            "Item": r["Item"],
-                            "Qtd": float(r["Qtd"]),
-                            "Unit(R$)": float(r["Unit(R$)"]),
-                            "Total(R$)": float(r["Total(R$)"]),
-                        }
-                    )
-            if total_mat_indirect > 0.01:
-                planilha_rows.append(
-                    {
-                        "Categoria": "Materiais",
-                        "Item": "Materiais de Sub-componentes",
-                        "Qtd": None,
-                        "Unit(R$)": None,
-                        "Total(R$)": float(total_mat_indirect),
-                    }
-                )
-
-            if not df_proc_det.empty:
-                for _, r in df_proc_det.iterrows():
-                    planilha_rows.append(
-                        {
-                            "Categoria": "Processos",
-                            "Item": r["Item"],
-                            "Qtd": float(r["Qtd"]),
-                            "Unit(R$)": float(r["Unit(R$)"]),
-                            "Total(R$)": float(r["Total(R$)"]),
-                        }
-                    )
-            if total_proc_indirect > 0.01:
-                planilha_rows.append(
-                    {
-                        "Categoria": "Processos",
-                        "Item": "Processos de Sub-componentes",
-                        "Qtd": None,
-                        "Unit(R$)": None,
-                        "Total(R$)": float(total_proc_indirect),
-                    }
-                )
-
-            if not df_third_det.empty:
-                for _, r in df_third_det.iterrows():
-                    planilha_rows.append(
-                        {
-                            "Categoria": "Terceiros",
-                            "Item": r["Item"],
-                            "Qtd": float(r["Qtd"]),
-                            "Unit(R$)": float(r["Unit(R$)"]),
-                            "Total(R$)": float(r["Total(R$)"]),
-                        }
-                    )
-            if total_third_indirect > 0.01:
-                planilha_rows.append(
-                    {
-                        "Categoria": "Terceiros",
-                        "Item": "Terceiros de Sub-componentes",
-                        "Qtd": None,
-                        "Unit(R$)": None,
-                        "Total(R$)": float(total_third_indirect),
-                    }
-                )
-
-            planilha_rows.append(
-                {
-                    "Categoria": "Admin/Outros",
-                    "Item": "Admin/Frete/Outros",
-                    "Qtd": None,
-                    "Unit(R$)": None,
-                    "Total(R$)": float(v_adm),
-                }
-            )
-            planilha_rows.append(
-                {
-                    "Categoria": "Impostos",
-                    "Item": "Impostos",
-                    "Qtd": None,
-                    "Unit(R$)": None,
-                    "Total(R$)": float(v_imp),
-                }
-            )
+with tab3:
+    secao_precificacao()
 
-            df_planilha = pd.DataFrame(planilha_rows)
-            if not df_planilha.empty and total_cost > 0:
-                df_planilha["% do Custo"] = df_planilha["Total(R$)"].astype(float) / total_cost * 100.0
+@st.fragment
+def secao_cenarios():
+    conn = db.connection()
+    if not st.session_state.get("usuario"):
+        st.warning("Acesso restrito. Faça login na aba 'Acesso & Agendamentos'.")
+    else:
+        st.subheader("Cenários de preço")
+        st.caption("Ajustes percentuais (pct) ou em R$ por unidade/hora (abs) sobre materiais, processos e terceiros, por id, grupo ou fornecedor. Avaliados em memória: as tabelas de preço não são alteradas.")
+        cens = frame("scenarios")
+        with st.expander("Criar ou editar cenário", expanded=cens.empty):
+            base_opts = ["(novo)"] + cens["nome"].tolist()
+            editar = st.selectbox("Cenário", base_opts, key="cen_editar")
+            atual = cens[cens["nome"] == editar]
+            if atual.empty:
+                ajustes_df = pd.DataFrame({"categoria": pd.Series(dtype=str), "alvo": pd.Series(dtype=str), "valor": pd.Series(dtype=str), "tipo": pd.Series(dtype=str), "ajuste": pd.Series(dtype=float)})
             else:
-                df_planilha["% do Custo"] = 0.0
-
-            resumo_rows = [
-                {
-                    "Categoria": "Resumo",
-                    "Item": "Total Custo (sem impostos)",
-                    "Qtd": None,
-                    "Unit(R$)": None,
-                    "Total(R$)": float(total_cost),
-                    "% do Custo": 100.0,
+                ajustes_df = frame("scenario_adjustments", int(atual["id"].iloc[0]))
+            nome = st.text_input("Nome", value="" if atual.empty else editar, key=f"cen_nome_{editar}")
+            descricao = st.text_input("Descrição", value="" if atual.empty else (atual["descricao"].iloc[0] or ""), key=f"cen_desc_{editar}")
+            ajustes = st.data_editor(
+                ajustes_df, num_rows="dynamic", hide_index=True, use_container_width=True, key=f"cen_ajustes_{editar}",
+                column_config={
+                    "categoria": st.column_config.SelectboxColumn("categoria", options=list(SCENARIO_TARGETS), required=True),
+                    "alvo": st.column_config.SelectboxColumn("alvo", options=["id", "grupo", "fornecedor"], required=True, help="processos: id ou grupo; terceiros: id ou fornecedor"),
+                    "valor": st.column_config.TextColumn("valor", required=True, help="id do item, nome do grupo ou do fornecedor"),
+                    "tipo": st.column_config.SelectboxColumn("tipo", options=list(SCENARIO_TYPES), required=True),
+                    "ajuste": st.column_config.NumberColumn("ajuste", required=True, help="% (pct) ou R$ por unidade/hora (abs)"),
                 },
-                {
-                    "Categoria": "Resumo",
-                    "Item": "Preço de Venda",
-                    "Qtd": None,
-                    "Unit(R$)": None,
-                    "Total(R$)": float(res["preco_venda"]),
-                    "% do Custo": float(res["preco_venda"]) / total_cost * 100.0 if total_cost > 0 else 0.0,
-                },
-            ]
-            df_planilha = pd.concat([df_planilha, pd.DataFrame(resumo_rows)], ignore_index=True)
-            
-            if st.button(f"💾 Salvar/Atualizar Vínculo com {c_opt}", key="btn_save_quote", type="primary"):
-                db.link_product_client(p_id, c_id, margem, float(res["preco_venda"]))
-                db.add_cost_history(
-                    p_id,
-                    c_id,
-                    float(base["materiais"]),
-                    float(base["processos"]),
-                    float(base["terceiros"]),
-                    float(base["administrativos"]),
-                    float(res["impostos_valor"]),
-                    float(res["preco_venda"]),
-                    float(margem),
-                )
-                st.success(f"Orçamento salvo com sucesso! Produto vinculado a {c_opt}.")
-                st.rerun()
-
-            t_plan, t1, t2 = st.tabs(["Planilha Detalhada", "Gráficos", "Histórico de Vínculos"])
-            with t1:
-                dados_pareto = pd.DataFrame({
-                    "Categoria": ["Insumos", "Processos", "Impostos", "Admin/Outros"],
-                    "Custo_%": [
-                        float(base["materiais"]/base["sem_impostos"]*100) if base["sem_impostos"] > 0 else 0,
-                        float(base["processos"]/base["sem_impostos"]*100) if base["sem_impostos"] > 0 else 0,
-                        float(res["impostos_valor"]/base["sem_impostos"]*100) if base["sem_impostos"] > 0 else 0,
-                        float(base["administrativos"]/base["sem_impostos"]*100) if base["sem_impostos"] > 0 else 0
-                    ]
-                })
-                fig1 = px.pie(pd.DataFrame(dados_pareto).round(2), values="Custo_%", names="Categoria", title="Pareto de Custos")
-                st.plotly_chart(fig1, use_container_width=True)
-            with t2:
-                 try:
-                    links = pd.read_sql(f"SELECT c.nome as Cliente, pc.margem as 'Margem(%)', pc.preco_final as 'Preço(R$)', pc.data_vinculo as Data FROM product_clients pc JOIN clients c ON c.id=pc.client_id WHERE pc.product_id={p_id}", conn)
-                    st.dataframe(links)
-                 except Exception:
-                    st.write("Nenhum vínculo encontrado.")
-
-            with t_plan:
-                st.dataframe(
-                    df_planilha.style.format(
-                        {
-                            "Qtd": "{:.2f}",
-                            "Unit(R$)": "{:.2f}",
-                            "Total(R$)": "{:.2f}",
-                            "% do Custo": "{:.2f}",
-                        }
-                    ),
-                    use_container_width=True,
-                )
-                buf_xlsx = BytesIO()
-                df_planilha.to_excel(buf_xlsx, index=False, sheet_name="Custos")
-                buf_xlsx.seek(0)
-                st.download_button(
-                    "Exportar planilha detalhada para Excel",
-                    buf_xlsx,
-                    file_name=f"planilha_custos_prod_{p_id}_cli_{c_id}.xlsx",
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-                )
-
-                hist = pd.read_sql(
-                    """
-                    SELECT data_vinculo,
-                           custo_materiais,
-                           custo_processos,
-                           custo_terceiros,
-                           custos_admin,
-                           impostos,
-                           custo_total_sem_impostos,
-                           preco_final,
-                           margem
-                    FROM product_cost_history
-                    WHERE product_id = ? AND client_id = ?
-                    ORDER BY data_vinculo
-                    """,
-                    conn,
-                    params=(p_id, c_id),
-                )
-                if not hist.empty:
-                    df_long = hist.melt(
-                        id_vars="data_vinculo",
-                        value_vars=[
-                            "custo_materiais",
-                            "custo_processos",
-                            "custo_terceiros",
-                            "custos_admin",
-                            "impostos",
-                            "preco_final",
-                        ],
-                        var_name="Tipo",
-                        value_name="Valor",
-                    )
-                    df_long["Tipo"] = df_long["Tipo"].map(
-                        {
-                            "custo_materiais": "Materiais",
-                            "custo_processos": "Processos",
-                            "custo_terceiros": "Terceiros",
-                            "custos_admin": "Admin/Outros",
-                            "impostos": "Impostos",
-                            "preco_final": "Preço de Venda",
-                        }
-                    )
-                    fig_hist = px.line(
-                        df_long,
-                        x="data_vinculo",
-                        y="Valor",
-                        color="Tipo",
-                        markers=True,
-                        title="Evolução dos custos e preço de venda",
-                    )
-                    st.plotly_chart(fig_hist, use_container_width=True)
+            )
+            b1, b2 = st.columns(2)
+            if b1.button("Salvar cenário", key="btn_cen_salvar"):
+                if not nome.strip():
+                    st.warning("Informe o nome do cenário")
                 else:
-                    st.info("Ainda não há histórico de custos salvos para este produto e cliente.")
-
+                    try:
+                        db.save_scenario(nome.strip(), ajustes.dropna().to_dict("records"), descricao)
+                    except ValueError as e:
+                        st.error(str(e))
+                    else:
+                        salvo(f"Cenário '{nome.strip()}' salvo")
+            if not atual.empty and b2.button("Excluir cenário", key="btn_cen_excluir"):
+                db.delete_scenario(int(atual["id"].iloc[0]))
+                salvo(f"Cenário '{editar}' excluído")
+
+        sel = st.multiselect("Comparar cenários", cens["nome"].tolist(), key="cen_comparar")
+        if sel:
+            ids = tuple(int(cens.loc[cens["nome"] == n, "id"].iloc[0]) for n in sel)
+            por_produto, resumo = cached_scenarios(ids, version_stamp(conn).of(SCENARIO_STAMP_TABLES))
+            st.dataframe(
+                resumo.rename(columns={"cenario": "Cenário", "produtos_afetados": "Produtos afetados", "custo_total": "Custo total (R$)", "delta_total": "Δ total (R$)", "maior_delta": "Maior Δ (R$)", "delta_pct": "Δ %"}),
+                hide_index=True, use_container_width=True,
+                column_config={c: st.column_config.NumberColumn(c, format="%.2f") for c in ("Custo total (R$)", "Δ total (R$)", "Maior Δ (R$)", "Δ %")},
+            )
+            # Side by side: cost per scenario for the products that move the most
+            lado = por_produto.pivot(index="product_id", columns="cenario", values="custo")
+            delta = por_produto.pivot(index="product_id", columns="cenario", values="delta").drop(columns="Base")
+            top = delta.abs().max(axis=1).nlargest(50)
+            top = top[top > 0].index
+            if len(top):
+                prods = frame("products").set_index("id")
+                tabela = lado.loc[top]
+                tabela.columns = [f"{c} (R$)" for c in tabela.columns]
+                tabela.insert(0, "Produto", prods["codigo"].astype(str).reindex(top) + " - " + prods["nome"].reindex(top))
+                st.caption(f"{len(top)} produtos com maior variação de custo (sem impostos)")
+                st.dataframe(tabela.reset_index(drop=True), hide_index=True, use_container_width=True,
+                             column_config={c: st.column_config.NumberColumn(c, format="%.2f") for c in tabela.columns[1:]})
+            else:
+                st.info("Nenhum produto muda de custo nos cenários selecionados")
 
+with tab_cen:
+    secao_cenarios()
 
-with tab_access:
+@st.fragment
+def secao_acesso():
     if "usuario" not in st.session_state:
         st.session_state.usuario = None
 
@@ -808,7 +819,8 @@ with tab_access:
             senha = st.text_input("Senha", type="password", key="login_senha")
             if st.button("Login"):
                 row = db.get_user_by_email(email)
-                if row and verify_password(senha, row["senha_hash"]):
+                # Hashes made with older parameters are replaced on a successful login
+                if row and verify_password(senha, row["senha_hash"], on_rehash=lambda h: db.set_password_hash(row["id"], h)):
                     st.session_state.usuario = {"id": row["id"], "nome": row["nome"], "email": row["email"], "role": row["role"]}
                     st.success("Login realizado")
                     st.rerun()
@@ -858,3 +870,29 @@ with tab_access:
         ap = db.list_appointments(user_id=st.session_state.usuario["id"] if st.session_state.usuario["id"] != 0 else None)
         ap_df = pd.DataFrame([{"id": r[0], "user_id": r[1], "data_hora": r[2], "observacao": r[3], "status": r[4]} for r in ap])
         st.dataframe(ap_df)
+
+with tab_access:
+    secao_acesso()
+
+usuario = st.session_state.get("usuario")
+if usuario and usuario.get("role") == "admin":
+    with st.sidebar.expander("Diagnóstico de desempenho"):
+        st.caption("Mede todas as sessões deste servidor enquanto ativa")
+        ativo = st.toggle("Instrumentação ativa", value=instrument.recorder.enabled, key="diag_ativo")
+        if ativo != instrument.recorder.enabled:
+            instrument.enable() if ativo else instrument.disable()
+        diag_n = int(st.number_input("Mostrar últimas", min_value=5, max_value=200, value=20, key="diag_n"))
+        ops = instrument.recorder.last_operations(diag_n)
+        st.caption("Operações (segundos; etapas rollup / impostos / preco)")
+        if ops:
+            st.dataframe(pd.DataFrame([
+                dict({k: op[k] for k in ("inicio", "nome", "detalhe", "segundos", "sql", "sql_segundos", "linhas")}, **{f"etapa_{k}": v for k, v in op["etapas"].items()})
+                for op in ops
+            ]), hide_index=True)
+        st.caption("Consultas mais lentas (tempo total)")
+        consultas = instrument.recorder.slowest_queries(diag_n)
+        if consultas:
+            st.dataframe(pd.DataFrame(consultas), hide_index=True)
+        if st.button("Limpar medições", key="diag_reset"):
+            instrument.recorder.reset()
+            st.rerun()
@@ -0,0 +1,95 @@
+import random
+from datetime import datetime
+from pricing.db import Database, COST_TABLES, bump_versions, refresh_closure
+
+# Synthetic catalogs for the benchmarks. Products are split into depth + 1
+# levels; level 0 are parts (materials, processes, third-party services) and
+# every product above takes `fanout` components from the level below. With
+# probability `sharing` a component slot reuses a sub-assembly some other
+# parent already uses, otherwise it prefers one nobody uses yet.
+
+DEFAULTS = {
+    "n_products": 1000,
+    "n_materials": 2000,
+    "n_processes": 100,
+    "n_thirds": 50,
+    "n_clients": 20,
+    "depth": 3,
+    "fanout": 3,
+    "sharing": 0.3,
+    "seed": 7,
+}
+
+def level_sizes(n_products, depth):
+    # Half the catalog are parts, each level above half the size of the one below
+    weights = [2 ** (depth - lv) for lv in range(depth + 1)]
+    total = sum(weights)
+    sizes = [max(1, n_products * w // total) for w in weights]
+    sizes[0] += n_products - sum(sizes)
+    return sizes
+
+def build_catalog(path, **params):
+    # Returns (Database, info) with info["levels"] = product ids per level
+    p = dict(DEFAULTS, **params)
+    rnd = random.Random(p["seed"])
+    db = Database(path)
+    db.seed_demo()
+    hoje = datetime.now().strftime("%Y-%m-%d")
+    with db.transaction() as conn:
+        conn.executemany(
+            "INSERT INTO vertical_materials (codigo, grupo, subgrupo, nome, ncm, unidade, preco_unitario, fornecedor, data_atualizacao) VALUES (?,?,?,?,?,?,?,?,?)",
+            [(f"MAT{i:06d}", f"G{i % 12}", f"S{i % 40}", f"Material {i}", "7208.38.90", rnd.choice(["kg", "m", "un"]), rnd.randint(10, 90000) / 100, f"Fornecedor {i % 30}", hoje) for i in range(p["n_materials"])],
+        )
+        conn.executemany(
+            "INSERT INTO vertical_processes (grupo, subgrupo, nome, preco_unitario_hora, unidade, origem) VALUES (?,?,?,?,?,?)",
+            [(f"G{i % 5}", "", f"Processo {i}", rnd.randint(5000, 40000) / 100, "hora", "Benchmark") for i in range(p["n_processes"])],
+        )
+        conn.executemany(
+            "INSERT INTO third_party_items (nome, preco_unitario, quantidade_padrao, fornecedor, unidade) VALUES (?,?,?,?,?)",
+            [(f"Terceiro {i}", rnd.randint(500, 90000) / 100, 1, f"Terceiro {i % 10}", "serviço") for i in range(p["n_thirds"])],
+        )
+        conn.executemany(
+            "INSERT INTO clients (codigo, nome, planta, uf, cidade, regime, pis, cofins, icms, fator) VALUES (?,?,?,?,?,?,?,?,?,?)",
+            [(f"{i:014d}", f"Cliente {i}", "Planta 1", rnd.choice(["SP", "RS", "MG"]), "", "real", 0.0165, 0.076, rnd.choice([0.07, 0.12, 0.18]), 1.0) for i in range(p["n_clients"])],
+        )
+        mat_ids = [r[0] for r in conn.execute("SELECT id FROM vertical_materials").fetchall()]
+        proc_ids = [r[0] for r in conn.execute("SELECT id FROM vertical_processes").fetchall()]
+        third_ids = [r[0] for r in conn.execute("SELECT id FROM third_party_items").fetchall()]
+        first = conn.execute("SELECT COALESCE(MAX(id), 0) FROM products").fetchone()[0] + 1
+        conn.executemany(
+            "INSERT INTO products (codigo, nome, quantidade, destino_uf, ncm, local_fabricacao_uf, grupo, subgrupo) VALUES (?,?,?,?,?,?,?,?)",
+            [(f"BEN{i:07d}", f"Produto {i}", 1, rnd.choice(["SP", "RJ"]), "7208.38.90", "SP", "BENCH", "") for i in range(p["n_products"])],
+        )
+        levels = []
+        start = first
+        for size in level_sizes(p["n_products"], p["depth"]):
+            levels.append(list(range(start, start + size)))
+            start += size
+        materials, processes, thirds, components = [], [], [], []
+        for lv, ids in enumerate(levels):
+            for pid in ids:
+                for _ in range(rnd.randint(1, 4) if lv == 0 else rnd.randint(0, 1)):
+                    materials.append((pid, rnd.choice(mat_ids), rnd.choice([0.5, 1, 2, 3.25, rnd.randint(1, 500) / 10])))
+                processes.append((pid, rnd.choice(proc_ids), rnd.choice([0.25, 0.5, 1, 2])))
+                if rnd.random() < 0.2:
+                    thirds.append((pid, rnd.choice(third_ids), 1))
+            if lv == 0:
+                continue
+            below = levels[lv - 1]
+            unused = below[:]
+            rnd.shuffle(unused)
+            used = []
+            for pid in ids:
+                for component_id in set(
+                    rnd.choice(used) if used and (rnd.random() < p["sharing"] or not unused) else (unused.pop() if unused else rnd.choice(below))
+                    for _ in range(p["fanout"])
+                ):
+                    components.append((pid, component_id, rnd.choice([1, 2, 4])))
+                    used.append(component_id)
+        conn.executemany("INSERT INTO materials_usage (product_id, material_id, quantidade) VALUES (?,?,?)", materials)
+        conn.executemany("INSERT INTO processes_usage (product_id, process_id, horas) VALUES (?,?,?)", processes)
+        conn.executemany("INSERT INTO third_usage (product_id, third_id, quantidade) VALUES (?,?,?)", thirds)
+        conn.executemany("INSERT INTO product_components (parent_product_id, component_product_id, quantidade) VALUES (?,?,?)", components)
+        refresh_closure(conn, [pid for ids in levels for pid in ids])
+        bump_versions(conn, "products", "clients", *COST_TABLES)
+    return db, {"params": p, "levels": levels, "components": len(components)}
@@ -0,0 +1,166 @@
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from multiprocessing import get_context
+import numpy as np
+import pandas as pd
+from benchmarks.catalog import DEFAULTS, build_catalog
+from pricing.engine import get_base_cost, suggest_sale_price, price_grid, TaxResolver
+from pricing.erp_import import import_erp_file
+from pricing.fixedpoint import price_grid_fixed
+from pricing.rollup import CostRollup
+
+# python -m benchmarks.run --scales 1000,10000 --out bench.json
+# Each scale runs in a fresh process, so peak RSS is per scale (the high-water
+# mark after each case, in the order below).
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+@contextmanager
+def count_statements(conn):
+    counter = [0]
+    def trace(_sql):
+        counter[0] += 1
+    conn.set_trace_callback(trace)
+    try:
+        yield counter
+    finally:
+        conn.set_trace_callback(None)
+
+def measure(conn, ops, **extra):
+    # ops: callables timed one by one
+    latencies = []
+    with count_statements(conn) as statements:
+        for op in ops:
+            start = time.perf_counter()
+            op()
+            latencies.append(time.perf_counter() - start)
+    lat = np.array(latencies)
+    total = float(lat.sum())
+    return dict({
+        "ops": len(lat),
+        "ops_s": len(lat) / total if total else None,
+        "p50_ms": float(np.percentile(lat, 50) * 1000),
+        "p95_ms": float(np.percentile(lat, 95) * 1000),
+        "total_s": total,
+        "sql_statements": statements[0],
+        "sql_per_op": statements[0] / len(lat),
+        "peak_rss_mb": peak_rss_mb(),
+    }, **extra)
+
+def erp_csv(rows, seed):
+    rnd = random.Random(seed)
+    frame = pd.DataFrame({
+        "grupo": [f"G{i % 12}" for i in range(rows)],
+        "subgrupo": [f"S{i % 40}" for i in range(rows)],
+        "nome_insumo": [f"Insumo ERP {i}" for i in range(rows)],
+        "ncm": "7208.38.90",
+        "unidade": "kg",
+        "custo_unitario": [rnd.randint(10, 90000) / 100 for _ in range(rows)],
+        "fornecedor": "ERP",
+    })
+    data = frame.to_csv(index=False).encode()
+    f = io.BytesIO(data)
+    f.size = len(data)
+    return f
+
+def run_scale(params, sample, erp_rows, workdir):
+    path = os.path.join(workdir, f"bench_{params['n_products']}.db")
+    start = time.perf_counter()
+    db, info = build_catalog(path, **params)
+    results = {"build_s": time.perf_counter() - start, "components": info["components"], "cases": {}}
+    cases = results["cases"]
+    conn = db.connection()
+    rnd = random.Random(params.get("seed", DEFAULTS["seed"]))
+    tops = info["levels"][-1]
+    picks = rnd.sample(tops, min(sample, len(tops)))
+    client_id = conn.execute("SELECT MIN(id) FROM clients").fetchone()[0]
+    client_ids = [r[0] for r in conn.execute("SELECT id FROM clients ORDER BY id LIMIT 5").fetchall()]
+
+    cases["get_base_cost"] = measure(conn, [lambda pid=pid: get_base_cost(conn, pid) for pid in picks])
+    cases["suggest_sale_price"] = measure(conn, [lambda pid=pid: suggest_sale_price(conn, pid, client_id, 25) for pid in picks])
+    holder = {}
+    cases["rollup_load"] = measure(conn, [lambda: holder.update(rollup=CostRollup.load(conn), taxes=TaxResolver.load(conn))])
+    rollup, taxes = holder["rollup"], holder["taxes"]
+    cases["suggest_sale_price_rollup"] = measure(conn, [lambda pid=pid: suggest_sale_price(conn, pid, client_id, 25, rollup=rollup, taxes=taxes) for pid in picks])
+    grid_ids = rnd.sample(sum(info["levels"], []), min(sample * 20, params["n_products"]))
+    margens = [10, 25, 40]
+    cases["price_grid"] = measure(conn, [lambda: price_grid(conn, grid_ids, client_ids, margens, rollup=rollup, taxes=taxes)], rows=len(grid_ids) * len(client_ids) * len(margens))
+    cases["price_grid_fixed"] = measure(conn, [lambda: price_grid_fixed(conn, grid_ids, client_ids, margens, taxes=taxes, rollup=rollup)], rows=len(grid_ids) * len(client_ids) * len(margens))
+
+    # Composition saves: rewrite mid-level products with their own composition
+    mids = info["levels"][len(info["levels"]) // 2]
+    def save_composition(pid):
+        materials = conn.execute("SELECT vm.nome, mu.quantidade FROM materials_usage mu JOIN vertical_materials vm ON vm.id=mu.material_id WHERE mu.product_id=?", (pid,)).fetchall()
+        processes = conn.execute("SELECT vp.nome, pu.horas FROM processes_usage pu JOIN vertical_processes vp ON vp.id=pu.process_id WHERE pu.product_id=?", (pid,)).fetchall()
+        thirds = conn.execute("SELECT tp.nome, tu.quantidade FROM third_usage tu JOIN third_party_items tp ON tp.id=tu.third_id WHERE tu.product_id=?", (pid,)).fetchall()
+        components = conn.execute("SELECT component_product_id, quantidade FROM product_components WHERE parent_product_id=?", (pid,)).fetchall()
+        db.replace_composition(pid, materials, processes, thirds, components)
+    cases["replace_composition"] = measure(conn, [lambda pid=pid: save_composition(pid) for pid in rnd.sample(mids, min(sample, len(mids)))])
+
+    # Editor save path: 1% of the materials repriced through apply_changes
+    def editor_save():
+        original = pd.read_sql("SELECT * FROM vertical_materials", conn)
+        edited = original.copy()
+        rows = edited.sample(frac=0.01, random_state=rnd.randint(0, 10 ** 6)).index
+        edited.loc[rows, "preco_unitario"] = edited.loc[rows, "preco_unitario"] + 0.01
+        db.apply_changes("vertical_materials", original, edited)
+    cases["apply_changes"] = measure(conn, [editor_save for _ in range(5)])
+
+    f = erp_csv(erp_rows, params.get("seed", DEFAULTS["seed"]))
+    cases["erp_import"] = measure(conn, [lambda: import_erp_file(db, f, "erp.csv")], rows=erp_rows)
+    cases["erp_import"]["rows_s"] = erp_rows / cases["erp_import"]["total_s"]
+    db.close()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks do motor de precificação sobre catálogos sintéticos")
+    parser.add_argument("--scales", default="1000,10000", help="números de produtos, separados por vírgula")
+    parser.add_argument("--materials", type=int, default=DEFAULTS["n_materials"])
+    parser.add_argument("--depth", type=int, default=DEFAULTS["depth"])
+    parser.add_argument("--fanout", type=int, default=DEFAULTS["fanout"])
+    parser.add_argument("--sharing", type=float, default=DEFAULTS["sharing"])
+    parser.add_argument("--seed", type=int, default=DEFAULTS["seed"])
+    parser.add_argument("--sample", type=int, default=50, help="operações por caso")
+    parser.add_argument("--erp-rows", type=int, default=50000)
+    parser.add_argument("--out", help="arquivo JSON de saída (padrão: stdout)")
+    args = parser.parse_args(argv)
+    report = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "scales": [],
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        for n in (int(s) for s in args.scales.split(",") if s.strip()):
+            params = {"n_products": n, "n_materials": args.materials, "depth": args.depth, "fanout": args.fanout, "sharing": args.sharing, "seed": args.seed}
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                results = pool.submit(run_scale, params, args.sample, args.erp_rows, workdir).result()
+            report["scales"].append(dict(params=params, **results))
+            print(f"{n} produtos: " + ", ".join(f"{name} {case['ops_s']:.1f} ops/s" for name, case in results["cases"].items()), file=sys.stderr)
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
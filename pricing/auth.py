@@ -1,19 +1,50 @@
 import os
 import hashlib
+import hmac
 import secrets
 
-def hash_password(password):
+# Stored as "pbkdf2_sha256$<iterações>$<salt>$<hash hex>". Hashes from before
+# the versioned format ("<salt>$<hash hex>") used 100000 iterations; they and
+# any hash with other parameters still verify, and needs_rehash() tells the
+# caller to store a new one (verify_password does it through on_rehash).
+ALGORITHM = "pbkdf2_sha256"
+LEGACY_ITERATIONS = 100000
+ITERATIONS = int(os.environ.get("PASSWORD_HASH_ITERATIONS", LEGACY_ITERATIONS))
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac("sha256", password.encode(), salt.encode(), iterations).hex()
+
+def _parse(stored):
+    # -> (iterations, salt, hash hex), None when unreadable
+    parts = (stored or "").split("$")
+    if len(parts) == 2:
+        return LEGACY_ITERATIONS, parts[0], parts[1]
+    if len(parts) == 4 and parts[0] == ALGORITHM and parts[1].isdigit():
+        return int(parts[1]), parts[2], parts[3]
+    return None
+
+def hash_password(password, iterations=None):
+    iterations = iterations or ITERATIONS
     salt = secrets.token_hex(16)
-    dk = hashlib.pbkdf2_hmac("sha256", password.encode(), salt.encode(), 100000)
-    return f"{salt}${dk.hex()}"
+    return f"{ALGORITHM}${iterations}${salt}${_pbkdf2(password, salt, iterations)}"
 
-def verify_password(password, stored):
-    try:
-        salt, hexhash = stored.split("$")
-    except ValueError:
+def needs_rehash(stored):
+    # Legacy format, or parameters other than the current ones
+    parsed = _parse(stored)
+    return parsed is None or not stored.startswith(ALGORITHM + "$") or parsed[0] != ITERATIONS
+
+def verify_password(password, stored, on_rehash=None):
+    # on_rehash(novo_hash) is called after a successful check of a hash made
+    # with other parameters, so it can be saved in its place
+    parsed = _parse(stored)
+    if parsed is None:
+        return False
+    iterations, salt, hexhash = parsed
+    if not hmac.compare_digest(_pbkdf2(password, salt, iterations), hexhash):
         return False
-    dk = hashlib.pbkdf2_hmac("sha256", password.encode(), salt.encode(), 100000)
-    return dk.hex() == hexhash
+    if on_rehash is not None and needs_rehash(stored):
+        on_rehash(hash_password(password))
+    return True
 
 def is_master_password(password):
     mp = os.environ.get("MASTER_PASSWORD")
@@ -0,0 +1,75 @@
+import threading
+from collections import OrderedDict
+from pricing.db import COST_TABLES, read_versions
+
+
+class RollupCache:
+    # Per-product get_base_cost results, LRU-bounded. Coherence across
+    # processes comes from the table_versions counters stored in the database
+    # file itself: sync() compares them and drops everything on any change.
+    # put() only keeps results computed by a thread whose last sync() saw the
+    # current generation, so a slow reader cannot refill the cache with costs
+    # read before another session's write.
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale_puts = 0
+        self._data = OrderedDict()
+        self._stamp = None
+        self._lock = threading.Lock()
+        self._seen = threading.local()
+
+    def sync(self, conn):
+        stamp = read_versions(conn, COST_TABLES)
+        self._seen.stamp = stamp
+        with self._lock:
+            if stamp != self._stamp:
+                if self._data:
+                    self.invalidations += 1
+                self._data.clear()
+                self._stamp = stamp
+                return False
+        return True
+
+    def get(self, product_id):
+        with self._lock:
+            cost = self._data.get(product_id)
+            if cost is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(product_id)
+            self.hits += 1
+            return cost
+
+    def put(self, product_id, cost):
+        with self._lock:
+            if self._stamp is None or getattr(self._seen, "stamp", None) != self._stamp:
+                self.stale_puts += 1
+                return
+            self._data[product_id] = cost
+            self._data.move_to_end(product_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._stamp = None
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "stale_puts": self.stale_puts,
+            }
@@ -1,24 +1,554 @@
 import sqlite3
 import os
+import re
+import threading
+import pandas as pd
+from contextlib import contextmanager
 from datetime import datetime
 from pricing.auth import hash_password
+from pricing.instrument import TracedConnection, traced
+
+# Tables whose contents feed the cost rollup (prices, compositions, admin)
+COST_TABLES = (
+    "vertical_materials", "vertical_processes", "third_party_items", "admin_costs",
+    "materials_usage", "processes_usage", "third_usage", "product_components", "products",
+)
+
+def bump_versions(conn, *tables):
+    # Write-generation counters shared by every process using the same file;
+    # call inside the writing transaction so readers never see data without the bump
+    conn.executemany(
+        "INSERT INTO table_versions (table_name, version) VALUES (?, 1) "
+        "ON CONFLICT(table_name) DO UPDATE SET version = version + 1",
+        [(t,) for t in tables],
+    )
+
+def read_versions(conn, tables=None):
+    rows = conn.execute("SELECT table_name, version FROM table_versions").fetchall()
+    versions = {r[0]: r[1] for r in rows}
+    if tables is None:
+        return versions
+    return tuple(versions.get(t, 0) for t in tables)
+
+# child table -> [(column, parent table)], all ON DELETE CASCADE
+FOREIGN_KEYS = {
+    "product_clients": [("product_id", "products"), ("client_id", "clients")],
+    "product_cost_history": [("product_id", "products"), ("client_id", "clients")],
+    "product_components": [("parent_product_id", "products"), ("component_product_id", "products")],
+    "materials_usage": [("product_id", "products"), ("material_id", "vertical_materials")],
+    "processes_usage": [("product_id", "products"), ("process_id", "vertical_processes")],
+    "third_usage": [("product_id", "products"), ("third_id", "third_party_items")],
+    "appointments": [("user_id", "users")],
+    "product_closure": [("ancestor_id", "products"), ("descendant_id", "products")],
+    "product_cost_snapshot": [("product_id", "products")],
+    "product_quote_snapshot": [("link_id", "product_clients")],
+}
+
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_materials_usage_product ON materials_usage(product_id)",
+    "CREATE INDEX IF NOT EXISTS ix_materials_usage_material ON materials_usage(material_id)",
+    "CREATE INDEX IF NOT EXISTS ix_processes_usage_product ON processes_usage(product_id)",
+    "CREATE INDEX IF NOT EXISTS ix_processes_usage_process ON processes_usage(process_id)",
+    "CREATE INDEX IF NOT EXISTS ix_third_usage_product ON third_usage(product_id)",
+    "CREATE INDEX IF NOT EXISTS ix_third_usage_third ON third_usage(third_id)",
+    "CREATE INDEX IF NOT EXISTS ix_product_components_parent ON product_components(parent_product_id)",
+    "CREATE INDEX IF NOT EXISTS ix_product_components_component ON product_components(component_product_id)",
+    "CREATE INDEX IF NOT EXISTS ix_ncm_taxes_ncm ON ncm_taxes(ncm)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ux_product_clients ON product_clients(product_id, client_id)",
+    "CREATE INDEX IF NOT EXISTS ix_product_clients_client ON product_clients(client_id)",
+    "CREATE INDEX IF NOT EXISTS ix_product_cost_history_series ON product_cost_history(product_id, client_id, ts)",
+    "CREATE INDEX IF NOT EXISTS ix_product_cost_history_client ON product_cost_history(client_id)",
+    "CREATE INDEX IF NOT EXISTS ix_appointments_user ON appointments(user_id)",
+    "CREATE INDEX IF NOT EXISTS ix_reprice_shards_job ON reprice_shards(job_id, concluido_em)",
+    "CREATE INDEX IF NOT EXISTS ix_scenario_adjustments_scenario ON scenario_adjustments(scenario_id)",
+    "CREATE INDEX IF NOT EXISTS ix_product_closure_descendant ON product_closure(descendant_id, ancestor_id)",
+    # Filters of the paginated editors (filter_clause)
+    "CREATE INDEX IF NOT EXISTS ix_vertical_materials_grupo ON vertical_materials(grupo, subgrupo)",
+    "CREATE INDEX IF NOT EXISTS ix_vertical_materials_fornecedor ON vertical_materials(fornecedor)",
+    "CREATE INDEX IF NOT EXISTS ix_vertical_materials_codigo ON vertical_materials(codigo)",
+    "CREATE INDEX IF NOT EXISTS ix_vertical_processes_grupo ON vertical_processes(grupo, subgrupo)",
+    "CREATE INDEX IF NOT EXISTS ix_clients_codigo ON clients(codigo)",
+]
+
+# Columns the spreadsheet editors may write: text cells are saved as "" when
+# empty, numeric ones as 0 (or the given default). The paginated editor
+# filters on "filters" (exact value), "prefix" (starts with) and searches
+# "search" for a substring
+EDITABLE_TABLES = {
+    "vertical_materials": {
+        "text": ["codigo", "grupo", "subgrupo", "nome", "ncm", "unidade", "fornecedor", "data_atualizacao"],
+        "numeric": ["preco_unitario"],
+        "filters": ["grupo", "subgrupo", "fornecedor"],
+        "prefix": ["codigo"],
+        "search": ["nome", "codigo", "ncm"],
+    },
+    "vertical_processes": {
+        "text": ["grupo", "subgrupo", "nome", "unidade", "origem", "maquina"],
+        "numeric": ["preco_unitario_hora"],
+        "filters": ["grupo", "subgrupo"],
+        "search": ["nome", "maquina", "origem"],
+    },
+    "third_party_items": {
+        "text": ["nome", "fornecedor", "unidade"],
+        "numeric": ["preco_unitario", "quantidade_padrao"],
+        "defaults": {"unidade": "serviço"},
+        "filters": ["fornecedor"],
+        "search": ["nome", "fornecedor"],
+    },
+    "clients": {
+        "text": ["codigo", "nome", "planta", "uf", "cidade", "regime"],
+        "numeric": ["pis", "cofins", "icms", "fator"],
+        "strip": ["codigo"],
+        "filters": ["uf", "regime"],
+        "prefix": ["codigo"],
+        "search": ["nome", "codigo", "cidade", "planta"],
+    },
+    "admin_costs": {
+        "text": ["nome"],
+        "numeric": ["valor"],
+    },
+}
+
+# Scenario adjustments (pricing.scenarios): what each category can be
+# targeted by; tipo "pct" multiplies the price, "abs" adds R$ per unit/hour
+SCENARIO_TARGETS = {
+    "materiais": ("id", "grupo", "fornecedor"),
+    "processos": ("id", "grupo"),
+    "terceiros": ("id", "fornecedor"),
+}
+SCENARIO_TYPES = ("pct", "abs")
+
+# REAL money column -> integer centavos column kept in step by triggers;
+# NULL when the value carries fractions of a centavo
+MONEY_COLUMNS = {
+    "vertical_materials": ("preco_unitario", "preco_unitario_centavos"),
+    "vertical_processes": ("preco_unitario_hora", "preco_unitario_hora_centavos"),
+    "third_party_items": ("preco_unitario", "preco_unitario_centavos"),
+    "admin_costs": ("valor", "valor_centavos"),
+}
+
+# product_cost_history: ts is data_vinculo in seconds since the epoch (the
+# wall-clock text read as UTC, so day/week/month buckets follow it). A save
+# that repeats the pair's latest snapshot (same costs, price and margin) is
+# not inserted. Parameters: product_id, client_id, data_vinculo, then
+# HISTORY_VALUES in order
+HISTORY_VALUES = (
+    "custo_materiais", "custo_processos", "custo_terceiros", "custos_admin",
+    "impostos", "custo_total_sem_impostos", "preco_final", "margem",
+)
+COST_HISTORY_INSERT = (
+    f"INSERT INTO product_cost_history (product_id, client_id, data_vinculo, ts, {', '.join(HISTORY_VALUES)}) "
+    f"SELECT ?1, ?2, ?3, CAST(strftime('%s', ?3) AS INTEGER), {', '.join(f'?{i}' for i in range(4, 4 + len(HISTORY_VALUES)))} "
+    f"WHERE NOT EXISTS (SELECT 1 FROM (SELECT {', '.join(HISTORY_VALUES)} FROM product_cost_history "
+    "WHERE product_id=?1 AND client_id=?2 ORDER BY ts DESC, id DESC LIMIT 1) ultimo "
+    f"WHERE {' AND '.join(f'ultimo.{c} IS ?{i}' for i, c in enumerate(HISTORY_VALUES, 4))})"
+)
+
+# product_cost_snapshot / product_quote_snapshot (pricing.snapshot): triggers
+# mark in snapshot_dirty the products each write to a cost or tax input
+# touches, and refresh_snapshot recomputes those and their ancestors only.
+# table -> (events, UPDATE OF columns or None for any, products touched by {r})
+SNAPSHOT_SOURCES = {
+    "products": (("INSERT", "UPDATE"), "ncm, local_fabricacao_uf, destino_uf", "SELECT {r}.id"),
+    "vertical_materials": (("UPDATE",), "preco_unitario", "SELECT product_id FROM materials_usage WHERE material_id = {r}.id"),
+    "vertical_processes": (("UPDATE",), "preco_unitario_hora", "SELECT product_id FROM processes_usage WHERE process_id = {r}.id"),
+    "third_party_items": (("UPDATE",), "preco_unitario", "SELECT product_id FROM third_usage WHERE third_id = {r}.id"),
+    "materials_usage": (("INSERT", "UPDATE", "DELETE"), None, "SELECT {r}.product_id"),
+    "processes_usage": (("INSERT", "UPDATE", "DELETE"), None, "SELECT {r}.product_id"),
+    "third_usage": (("INSERT", "UPDATE", "DELETE"), None, "SELECT {r}.product_id"),
+    "product_components": (("INSERT", "UPDATE", "DELETE"), None, "SELECT {r}.parent_product_id"),
+    "admin_costs": (("INSERT", "UPDATE", "DELETE"), "valor", "SELECT id FROM products"),
+    "product_clients": (("INSERT", "UPDATE"), "product_id, client_id, margem", "SELECT {r}.product_id"),
+    "clients": (("UPDATE",), "pis, cofins, icms", "SELECT product_id FROM product_clients WHERE client_id = {r}.id"),
+    "ncm_taxes": (("INSERT", "UPDATE", "DELETE"), None, "SELECT id FROM products WHERE ncm = {r}.ncm"),
+}
+
+def _create_snapshot_triggers(cur):
+    for table, (events, columns, touched) in SNAPSHOT_SOURCES.items():
+        for event in events:
+            rows = {"INSERT": ("NEW",), "DELETE": ("OLD",), "UPDATE": ("NEW", "OLD")}[event]
+            select = " UNION ".join(touched.format(r=r) for r in rows)
+            of = f" OF {columns}" if event == "UPDATE" and columns else ""
+            cur.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_snapshot_{event.lower()} AFTER {event}{of} ON {table}
+            BEGIN INSERT OR IGNORE INTO snapshot_dirty (product_id) {select}; END
+            """)
+
+def _migrate_history_ts(cur):
+    cols = [r[1] for r in cur.execute("PRAGMA table_info(product_cost_history)").fetchall()]
+    if "ts" not in cols:
+        cur.execute("ALTER TABLE product_cost_history ADD COLUMN ts INTEGER")
+        cur.execute("UPDATE product_cost_history SET ts = CAST(strftime('%s', data_vinculo) AS INTEGER)")
+    # Superseded by ix_product_cost_history_series (product_id, client_id, ts)
+    cur.execute("DROP INDEX IF EXISTS ix_product_cost_history_link")
+
+def _centavos_sql(expr):
+    return f"CASE WHEN ROUND({expr} * 100) / 100.0 = {expr} THEN CAST(ROUND({expr} * 100) AS INTEGER) END"
+
+def _migrate_money_columns(cur):
+    for table, (column, centavos) in MONEY_COLUMNS.items():
+        cols = [r[1] for r in cur.execute(f"PRAGMA table_info({table})").fetchall()]
+        if centavos not in cols:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {centavos} INTEGER")
+            cur.execute(f"UPDATE {table} SET {centavos} = {_centavos_sql(column)}")
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_{centavos}_insert AFTER INSERT ON {table}
+        BEGIN UPDATE {table} SET {centavos} = {_centavos_sql('NEW.' + column)} WHERE id = NEW.id; END
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_{centavos}_update AFTER UPDATE OF {column} ON {table}
+        BEGIN UPDATE {table} SET {centavos} = {_centavos_sql('NEW.' + column)} WHERE id = NEW.id; END
+        """)
+
+# FTS5 indexes (external content, kept in sync by triggers): table ->
+# (indexed columns, bm25 weight per column). Codes weigh most, then names
+SEARCH_INDEXES = {
+    "products": (["codigo", "nome", "grupo", "subgrupo"], [10.0, 5.0, 1.0, 1.0]),
+    "vertical_materials": (["codigo", "nome", "grupo", "subgrupo", "fornecedor"], [10.0, 5.0, 1.0, 1.0, 1.0]),
+    "clients": (["codigo", "nome", "cidade"], [10.0, 5.0, 1.0]),
+}
+
+def _create_search_indexes(cur):
+    # False when this SQLite build has no FTS5: search() falls back to LIKE
+    for table, (columns, _weights) in SEARCH_INDEXES.items():
+        fts = f"{table}_fts"
+        exists = cur.execute("SELECT 1 FROM sqlite_master WHERE name=?", (fts,)).fetchone()
+        try:
+            cur.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({', '.join(columns)}, "
+                f"content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+            )
+        except sqlite3.OperationalError:
+            return False
+        cols = ", ".join(columns)
+        new = ", ".join(f"NEW.{c}" for c in columns)
+        old = ", ".join(f"OLD.{c}" for c in columns)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{fts}_insert AFTER INSERT ON {table}
+        BEGIN INSERT INTO {fts} (rowid, {cols}) VALUES (NEW.id, {new}); END
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{fts}_delete AFTER DELETE ON {table}
+        BEGIN INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', OLD.id, {old}); END
+        """)
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{fts}_update AFTER UPDATE OF {cols} ON {table}
+        BEGIN
+            INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', OLD.id, {old});
+            INSERT INTO {fts} (rowid, {cols}) VALUES (NEW.id, {new});
+        END
+        """)
+        if not exists:
+            cur.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+    return True
+
+def has_search_index(conn, table):
+    return table in SEARCH_INDEXES and conn.execute("SELECT 1 FROM sqlite_master WHERE name=?", (f"{table}_fts",)).fetchone() is not None
+
+def match_query(text):
+    # Typeahead text -> FTS5 query: every word must match as a prefix
+    # ("prd-00 chapa" -> "prd"* AND "00"* AND "chapa"*); None if no words
+    words = re.findall(r"\w+", text or "")
+    return " AND ".join(f'"{w}"*' for w in words) or None
+
+# Matches scored per search: a word common to the whole catalog ("produto")
+# ranks only the first SEARCH_CANDIDATES hits, so typeahead latency stays
+# bounded at a million rows; the more words typed, the fewer hits
+SEARCH_CANDIDATES = 5000
+
+def search(conn, table, text, k=20):
+    # Top k rows of table matching text, best first (bm25 over SEARCH_INDEXES
+    # columns); without FTS5, a LIKE scan in id order
+    columns, weights = SEARCH_INDEXES[table]
+    query = match_query(text)
+    if query is None:
+        return []
+    if has_search_index(conn, table):
+        fts = f"{table}_fts"
+        return conn.execute(
+            f"SELECT t.id, {', '.join('t.' + c for c in columns)} FROM "
+            f"(SELECT rowid, bm25({fts}, {', '.join(map(str, weights))}) AS score FROM {fts} WHERE {fts} MATCH ? LIMIT ?) hits "
+            f"JOIN {table} t ON t.id = hits.rowid ORDER BY hits.score LIMIT ?",
+            (query, SEARCH_CANDIDATES, k),
+        ).fetchall()
+    words = re.findall(r"\w+", text)
+    where = " AND ".join("(" + " OR ".join(f"{c} LIKE ?" for c in columns) + ")" for _ in words)
+    params = [f"%{w}%" for w in words for _ in columns]
+    return conn.execute(f"SELECT id, {', '.join(columns)} FROM {table} WHERE {where} ORDER BY id LIMIT ?", params + [k]).fetchall()
+
+def filter_clause(table, filtros=(), busca="", fts=False):
+    # WHERE clause and params for the paginated editors. filtros holds
+    # (column, value) pairs; prefix columns become an index-friendly range.
+    # With fts the text search goes through the table's FTS5 index
+    spec = EDITABLE_TABLES[table]
+    terms, params = [], []
+    for column, value in filtros:
+        if column in spec.get("prefix", ()):
+            terms.append(f"({column} >= ? AND {column} < ?)")
+            params += [value, value + "\U0010ffff"]
+        elif column in spec.get("filters", ()) and value:
+            terms.append(f"{column} = ?")
+            params.append(value)
+        elif column in spec.get("filters", ()):
+            terms.append(f"COALESCE({column}, '') = ''")
+        else:
+            raise ValueError(f"Filtro inválido para {table}: {column}")
+    if busca and fts and match_query(busca):
+        terms.append(f"id IN (SELECT rowid FROM {table}_fts WHERE {table}_fts MATCH ?)")
+        params.append(match_query(busca))
+    elif busca:
+        terms.append("(" + " OR ".join(f"{c} LIKE ?" for c in spec["search"]) + ")")
+        params += [f"%{busca}%"] * len(spec["search"])
+    return (" WHERE " + " AND ".join(terms) if terms else ""), params
+
+def child_tables(table):
+    return [child for child, fks in FOREIGN_KEYS.items() if any(parent == table for _c, parent in fks)]
+
+def _normalize_frame(df, spec, columns):
+    defaults = spec.get("defaults", {})
+    out = pd.DataFrame(index=df.index)
+    for c in columns:
+        if c in spec["numeric"]:
+            out[c] = pd.to_numeric(df[c], errors="coerce").fillna(defaults.get(c, 0.0)).astype(float)
+        else:
+            col = df[c].astype(object)
+            col = col.where(col.notna() & (col != ""), defaults.get(c, "")).astype(str)
+            out[c] = col.str.strip() if c in spec.get("strip", ()) else col
+    return out
+
+def diff_frames(table, original, edited):
+    # Change set between the frame shown in st.data_editor and the edited one:
+    # rows without a known id are inserts, rows whose cells differ are updates
+    # and ids missing from the edited frame are deletes
+    spec = EDITABLE_TABLES[table]
+    columns = [c for c in spec["text"] + spec["numeric"] if c in edited.columns]
+    orig = _normalize_frame(original, spec, columns)
+    orig.index = pd.Index(original["id"].astype("int64"))
+    new = _normalize_frame(edited, spec, columns)
+    ids = pd.to_numeric(edited["id"], errors="coerce") if "id" in edited.columns else pd.Series(float("nan"), index=edited.index)
+    is_new = (ids.isna() | ~ids.isin(orig.index)).to_numpy()
+    inserted = new[is_new].copy()
+    inserted.insert(0, "id", ids[is_new].astype("Int64"))
+    kept = new[~is_new]
+    kept.index = pd.Index(ids[~is_new].astype("int64"))
+    kept = kept[~kept.index.duplicated(keep="last")]
+    changed = (orig.loc[kept.index, columns].to_numpy(dtype=object) != kept[columns].to_numpy(dtype=object)).any(axis=1)
+    return {
+        "columns": columns,
+        "inserted": inserted,
+        "updated": kept[changed],
+        "deleted": sorted(int(i) for i in orig.index.difference(kept.index)),
+    }
+
+def _rebuild_with_foreign_keys(cur, table):
+    # SQLite cannot ALTER in a foreign key: copy into a table declared with the
+    # constraints, dropping orphan rows (and duplicate links) along the way
+    ddl = cur.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone()[0]
+    fks = FOREIGN_KEYS[table]
+    for column, parent in fks:
+        ddl = re.sub(rf"\b{column}\s+INTEGER\b(?!\s+REFERENCES)", f"{column} INTEGER REFERENCES {parent}(id) ON DELETE CASCADE", ddl, count=1)
+    ddl = re.sub(rf"^CREATE TABLE\s+(IF NOT EXISTS\s+)?\"?{table}\"?", f"CREATE TABLE {table}__new", ddl)
+    cols = [r[1] for r in cur.execute(f"PRAGMA table_info({table})").fetchall()]
+    where = " AND ".join(f"({c} IS NULL OR {c} IN (SELECT id FROM {parent}))" for c, parent in fks)
+    if table == "product_clients":
+        where += " AND id IN (SELECT MAX(id) FROM product_clients GROUP BY product_id, client_id)"
+    cur.execute(f"DROP TABLE IF EXISTS {table}__new")
+    cur.execute(ddl)
+    cur.execute(f"INSERT INTO {table}__new ({', '.join(cols)}) SELECT {', '.join(cols)} FROM {table} WHERE {where}")
+    cur.execute(f"DROP TABLE {table}")
+    cur.execute(f"ALTER TABLE {table}__new RENAME TO {table}")
+
+def _check_acyclic(conn, product_id, component_ids):
+    # A new edge product -> component closes a cycle when the component already
+    # contains the product (or is the product itself)
+    for component_id in set(component_ids):
+        if component_id == product_id or conn.execute(
+            "SELECT 1 FROM product_closure WHERE ancestor_id=? AND descendant_id=?", (component_id, product_id)
+        ).fetchone():
+            raise ValueError(f"Ciclo na composição de produtos: o produto {component_id} já contém o produto {product_id}")
+
+def refresh_closure(conn, product_ids=None):
+    # Recomputes the product_closure rows of the given products and of all
+    # their ancestors (every product when None), children before parents:
+    # quantidade is summed over all paths, depth is the shortest one
+    if product_ids is None:
+        affected = {r[0] for r in conn.execute("SELECT id FROM products").fetchall()}
+    else:
+        affected = set(product_ids)
+        ids = list(affected)
+        for i in range(0, len(ids), 900):
+            chunk = ids[i:i + 900]
+            affected.update(r[0] for r in conn.execute(
+                f"SELECT ancestor_id FROM product_closure WHERE descendant_id IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall())
+    edges = {a: [] for a in affected}
+    ids = list(affected)
+    for i in range(0, len(ids), 900):
+        chunk = ids[i:i + 900]
+        for parent_id, component_id, qty in conn.execute(
+            f"SELECT parent_product_id, component_product_id, quantidade FROM product_components WHERE parent_product_id IN ({','.join('?' * len(chunk))}) ORDER BY id",
+            chunk,
+        ).fetchall():
+            edges[parent_id].append((component_id, qty or 0.0))
+    pending = {a: sum(1 for c, _q in edges[a] if c in affected) for a in affected}
+    parents = {}
+    for a in affected:
+        for c, _q in edges[a]:
+            if c in affected:
+                parents.setdefault(c, []).append(a)
+    ready = [a for a in affected if pending[a] == 0]
+    closure = {}
+    while ready:
+        node = ready.pop()
+        rows = {}
+        for component_id, qty in edges[node]:
+            below = closure.get(component_id)
+            if below is None:
+                below = {r[0]: (r[1], r[2]) for r in conn.execute(
+                    "SELECT descendant_id, depth, quantidade FROM product_closure WHERE ancestor_id=?", (component_id,)
+                ).fetchall()}
+            for descendant_id, (depth, q) in [(component_id, (0, 1.0))] + list(below.items()):
+                d, total = rows.get(descendant_id, (depth + 1, 0.0))
+                rows[descendant_id] = (min(d, depth + 1), total + qty * q)
+        closure[node] = rows
+        for parent_id in parents.get(node, ()):
+            pending[parent_id] -= 1
+            if pending[parent_id] == 0:
+                ready.append(parent_id)
+    # Products left pending sit on (or above) a cycle; init_schema moves the
+    # links closing such cycles to product_components_quarantine first
+    done = list(closure)
+    for i in range(0, len(done), 900):
+        chunk = done[i:i + 900]
+        conn.execute(f"DELETE FROM product_closure WHERE ancestor_id IN ({','.join('?' * len(chunk))})", chunk)
+    conn.executemany(
+        "INSERT INTO product_closure (ancestor_id, descendant_id, depth, quantidade) VALUES (?,?,?,?)",
+        ((a, d, depth, q) for a, rows in closure.items() for d, (depth, q) in rows.items()),
+    )
+    return done
+
+def quarantine_cycles(conn):
+    # Cycles saved before _check_acyclic existed would make every rollup fail:
+    # the links closing them (DFS back edges) move to
+    # product_components_quarantine and the closure of the products involved is
+    # rebuilt. Returns the moved (id, parent, component, quantidade) rows.
+    edges = {}
+    pending = {}
+    parents = {}
+    for link_id, parent_id, component_id, qty in conn.execute(
+        "SELECT id, parent_product_id, component_product_id, quantidade FROM product_components ORDER BY id"
+    ).fetchall():
+        edges.setdefault(parent_id, []).append((link_id, component_id, qty))
+        pending[parent_id] = pending.get(parent_id, 0) + 1
+        pending.setdefault(component_id, 0)
+        parents.setdefault(component_id, []).append(parent_id)
+    ready = [n for n, count in pending.items() if count == 0]
+    while ready:
+        for parent_id in parents.get(ready.pop(), ()):
+            pending[parent_id] -= 1
+            if pending[parent_id] == 0:
+                ready.append(parent_id)
+    stuck = {n for n, count in pending.items() if count > 0}
+    if not stuck:
+        return []
+    moved = []
+    state = {}  # 1 = on the DFS stack, 2 = finished
+    for root in sorted(stuck):
+        if root in state:
+            continue
+        state[root] = 1
+        stack = [(root, iter(edges.get(root, ())))]
+        while stack:
+            node, links = stack[-1]
+            for link_id, component_id, qty in links:
+                if component_id not in stuck:
+                    continue
+                if state.get(component_id) == 1:
+                    moved.append((link_id, node, component_id, qty))
+                elif component_id not in state:
+                    state[component_id] = 1
+                    stack.append((component_id, iter(edges.get(component_id, ()))))
+                    break
+            else:
+                state[node] = 2
+                stack.pop()
+    agora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    conn.executemany(
+        "INSERT INTO product_components_quarantine (id, parent_product_id, component_product_id, quantidade, data_quarentena) VALUES (?,?,?,?,?)",
+        [row + (agora,) for row in moved],
+    )
+    conn.executemany("DELETE FROM product_components WHERE id=?", [(row[0],) for row in moved])
+    refresh_closure(conn, stuck)
+    bump_versions(conn, "product_components")
+    return moved
+
+# Applied to every connection; journal_mode=WAL is persistent and set once per file
+CONNECTION_PRAGMAS = (
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA temp_store=MEMORY",
+)
 
 class Database:
     def __init__(self, path=None):
         self.path = path or os.path.join(os.getcwd(), "precificacao.db")
+        self._local = threading.local()
         self._ensure_db()
         self.init_schema()
 
     def _ensure_db(self):
-        if not os.path.exists(self.path):
-            conn = sqlite3.connect(self.path)
-            conn.close()
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.close()
 
     def connect(self):
-        conn = sqlite3.connect(self.path)
+        # A new connection owned (and closed) by the caller
+        conn = sqlite3.connect(self.path, timeout=5.0, factory=TracedConnection)
         conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
         return conn
 
+    def connection(self):
+        # The calling thread's shared connection; sqlite3 connections cannot
+        # cross threads, so each thread (e.g. each Streamlit script run) gets one
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self.connect()
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        # Nested blocks join the outermost one, which commits or rolls back.
+        # The outermost one takes the write lock up front (BEGIN IMMEDIATE), so
+        # checks that read before writing (_check_acyclic) cannot race
+        conn = self.connection()
+        depth = self._local.depth
+        if depth == 0 and not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        self._local.depth = depth + 1
+        try:
+            yield conn
+        except BaseException:
+            self._local.depth = depth
+            if depth == 0:
+                conn.rollback()
+            raise
+        self._local.depth = depth
+        if depth == 0:
+            conn.commit()
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
     def init_schema(self):
         conn = self.connect()
         cur = conn.cursor()
@@ -122,8 +652,8 @@ class Database:
         cur.execute("""
         CREATE TABLE IF NOT EXISTS product_clients (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            product_id INTEGER,
-            client_id INTEGER,
+            product_id INTEGER REFERENCES products(id) ON DELETE CASCADE,
+            client_id INTEGER REFERENCES clients(id) ON DELETE CASCADE,
             margem REAL,
             preco_final REAL,
             data_vinculo TEXT
@@ -141,9 +671,10 @@ class Database:
         cur.execute("""
         CREATE TABLE IF NOT EXISTS product_cost_history (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            product_id INTEGER,
-            client_id INTEGER,
+            product_id INTEGER REFERENCES products(id) ON DELETE CASCADE,
+            client_id INTEGER REFERENCES clients(id) ON DELETE CASCADE,
             data_vinculo TEXT,
+            ts INTEGER,
             custo_materiais REAL,
             custo_processos REAL,
             custo_terceiros REAL,
@@ -154,13 +685,108 @@ class Database:
             margem REAL
         )
         """)
+        # Current cost per product and quote per link at its margem
+        # (pricing.snapshot); preco_atual is NULL when margem + impostos
+        # leave no valid price
+        snapshot_exists = cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='product_cost_snapshot'").fetchone()
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS product_cost_snapshot (
+            product_id INTEGER PRIMARY KEY REFERENCES products(id) ON DELETE CASCADE,
+            custo_materiais REAL,
+            custo_processos REAL,
+            custo_terceiros REAL,
+            custos_admin REAL,
+            custo_total_sem_impostos REAL,
+            atualizado_em TEXT
+        )
+        """)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS product_quote_snapshot (
+            link_id INTEGER PRIMARY KEY REFERENCES product_clients(id) ON DELETE CASCADE,
+            margem REAL,
+            preco_atual REAL,
+            impostos_atual REAL,
+            margem_real_atual REAL,
+            atualizado_em TEXT
+        )
+        """)
+        cur.execute("CREATE TABLE IF NOT EXISTS snapshot_dirty (product_id INTEGER PRIMARY KEY) WITHOUT ROWID")
+        # Repricing jobs (pricing.reprice): a shard is a range of
+        # product_clients ids, committed together with its results
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS reprice_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            status TEXT NOT NULL,
+            filtros TEXT,
+            total_links INTEGER DEFAULT 0,
+            feitos INTEGER DEFAULT 0,
+            ignorados INTEGER DEFAULT 0,
+            criado_em TEXT,
+            iniciado_em TEXT,
+            atualizado_em TEXT,
+            concluido_em TEXT,
+            erro TEXT
+        )
+        """)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS reprice_shards (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            job_id INTEGER NOT NULL REFERENCES reprice_jobs(id) ON DELETE CASCADE,
+            primeiro_id INTEGER NOT NULL,
+            ultimo_id INTEGER NOT NULL,
+            links INTEGER NOT NULL,
+            concluido_em TEXT
+        )
+        """)
+
+        # What-if scenarios (pricing.scenarios): price adjustments kept apart
+        # from the base tables and applied only in memory
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS scenarios (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nome TEXT NOT NULL UNIQUE,
+            descricao TEXT,
+            criado_em TEXT
+        )
+        """)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS scenario_adjustments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            scenario_id INTEGER NOT NULL REFERENCES scenarios(id) ON DELETE CASCADE,
+            categoria TEXT NOT NULL,
+            alvo TEXT NOT NULL,
+            valor TEXT NOT NULL,
+            tipo TEXT NOT NULL,
+            ajuste REAL NOT NULL
+        )
+        """)
 
         cur.execute("""
         CREATE TABLE IF NOT EXISTS product_components (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
+            parent_product_id INTEGER REFERENCES products(id) ON DELETE CASCADE,
+            component_product_id INTEGER REFERENCES products(id) ON DELETE CASCADE,
+            quantidade REAL
+        )
+        """)
+        closure_exists = cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='product_closure'").fetchone()
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS product_closure (
+            ancestor_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+            descendant_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+            depth INTEGER NOT NULL,
+            quantidade REAL NOT NULL,
+            PRIMARY KEY (ancestor_id, descendant_id)
+        ) WITHOUT ROWID
+        """)
+        quarantine_exists = cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='product_components_quarantine'").fetchone()
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS product_components_quarantine (
+            id INTEGER PRIMARY KEY,
             parent_product_id INTEGER,
             component_product_id INTEGER,
-            quantidade REAL
+            quantidade REAL,
+            data_quarentena TEXT
         )
         """)
         cur.execute("PRAGMA table_info(products)")
@@ -174,24 +800,24 @@ class Database:
         cur.execute("""
         CREATE TABLE IF NOT EXISTS materials_usage (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            product_id INTEGER,
-            material_id INTEGER,
+            product_id INTEGER REFERENCES products(id) ON DELETE CASCADE,
+            material_id INTEGER REFERENCES vertical_materials(id) ON DELETE CASCADE,
             quantidade REAL
         )
         """)
         cur.execute("""
         CREATE TABLE IF NOT EXISTS processes_usage (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            product_id INTEGER,
-            process_id INTEGER,
+            product_id INTEGER REFERENCES products(id) ON DELETE CASCADE,
+            process_id INTEGER REFERENCES vertical_processes(id) ON DELETE CASCADE,
             horas REAL
         )
         """)
         cur.execute("""
         CREATE TABLE IF NOT EXISTS third_usage (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            product_id INTEGER,
-            third_id INTEGER,
+            product_id INTEGER REFERENCES products(id) ON DELETE CASCADE,
+            third_id INTEGER REFERENCES third_party_items(id) ON DELETE CASCADE,
             quantidade REAL
         )
         """)
@@ -205,15 +831,45 @@ class Database:
         )
         """)
         cur.execute("""
+        CREATE TABLE IF NOT EXISTS table_versions (
+            table_name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+        """)
+        cur.execute("""
         CREATE TABLE IF NOT EXISTS appointments (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
             data_hora TEXT,
             observacao TEXT,
             status TEXT
         )
         """)
+        # Existing databases: rebuild child tables created before foreign keys existed
+        for table in FOREIGN_KEYS:
+            cur.execute(f"PRAGMA foreign_key_list({table})")
+            if not cur.fetchall():
+                _rebuild_with_foreign_keys(cur, table)
+        _migrate_money_columns(cur)
+        _migrate_history_ts(cur)
+        _create_snapshot_triggers(cur)
+        if not snapshot_exists:
+            # First build: every product is computed on the next refresh
+            cur.execute("INSERT OR IGNORE INTO snapshot_dirty (product_id) SELECT id FROM products")
+        _create_search_indexes(cur)
+        for sql in INDEXES:
+            cur.execute(sql)
         conn.commit()
+        # Cycles can only predate _check_acyclic, so the full scan of
+        # product_components runs once, when the quarantine table is created
+        self.quarantined_links = []
+        if not quarantine_exists or not closure_exists:
+            conn.execute("BEGIN IMMEDIATE")
+            if not quarantine_exists:
+                self.quarantined_links = quarantine_cycles(conn)
+            if not closure_exists:
+                refresh_closure(conn)
+            conn.commit()
         conn.close()
 
     def seed_demo(self):
@@ -277,166 +933,323 @@ class Database:
                 "INSERT INTO users (nome, email, senha_hash, role) VALUES (?,?,?,?)",
                 ("Admin Costi", "admin@costi.com", hash_password("admin"), "admin")
             )
+        bump_versions(conn, "clients", "ncm_taxes", *COST_TABLES)
         conn.commit()
         conn.close()
 
+    def duplicate_material(self, material_id):
+        # Copy of the material with "_COPY" appended to its código; returns the new id
+        with self.transaction() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """INSERT INTO vertical_materials (codigo, grupo, subgrupo, nome, ncm, unidade, preco_unitario, fornecedor, data_atualizacao)
+                   SELECT CASE WHEN COALESCE(codigo, '') <> '' THEN TRIM(codigo) || '_COPY' ELSE '' END,
+                          grupo, subgrupo, nome, ncm, unidade, COALESCE(preco_unitario, 0), fornecedor, data_atualizacao
+                   FROM vertical_materials WHERE id=?""",
+                (material_id,),
+            )
+            bump_versions(conn, "vertical_materials")
+            new_id = cur.lastrowid
+        return new_id
+
     def add_product(self, codigo, nome, quantidade, destino_uf, ncm, local_fabricacao_uf, grupo=None, subgrupo=None):
-        conn = self.connect()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO products (codigo, nome, quantidade, destino_uf, ncm, local_fabricacao_uf, grupo, subgrupo) VALUES (?,?,?,?,?,?,?,?)",
-            (codigo, nome, quantidade, destino_uf, ncm, local_fabricacao_uf, grupo, subgrupo)
-        )
-        conn.commit()
-        pid = cur.lastrowid
-        conn.close()
+        with self.transaction() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "INSERT INTO products (codigo, nome, quantidade, destino_uf, ncm, local_fabricacao_uf, grupo, subgrupo) VALUES (?,?,?,?,?,?,?,?)",
+                (codigo, nome, quantidade, destino_uf, ncm, local_fabricacao_uf, grupo, subgrupo)
+            )
+            bump_versions(conn, "products")
+            pid = cur.lastrowid
         return pid
 
     def update_product(self, product_id, codigo, nome, quantidade, destino_uf, ncm, local_fabricacao_uf, grupo=None, subgrupo=None):
-        conn = self.connect()
-        conn.execute(
-            "UPDATE products SET codigo=?, nome=?, quantidade=?, destino_uf=?, ncm=?, local_fabricacao_uf=?, grupo=?, subgrupo=? WHERE id=?",
-            (codigo, nome, quantidade, destino_uf, ncm, local_fabricacao_uf, grupo, subgrupo, product_id)
-        )
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE products SET codigo=?, nome=?, quantidade=?, destino_uf=?, ncm=?, local_fabricacao_uf=?, grupo=?, subgrupo=? WHERE id=?",
+                (codigo, nome, quantidade, destino_uf, ncm, local_fabricacao_uf, grupo, subgrupo, product_id)
+            )
+            bump_versions(conn, "products")
 
     def delete_product_cascade(self, product_id):
-        conn = self.connect()
-        conn.execute("DELETE FROM materials_usage WHERE product_id=?", (product_id,))
-        conn.execute("DELETE FROM processes_usage WHERE product_id=?", (product_id,))
-        conn.execute("DELETE FROM third_usage WHERE product_id=?", (product_id,))
-        conn.execute("DELETE FROM product_clients WHERE product_id=?", (product_id,))
-        conn.execute("DELETE FROM product_components WHERE parent_product_id=?", (product_id,))
-        conn.execute("DELETE FROM products WHERE id=?", (product_id,))
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            ancestors = [r[0] for r in conn.execute("SELECT ancestor_id FROM product_closure WHERE descendant_id=?", (product_id,)).fetchall()]
+            conn.execute("DELETE FROM materials_usage WHERE product_id=?", (product_id,))
+            conn.execute("DELETE FROM processes_usage WHERE product_id=?", (product_id,))
+            conn.execute("DELETE FROM third_usage WHERE product_id=?", (product_id,))
+            conn.execute("DELETE FROM product_clients WHERE product_id=?", (product_id,))
+            conn.execute("DELETE FROM product_components WHERE parent_product_id=?", (product_id,))
+            conn.execute("DELETE FROM products WHERE id=?", (product_id,))
+            refresh_closure(conn, ancestors)
+            bump_versions(conn, "products", "materials_usage", "processes_usage", "third_usage", "product_components", "product_clients")
 
     def add_material_usage(self, product_id, material_id, quantidade):
-        conn = self.connect()
-        conn.execute("INSERT INTO materials_usage (product_id, material_id, quantidade) VALUES (?,?,?)", (product_id, material_id, quantidade))
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            conn.execute("INSERT INTO materials_usage (product_id, material_id, quantidade) VALUES (?,?,?)", (product_id, material_id, quantidade))
+            bump_versions(conn, "materials_usage")
 
     def add_process_usage(self, product_id, process_id, horas):
-        conn = self.connect()
-        conn.execute("INSERT INTO processes_usage (product_id, process_id, horas) VALUES (?,?,?)", (product_id, process_id, horas))
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            conn.execute("INSERT INTO processes_usage (product_id, process_id, horas) VALUES (?,?,?)", (product_id, process_id, horas))
+            bump_versions(conn, "processes_usage")
 
     def add_third_usage(self, product_id, third_id, quantidade):
-        conn = self.connect()
-        conn.execute("INSERT INTO third_usage (product_id, third_id, quantidade) VALUES (?,?,?)", (product_id, third_id, quantidade))
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            conn.execute("INSERT INTO third_usage (product_id, third_id, quantidade) VALUES (?,?,?)", (product_id, third_id, quantidade))
+            bump_versions(conn, "third_usage")
 
     def add_component_usage(self, product_id, component_id, quantidade):
-        conn = self.connect()
-        conn.execute("INSERT INTO product_components (parent_product_id, component_product_id, quantidade) VALUES (?,?,?)", (product_id, component_id, quantidade))
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            _check_acyclic(conn, product_id, [component_id])
+            conn.execute("INSERT INTO product_components (parent_product_id, component_product_id, quantidade) VALUES (?,?,?)", (product_id, component_id, quantidade))
+            refresh_closure(conn, [product_id])
+            bump_versions(conn, "product_components")
 
     def clear_composition(self, product_id):
-        conn = self.connect()
-        conn.execute("DELETE FROM materials_usage WHERE product_id=?", (product_id,))
-        conn.execute("DELETE FROM processes_usage WHERE product_id=?", (product_id,))
-        conn.execute("DELETE FROM third_usage WHERE product_id=?", (product_id,))
-        conn.execute("DELETE FROM product_components WHERE parent_product_id=?", (product_id,))
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM materials_usage WHERE product_id=?", (product_id,))
+            conn.execute("DELETE FROM processes_usage WHERE product_id=?", (product_id,))
+            conn.execute("DELETE FROM third_usage WHERE product_id=?", (product_id,))
+            conn.execute("DELETE FROM product_components WHERE parent_product_id=?", (product_id,))
+            refresh_closure(conn, [product_id])
+            bump_versions(conn, "materials_usage", "processes_usage", "third_usage", "product_components")
+
+    def _get_or_create_names(self, conn, table, names, insert_sql, default_row):
+        # name -> id for every name, inserting the missing ones with default_row(nome)
+        names = list(dict.fromkeys(names))
+        ids = {}
+        def lookup(chunk):
+            marks = ",".join("?" * len(chunk))
+            for r in conn.execute(f"SELECT nome, MIN(id) FROM {table} WHERE nome IN ({marks}) GROUP BY nome", chunk):
+                ids[r[0]] = r[1]
+        for i in range(0, len(names), 900):
+            lookup(names[i:i + 900])
+        missing = [n for n in names if n not in ids]
+        if missing:
+            conn.executemany(insert_sql, [default_row(n) for n in missing])
+            for i in range(0, len(missing), 900):
+                lookup(missing[i:i + 900])
+            bump_versions(conn, table)
+        return ids
+
+    @traced("replace_composition")
+    def replace_composition(self, product_id, materials=(), processes=(), thirds=(), components=()):
+        # materials/thirds: (nome, quantidade); processes: (nome, horas);
+        # components: (component_product_id, quantidade). Unknown names are
+        # created with zero price, everything in a single transaction.
+        materials = [(str(n).strip(), q) for n, q in materials if str(n or "").strip()]
+        processes = [(str(n).strip(), h) for n, h in processes if str(n or "").strip()]
+        thirds = [(str(n).strip(), q) for n, q in thirds if str(n or "").strip()]
+        hoje = datetime.now().strftime("%Y-%m-%d")
+        with self.transaction() as conn:
+            _check_acyclic(conn, product_id, [c for c, _q in components])
+            mat_ids = self._get_or_create_names(
+                conn, "vertical_materials", [n for n, _q in materials],
+                "INSERT INTO vertical_materials (grupo, subgrupo, nome, ncm, unidade, preco_unitario, fornecedor, data_atualizacao) VALUES (?,?,?,?,?,?,?,?)",
+                lambda n: ("", "", n, "", "un", 0.0, "", hoje),
+            )
+            proc_ids = self._get_or_create_names(
+                conn, "vertical_processes", [n for n, _h in processes],
+                "INSERT INTO vertical_processes (grupo, subgrupo, nome, preco_unitario_hora, unidade, origem) VALUES (?,?,?,?,?,?)",
+                lambda n: ("", "", n, 0.0, "hora", "Manual"),
+            )
+            th_ids = self._get_or_create_names(
+                conn, "third_party_items", [n for n, _q in thirds],
+                "INSERT INTO third_party_items (nome, preco_unitario, quantidade_padrao, fornecedor, unidade) VALUES (?,?,?,?,?)",
+                lambda n: (n, 0.0, 1.0, "", "serviço"),
+            )
+            conn.execute("DELETE FROM materials_usage WHERE product_id=?", (product_id,))
+            conn.execute("DELETE FROM processes_usage WHERE product_id=?", (product_id,))
+            conn.execute("DELETE FROM third_usage WHERE product_id=?", (product_id,))
+            conn.execute("DELETE FROM product_components WHERE parent_product_id=?", (product_id,))
+            conn.executemany("INSERT INTO materials_usage (product_id, material_id, quantidade) VALUES (?,?,?)",
+                             [(product_id, mat_ids[n], q) for n, q in materials])
+            conn.executemany("INSERT INTO processes_usage (product_id, process_id, horas) VALUES (?,?,?)",
+                             [(product_id, proc_ids[n], h) for n, h in processes])
+            conn.executemany("INSERT INTO third_usage (product_id, third_id, quantidade) VALUES (?,?,?)",
+                             [(product_id, th_ids[n], q) for n, q in thirds])
+            conn.executemany("INSERT INTO product_components (parent_product_id, component_product_id, quantidade) VALUES (?,?,?)",
+                             [(product_id, c, q) for c, q in components])
+            refresh_closure(conn, [product_id])
+            bump_versions(conn, "materials_usage", "processes_usage", "third_usage", "product_components")
 
     def link_product_client(self, product_id, client_id, margem=0.0, preco_final=0.0):
-        conn = self.connect()
-        cur = conn.cursor()
-        cur.execute("SELECT id FROM product_clients WHERE product_id=? AND client_id=?", (product_id, client_id))
-        row = cur.fetchone()
-        data_vinculo = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        if row:
-            cur.execute("UPDATE product_clients SET margem=?, preco_final=?, data_vinculo=? WHERE id=?", (margem, preco_final, data_vinculo, row[0]))
-        else:
-            cur.execute("INSERT INTO product_clients (product_id, client_id, margem, preco_final, data_vinculo) VALUES (?,?,?,?,?)", (product_id, client_id, margem, preco_final, data_vinculo))
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            data_vinculo = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            conn.execute(
+                "INSERT INTO product_clients (product_id, client_id, margem, preco_final, data_vinculo) VALUES (?,?,?,?,?) "
+                "ON CONFLICT(product_id, client_id) DO UPDATE SET margem=excluded.margem, preco_final=excluded.preco_final, data_vinculo=excluded.data_vinculo",
+                (product_id, client_id, margem, preco_final, data_vinculo),
+            )
+            bump_versions(conn, "product_clients")
 
     def add_cost_history(self, product_id, client_id, custo_materiais, custo_processos, custo_terceiros, custos_admin, impostos, preco_final, margem, data_vinculo=None):
-        conn = self.connect()
-        cur = conn.cursor()
+        # Returns False when the snapshot repeats the latest one and was skipped
         if data_vinculo is None:
             data_vinculo = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         custo_total_sem_impostos = (custo_materiais or 0) + (custo_processos or 0) + (custo_terceiros or 0) + (custos_admin or 0)
-        cur.execute(
-            """
-            INSERT INTO product_cost_history (
-                product_id, client_id, data_vinculo,
-                custo_materiais, custo_processos, custo_terceiros,
-                custos_admin, impostos, custo_total_sem_impostos,
-                preco_final, margem
-            ) VALUES (?,?,?,?,?,?,?,?,?,?,?)
-            """,
-            (
-                product_id,
-                client_id,
-                data_vinculo,
-                float(custo_materiais or 0),
-                float(custo_processos or 0),
-                float(custo_terceiros or 0),
-                float(custos_admin or 0),
-                float(impostos or 0),
-                float(custo_total_sem_impostos),
-                float(preco_final or 0),
-                float(margem or 0),
-            ),
-        )
-        conn.commit()
-        conn.close()
+        values = (custo_materiais, custo_processos, custo_terceiros, custos_admin, impostos, custo_total_sem_impostos, preco_final, margem)
+        with self.transaction() as conn:
+            cur = conn.execute(COST_HISTORY_INSERT, (product_id, client_id, data_vinculo) + tuple(float(v or 0) for v in values))
+            if cur.rowcount:
+                bump_versions(conn, "product_cost_history")
+            return cur.rowcount > 0
 
     def unlink_product_client(self, product_id, client_id):
-        conn = self.connect()
-        conn.execute("DELETE FROM product_clients WHERE product_id=? AND client_id=?", (product_id, client_id))
-        conn.commit()
-        conn.close()
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM product_clients WHERE product_id=? AND client_id=?", (product_id, client_id))
+            bump_versions(conn, "product_clients")
+
+    @traced("apply_changes")
+    def apply_changes(self, table, original, edited):
+        # Writes only the rows diff_frames found; returns the affected ids per
+        # kind so callers can invalidate caches (e.g. CostRollup.propagate)
+        changes = diff_frames(table, original, edited)
+        columns = changes["columns"]
+        result = {"inserted": [], "updated": [int(i) for i in changes["updated"].index], "deleted": changes["deleted"]}
+        with self.transaction() as conn:
+            if changes["deleted"]:
+                conn.executemany(f"DELETE FROM {table} WHERE id=?", [(i,) for i in changes["deleted"]])
+            if result["updated"]:
+                conn.executemany(
+                    f"UPDATE {table} SET {', '.join(c + '=?' for c in columns)} WHERE id=?",
+                    [values + [i] for i, values in zip(result["updated"], changes["updated"][columns].to_numpy(dtype=object).tolist())],
+                )
+            with_id, without_id = [], []
+            for row in changes["inserted"].to_numpy(dtype=object).tolist():
+                if pd.isna(row[0]):
+                    without_id.append(row[1:])
+                else:
+                    with_id.append([int(row[0])] + row[1:])
+            if with_id:
+                conn.executemany(f"INSERT INTO {table} (id, {', '.join(columns)}) VALUES ({','.join('?' * (len(columns) + 1))})", with_id)
+                result["inserted"] += [r[0] for r in with_id]
+            if without_id:
+                # The write lock is held, so every id above the current MAX(id)
+                # afterwards is one of these rows
+                last = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+                conn.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({','.join('?' * len(columns))})", without_id)
+                result["inserted"] += [r[0] for r in conn.execute(f"SELECT id FROM {table} WHERE id > ? ORDER BY id", (last,)).fetchall()]
+            if changes["deleted"]:
+                bump_versions(conn, table, *child_tables(table))
+            elif result["updated"] or result["inserted"]:
+                bump_versions(conn, table)
+        return result
+
+    def save_scenario(self, nome, ajustes, descricao=""):
+        # Creates or replaces the scenario named nome; ajustes are dicts with
+        # categoria, alvo, valor, tipo and ajuste
+        rows = []
+        for a in ajustes:
+            categoria, alvo, tipo = a["categoria"], a["alvo"], a["tipo"]
+            if alvo not in SCENARIO_TARGETS.get(categoria, ()):
+                raise ValueError(f"Ajuste inválido: {categoria} não aceita alvo '{alvo}'")
+            if tipo not in SCENARIO_TYPES:
+                raise ValueError(f"Tipo de ajuste inválido: {tipo}")
+            valor = str(a["valor"]).strip()
+            if alvo == "id" and not valor.isdigit():
+                raise ValueError(f"Id inválido no ajuste de {categoria}: {valor}")
+            rows.append((categoria, alvo, valor, tipo, float(a["ajuste"])))
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT INTO scenarios (nome, descricao, criado_em) VALUES (?,?,?) ON CONFLICT(nome) DO UPDATE SET descricao=excluded.descricao",
+                (nome, descricao, datetime.now().strftime("%Y-%m-%d %H:%M:%S")),
+            )
+            scenario_id = conn.execute("SELECT id FROM scenarios WHERE nome=?", (nome,)).fetchone()[0]
+            conn.execute("DELETE FROM scenario_adjustments WHERE scenario_id=?", (scenario_id,))
+            conn.executemany(
+                "INSERT INTO scenario_adjustments (scenario_id, categoria, alvo, valor, tipo, ajuste) VALUES (?,?,?,?,?,?)",
+                [(scenario_id,) + r for r in rows],
+            )
+            bump_versions(conn, "scenarios", "scenario_adjustments")
+        return scenario_id
+
+    def delete_scenario(self, scenario_id):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM scenarios WHERE id=?", (scenario_id,))
+            bump_versions(conn, "scenarios", "scenario_adjustments")
+
+    def explode(self, product_id):
+        # Every component below product_id, with the quantity per unit of it
+        conn = self.connection()
+        return conn.execute(
+            """SELECT pc.descendant_id AS product_id, p.codigo, p.nome, pc.depth, pc.quantidade
+               FROM product_closure pc JOIN products p ON p.id=pc.descendant_id
+               WHERE pc.ancestor_id=? ORDER BY pc.depth, p.id""",
+            (product_id,),
+        ).fetchall()
+
+    def where_used(self, product_id):
+        # Every product that contains product_id, with how many units it takes
+        conn = self.connection()
+        return conn.execute(
+            """SELECT pc.ancestor_id AS product_id, p.codigo, p.nome, pc.depth, pc.quantidade
+               FROM product_closure pc JOIN products p ON p.id=pc.ancestor_id
+               WHERE pc.descendant_id=? ORDER BY pc.depth, p.id""",
+            (product_id,),
+        ).fetchall()
+
+    def search(self, table, text, k=20):
+        return search(self.connection(), table, text, k)
+
+    def versions(self, tables=None):
+        conn = self.connection()
+        v = read_versions(conn, tables)
+        return v
 
     def get_products_by_client(self, client_id):
-        conn = self.connect()
+        conn = self.connection()
         cur = conn.cursor()
         cur.execute("""SELECT p.id, p.codigo, p.nome FROM products p 
                        JOIN product_clients pc ON pc.product_id=p.id 
                        WHERE pc.client_id=?""", (client_id,))
         rows = cur.fetchall()
-        conn.close()
         return rows
 
     def add_user(self, nome, email, senha_hash, role="cliente"):
-        conn = self.connect()
-        cur = conn.cursor()
-        cur.execute("INSERT INTO users (nome, email, senha_hash, role) VALUES (?,?,?,?)", (nome, email, senha_hash, role))
-        conn.commit()
-        uid = cur.lastrowid
-        conn.close()
+        with self.transaction() as conn:
+            cur = conn.cursor()
+            cur.execute("INSERT INTO users (nome, email, senha_hash, role) VALUES (?,?,?,?)", (nome, email, senha_hash, role))
+            uid = cur.lastrowid
         return uid
 
+    def add_users(self, users, update_existing=False):
+        # users: (nome, email, senha_hash, role) rows, written in one
+        # transaction; an email already registered is left alone, or with
+        # update_existing gets the row's nome, senha_hash and role.
+        # Returns {"inseridos", "atualizados", "ignorados"}
+        users = list(users)
+        conflict = "DO UPDATE SET nome=excluded.nome, senha_hash=excluded.senha_hash, role=excluded.role" if update_existing else "DO NOTHING"
+        with self.transaction() as conn:
+            count = "SELECT COUNT(*) FROM users"
+            before, changes = conn.execute(count).fetchone()[0], conn.total_changes
+            conn.executemany(f"INSERT INTO users (nome, email, senha_hash, role) VALUES (?,?,?,?) ON CONFLICT(email) {conflict}", users)
+            written = conn.total_changes - changes
+            inserted = conn.execute(count).fetchone()[0] - before
+        return {"inseridos": inserted, "atualizados": written - inserted, "ignorados": len(users) - written}
+
+    def set_password_hash(self, user_id, senha_hash):
+        with self.transaction() as conn:
+            conn.execute("UPDATE users SET senha_hash=? WHERE id=?", (senha_hash, user_id))
+
     def get_user_by_email(self, email):
-        conn = self.connect()
+        conn = self.connection()
         cur = conn.cursor()
         cur.execute("SELECT id, nome, email, senha_hash, role FROM users WHERE email=?", (email,))
         row = cur.fetchone()
-        conn.close()
         return row
 
     def add_appointment(self, user_id, data_hora, observacao, status="pendente"):
-        conn = self.connect()
-        cur = conn.cursor()
-        cur.execute("INSERT INTO appointments (user_id, data_hora, observacao, status) VALUES (?,?,?,?)", (user_id, data_hora, observacao, status))
-        conn.commit()
-        aid = cur.lastrowid
-        conn.close()
+        with self.transaction() as conn:
+            cur = conn.cursor()
+            cur.execute("INSERT INTO appointments (user_id, data_hora, observacao, status) VALUES (?,?,?,?)", (user_id, data_hora, observacao, status))
+            aid = cur.lastrowid
         return aid
 
     def list_appointments(self, user_id=None):
-        conn = self.connect()
+        conn = self.connection()
         if user_id:
             df = conn.execute("SELECT id, user_id, data_hora, observacao, status FROM appointments WHERE user_id=?", (user_id,)).fetchall()
         else:
             df = conn.execute("SELECT id, user_id, data_hora, observacao, status FROM appointments").fetchall()
-        conn.close()
         return df
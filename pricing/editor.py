@@ -0,0 +1,63 @@
+import math
+import streamlit as st
+from pricing.db import EDITABLE_TABLES
+from pricing.frames import count_rows, filter_options, load_page, version_stamp
+
+# Paginated, filterable st.data_editor for the EDITABLE_TABLES. Only one page
+# (LIMIT/OFFSET in id order) reaches the browser; the returned (page, edited)
+# pair goes to Database.apply_changes, so a save touches only that page's
+# changed rows. Queries are cached on the table's table_versions generation.
+
+PAGE_SIZES = (50, 100, 200, 500)
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _options(_conn, table, column, stamp):
+    return filter_options(_conn, table, column)
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _count(_conn, table, stamp, filtros, busca):
+    return count_rows(_conn, table, filtros, busca)
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def _page(_conn, table, stamp, filtros, busca, offset, limit):
+    return load_page(_conn, table, filtros, busca, offset, limit)
+
+def paged_editor(db, table, key, column_config=None):
+    conn = db.connection()
+    spec = EDITABLE_TABLES[table]
+    stamp = version_stamp(conn).of((table,))
+    filters, prefixes = spec.get("filters", []), spec.get("prefix", [])
+    cols = st.columns(len(filters) + len(prefixes) + 1)
+    filtros = []
+    for col, column in zip(cols, filters):
+        escolha = col.selectbox(
+            column, [None] + _options(conn, table, column, stamp), key=f"{key}_filtro_{column}",
+            format_func=lambda v: "(todos)" if v is None else (v or "(vazio)"),
+        )
+        if escolha is not None:
+            filtros.append((column, escolha))
+    for col, column in zip(cols[len(filters):], prefixes):
+        valor = col.text_input(f"{column} começa com", key=f"{key}_prefixo_{column}").strip()
+        if valor:
+            filtros.append((column, valor))
+    busca = cols[-1].text_input("Buscar", key=f"{key}_busca").strip()
+    filtros = tuple(filtros)
+
+    total = _count(conn, table, stamp, filtros, busca)
+    c1, c2, c3 = st.columns([1, 1, 3])
+    tamanho = c2.selectbox("Linhas por página", PAGE_SIZES, index=1, key=f"{key}_tamanho")
+    paginas = max(1, math.ceil(total / tamanho))
+    consulta = (filtros, busca, tamanho)
+    if st.session_state.get(f"{key}_consulta") != consulta or st.session_state.get(f"{key}_pagina", 1) > paginas:
+        # New filters (or fewer pages after a delete): back to the first page
+        st.session_state[f"{key}_consulta"] = consulta
+        st.session_state[f"{key}_pagina"] = 1
+    pagina = int(c1.number_input("Página", min_value=1, max_value=paginas, step=1, key=f"{key}_pagina"))
+    c3.caption(f"{total:,} registros — página {pagina} de {paginas}")
+    page = _page(conn, table, stamp, filtros, busca, (pagina - 1) * tamanho, tamanho)
+    # The key changes with the page and the data, so edits never carry over
+    edited = st.data_editor(
+        page, num_rows="dynamic", column_config=column_config,
+        key=f"{key}_editor_{stamp}_{filtros}_{busca}_{pagina}_{tamanho}",
+    )
+    return page, edited
@@ -1,10 +1,20 @@
 import sqlite3
+import threading
 from decimal import Decimal, ROUND_HALF_UP
+import numpy as np
+import pandas as pd
+from pricing.db import bump_versions, read_versions
+from pricing.instrument import stage, traced
 
 def _d(x):
     return Decimal(str(x))
 
-def get_base_cost(conn, product_id):
+def get_base_cost(conn, product_id, rollup=None):
+    # rollup: CostRollup (or any object with get/put) answering from memory
+    if rollup is not None:
+        cached = rollup.get(product_id)
+        if cached is not None:
+            return cached
     cur = conn.cursor()
     cur.execute("""SELECT mu.quantidade, vm.preco_unitario FROM materials_usage mu JOIN vertical_materials vm ON mu.material_id=vm.id WHERE mu.product_id=?""", (product_id,))
     custo_materiais = sum((_d(r[0]) * _d(r[1]) for r in cur.fetchall()), _d(0))
@@ -24,7 +34,7 @@ def get_base_cost(conn, product_id):
         comp_id = comp[0]
         comp_qty = _d(comp[1])
         # Recursive call
-        comp_cost = get_base_cost(conn, comp_id)
+        comp_cost = get_base_cost(conn, comp_id, rollup)
         custo_componentes_materiais += comp_cost["materiais"] * comp_qty
         custo_componentes_processos += comp_cost["processos"] * comp_qty
         custo_componentes_terceiros += comp_cost["terceiros"] * comp_qty
@@ -45,7 +55,7 @@ def get_base_cost(conn, product_id):
     # So we only roll up Mat, Proc, Third.
 
     custo_sem_impostos = total_materiais + total_processos + total_terceiros + custo_admin
-    return {
+    result = {
         "materiais": total_materiais,
         "processos": total_processos,
         "terceiros": total_terceiros,
@@ -55,8 +65,96 @@ def get_base_cost(conn, product_id):
         "own_processos": custo_processos,
         "own_terceiros": custo_terceiros
     }
+    if rollup is not None:
+        rollup.put(product_id, result)
+    return result
+
+class TaxResolver:
+    # clients and ncm_taxes held in memory, rates resolved once per
+    # (ncm, origem_uf, destino_uf, client_id); check() reloads everything when
+    # the write generation of either table moves
+    TABLES = ("clients", "ncm_taxes")
+
+    def __init__(self):
+        self.clients = {}
+        self.ncm_rates = {}
+        self._memo = {}
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, conn):
+        resolver = cls()
+        resolver.check(conn)
+        return resolver
+
+    def check(self, conn):
+        stamp = read_versions(conn, self.TABLES)
+        if stamp == self._stamp:
+            return True
+        cur = conn.cursor()
+        # Raw values: rates() converts them, so a row with NULL rates fails
+        # only the quotes that use it, as _tax_rate_for_product does
+        clients = {r[0]: (r[1], r[2], r[3], r[4]) for r in cur.execute("SELECT id, regime, pis, cofins, icms FROM clients").fetchall()}
+        ncm_rates = {}
+        for ncm, pis, cofins, icms in cur.execute("SELECT ncm, pis, cofins, icms FROM ncm_taxes ORDER BY id").fetchall():
+            ncm_rates.setdefault(ncm, (pis, cofins, icms))
+        with self._lock:
+            self.clients = clients
+            self.ncm_rates = ncm_rates
+            self._memo = {}
+            self._stamp = stamp
+        return False
 
-def _tax_rate_for_product(conn, product_id, client_id):
+    def rates(self, ncm, origem_uf, destino_uf, client_id):
+        # One consistent snapshot: a concurrent check() swaps all three
+        # together, so a result is never mixed or memoized into the new dict
+        with self._lock:
+            clients, ncm_rates, memo = self.clients, self.ncm_rates, self._memo
+        key = (ncm, origem_uf, destino_uf, client_id)
+        taxa = memo.get(key)
+        if taxa is None:
+            if client_id not in clients:
+                raise KeyError(f"IDs não encontrados: {[client_id]}")
+            regime, *client_rates = clients[client_id]
+            pis, cofins, icms = (_d(v) for v in client_rates)
+            if ncm in ncm_rates:
+                pis, cofins, icms = (_d(v) for v in ncm_rates[ncm])
+            if origem_uf != destino_uf:
+                icms = _d("0.12")
+            taxa = {"pis": pis, "cofins": cofins, "icms": icms, "total": pis + cofins + icms, "regime": regime}
+            memo[key] = taxa
+        return taxa
+
+    def for_product(self, conn, product_id, client_id):
+        p = conn.execute("SELECT ncm, local_fabricacao_uf, destino_uf FROM products WHERE id=?", (product_id,)).fetchone()
+        if p is None:
+            raise KeyError(f"IDs não encontrados: {[product_id]}")
+        return self.rates(p[0], p[1], p[2], client_id)
+
+    def grid(self, conn, product_ids, client_ids):
+        # P x C matrices of pis/cofins/icms/total for price_grid
+        products = {}
+        ids = [int(p) for p in product_ids]
+        for i in range(0, len(ids), 900):
+            chunk = ids[i:i + 900]
+            for r in conn.execute(f"SELECT id, ncm, local_fabricacao_uf, destino_uf FROM products WHERE id IN ({','.join('?' * len(chunk))})", chunk).fetchall():
+                products[r[0]] = (r[1], r[2], r[3])
+        missing = [p for p in ids if p not in products] or [int(c) for c in client_ids if int(c) not in self.clients]
+        if missing:
+            raise KeyError(f"IDs não encontrados: {missing[:20]}")
+        shape = (len(ids), len(client_ids))
+        rates = {k: np.empty(shape) for k in ("pis", "cofins", "icms", "total")}
+        for i, pid in enumerate(ids):
+            for j, cid in enumerate(client_ids):
+                taxa = self.rates(*products[pid], int(cid))
+                for k in rates:
+                    rates[k][i, j] = float(taxa[k])
+        return rates
+
+def _tax_rate_for_product(conn, product_id, client_id, taxes=None):
+    if taxes is not None:
+        return taxes.for_product(conn, product_id, client_id)
     cur = conn.cursor()
     cur.execute("SELECT destino_uf, ncm, local_fabricacao_uf FROM products WHERE id=?", (product_id,))
     p = cur.fetchone()
@@ -80,8 +178,10 @@ def _tax_rate_for_product(conn, product_id, client_id):
     total = pis + cofins + icms
     return {"pis": pis, "cofins": cofins, "icms": icms, "total": total, "regime": regime}
 
-def suggest_sale_price(conn, product_id, client_id, margem_percentual, admin_pct=0.0, frete_pct=0.0, outros_pct=0.0):
-    base_bruto = get_base_cost(conn, product_id)
+@traced("suggest_sale_price")
+def suggest_sale_price(conn, product_id, client_id, margem_percentual, admin_pct=0.0, frete_pct=0.0, outros_pct=0.0, rollup=None, taxes=None):
+    with stage("rollup"):
+        base_bruto = get_base_cost(conn, product_id, rollup)
     base_core = base_bruto["materiais"] + base_bruto["processos"] + base_bruto["terceiros"]
     perc_total = _d(admin_pct) + _d(frete_pct) + _d(outros_pct)
     custo_admin_calc = (base_core * (perc_total / _d(100))) if perc_total > _d(0) else base_bruto["administrativos"]
@@ -93,11 +193,13 @@ def suggest_sale_price(conn, product_id, client_id, margem_percentual, admin_pct
         "administrativos": custo_admin_calc,
         "sem_impostos": custo_sem_impostos,
     }
-    taxa = _tax_rate_for_product(conn, product_id, client_id)
-    margem = _d(margem_percentual) / _d(100)
-    preco = base["sem_impostos"] / (_d(1) - margem - taxa["total"])
-    impostos_valor = preco * taxa["total"]
-    margem_real = (preco - base["sem_impostos"] - impostos_valor) / preco * _d(100)
+    with stage("impostos"):
+        taxa = _tax_rate_for_product(conn, product_id, client_id, taxes)
+    with stage("preco"):
+        margem = _d(margem_percentual) / _d(100)
+        preco = base["sem_impostos"] / (_d(1) - margem - taxa["total"])
+        impostos_valor = preco * taxa["total"]
+        margem_real = (preco - base["sem_impostos"] - impostos_valor) / preco * _d(100)
     return {
         "preco_venda": preco.quantize(_d("0.01"), rounding=ROUND_HALF_UP),
         "margem_real_percent": margem_real.quantize(_d("0.01"), rounding=ROUND_HALF_UP),
@@ -107,11 +209,106 @@ def suggest_sale_price(conn, product_id, client_id, margem_percentual, admin_pct
         "regime": taxa["regime"],
     }
 
+PRICE_GRID_MONEY = ["materiais", "processos", "terceiros", "administrativos", "sem_impostos", "preco_venda", "impostos_valor"]
+
+def _round_cents(values):
+    # ROUND_HALF_UP to cents on float64; flags values too close to a half cent
+    # for float error to be ruled out, so the caller can redo them in Decimal
+    scaled = np.asarray(values, dtype=float) * 100.0
+    mag = np.abs(scaled)
+    frac = mag - np.floor(mag)
+    ambiguous = np.abs(frac - 0.5) < np.maximum(1e-7, mag * 1e-12)
+    return np.sign(scaled) * np.floor(mag + 0.5) / 100.0, ambiguous
+
+@traced("price_grid")
+def price_grid(conn, product_ids, client_ids, margens, admin_pct=0.0, frete_pct=0.0, outros_pct=0.0, rollup=None, taxes=None):
+    # Prices every (product, client, margin) combination in one vectorized pass.
+    # Costs come from a single CostRollup; cents match suggest_sale_price exactly.
+    from pricing.rollup import CostRollup
+    product_ids = np.asarray(product_ids, dtype=np.int64).ravel()
+    client_ids = np.asarray(client_ids, dtype=np.int64).ravel()
+    margens = np.asarray(margens, dtype=float).ravel()
+    perc_total = _d(admin_pct) + _d(frete_pct) + _d(outros_pct)
+    base = {k: np.empty(len(product_ids)) for k in PRICE_GRID_MONEY[:5]}
+    sem_exato = np.empty(len(product_ids))
+    with stage("rollup"):
+        if rollup is None:
+            rollup = CostRollup.load(conn)
+        for i, pid in enumerate(product_ids):
+            b = get_base_cost(conn, int(pid), rollup)
+            core = b["materiais"] + b["processos"] + b["terceiros"]
+            admin = (core * (perc_total / _d(100))) if perc_total > _d(0) else b["administrativos"]
+            for k, v in zip(PRICE_GRID_MONEY[:5], (b["materiais"], b["processos"], b["terceiros"], admin, core + admin)):
+                base[k][i] = float(v.quantize(_d("0.01"), rounding=ROUND_HALF_UP))
+            sem_exato[i] = float(core + admin)
+    with stage("impostos"):
+        if taxes is None:
+            taxes = TaxResolver.load(conn)
+        rates = taxes.grid(conn, product_ids, client_ids)
+
+    with stage("preco"):
+        return _price_grid_rows(conn, product_ids, client_ids, margens, base, sem_exato, rates, admin_pct, frete_pct, outros_pct, rollup, taxes)
+
+def _price_grid_rows(conn, product_ids, client_ids, margens, base, sem_exato, rates, admin_pct, frete_pct, outros_pct, rollup, taxes):
+    n_p, n_c, n_m = len(product_ids), len(client_ids), len(margens)
+    pi, ci, mi = (a.ravel() for a in np.meshgrid(np.arange(n_p), np.arange(n_c), np.arange(n_m), indexing="ij"))
+    sem = sem_exato[pi]
+    taxa = rates["total"][pi, ci]
+    margem = margens[mi]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        preco = sem / (1.0 - margem / 100.0 - taxa)
+        impostos = preco * taxa
+        margem_real = (preco - sem - impostos) / preco * 100.0
+    preco_r, amb_p = _round_cents(preco)
+    impostos_r, amb_i = _round_cents(impostos)
+    margem_real_r, amb_m = _round_cents(margem_real)
+
+    out = pd.DataFrame({
+        "product_id": product_ids[pi],
+        "client_id": client_ids[ci],
+        "margem": margem,
+        "materiais": base["materiais"][pi],
+        "processos": base["processos"][pi],
+        "terceiros": base["terceiros"][pi],
+        "administrativos": base["administrativos"][pi],
+        "sem_impostos": base["sem_impostos"][pi],
+        "pis": rates["pis"][pi, ci],
+        "cofins": rates["cofins"][pi, ci],
+        "icms": rates["icms"][pi, ci],
+        "taxa_total": taxa,
+        "preco_venda": preco_r,
+        "impostos_valor": impostos_r,
+        "margem_real_percent": margem_real_r,
+    })
+    # Half-cent ties the float path cannot decide are redone with the scalar Decimal path
+    for row in np.flatnonzero((amb_p | amb_i | amb_m) & np.isfinite(margem_real)):
+        res = suggest_sale_price(conn, int(out.at[row, "product_id"]), int(out.at[row, "client_id"]), float(out.at[row, "margem"]), admin_pct, frete_pct, outros_pct, rollup=rollup, taxes=taxes)
+        out.loc[row, ["preco_venda", "impostos_valor", "margem_real_percent"]] = [float(res["preco_venda"]), float(res["impostos_valor"]), float(res["margem_real_percent"])]
+    return out
+
+def check_price_parity(conn, grid, admin_pct=0.0, frete_pct=0.0, outros_pct=0.0, sample=None, rollup=None, taxes=None):
+    # Re-prices rows of a price_grid result through suggest_sale_price and
+    # returns the ones that differ by any cent (empty DataFrame means parity).
+    rows = grid if sample is None or sample >= len(grid) else grid.sample(n=sample, random_state=0)
+    fields = ["preco_venda", "impostos_valor", "margem_real_percent"] + PRICE_GRID_MONEY[:5]
+    bad = []
+    for idx, r in rows.iterrows():
+        try:
+            res = suggest_sale_price(conn, int(r["product_id"]), int(r["client_id"]), float(r["margem"]), admin_pct, frete_pct, outros_pct, rollup=rollup, taxes=taxes)
+        except ArithmeticError:
+            if not np.isfinite(r["margem_real_percent"]):
+                continue
+            bad.append(idx)
+            continue
+        expected = [res["preco_venda"], res["impostos_valor"], res["margem_real_percent"]] + [res["base"][k] for k in PRICE_GRID_MONEY[:5]]
+        if any(_d(r[f]).quantize(_d("0.01"), rounding=ROUND_HALF_UP) != e for f, e in zip(fields, expected)):
+            bad.append(idx)
+    return rows.loc[bad]
+
 def import_planilha_processos(conn, rows):
-    cur = conn.cursor()
-    for r in rows:
-        cur.execute(
-            "INSERT INTO vertical_processes (grupo, subgrupo, nome, preco_unitario_hora, unidade, origem) VALUES (?,?,?,?,?,?)",
-            (r.get("grupo") or "", r.get("subgrupo") or "", r["nome"], float(r["preco_unitario_hora"]), r.get("unidade") or "hora", "Planilha 1")
-        )
+    conn.executemany(
+        "INSERT INTO vertical_processes (grupo, subgrupo, nome, preco_unitario_hora, unidade, origem) VALUES (?,?,?,?,?,?)",
+        ((r.get("grupo") or "", r.get("subgrupo") or "", r["nome"], float(r["preco_unitario_hora"]), r.get("unidade") or "hora", "Planilha 1") for r in rows),
+    )
+    bump_versions(conn, "vertical_processes")
     conn.commit()
@@ -0,0 +1,163 @@
+import time
+from itertools import islice
+import pandas as pd
+from openpyxl import load_workbook
+from pricing.db import bump_versions
+from pricing.instrument import traced
+
+MATERIALS_INSERT = "INSERT INTO vertical_materials (grupo, subgrupo, nome, ncm, unidade, preco_unitario, fornecedor, data_atualizacao) VALUES (?,?,?,?,?,?,?,?)"
+PROCESSES_INSERT = "INSERT INTO vertical_processes (grupo, subgrupo, nome, preco_unitario_hora, unidade, origem) VALUES (?,?,?,?,?,?)"
+
+def _picker(cols):
+    lc = [c.lower() for c in cols]
+    def pick(keys):
+        for k in keys:
+            for i, c in enumerate(lc):
+                if k in c:
+                    return cols[i]
+        return None
+    return pick, lc
+
+def detect_layout(columns):
+    # Column auto-detection, run once on the header: ("materiais" | "processos", {campo: coluna})
+    cols = [str(c) for c in columns]
+    pick, lc = _picker(cols)
+    is_materials = any("insumo" in x or "matéria" in x or "materia" in x for x in lc) or (pick(("nome_insumo", "insumo")) is not None and pick(("custo_unit", "custo_unitario", "preco_unitario")) is not None)
+    if is_materials:
+        return "materiais", {
+            "grupo": pick(("grupo",)),
+            "subgrupo": pick(("subgrupo",)),
+            "nome": pick(("nome_insumo", "insumo", "nome")) or cols[0],
+            "ncm": pick(("ncm",)),
+            "unidade": pick(("unidade", "unit")),
+            "preco_unitario": pick(("custo_unitario", "preco_unitario", "valor_unitario")),
+            "fornecedor": pick(("fornecedor",)),
+        }
+    return "processos", {
+        "grupo": pick(("grupo",)),
+        "subgrupo": pick(("subgrupo",)),
+        "nome": pick(("nome", "processo", "operacao")) or cols[0],
+        "preco_hora": pick(("preco_hora", "valor_hora", "custo_hora")),
+        "preco_minuto": pick(("preco_minuto", "valor_minuto", "custo_minuto")),
+        "unidade": pick(("unidade", "unit")),
+    }
+
+def _text(chunk, column, default=""):
+    if column is None:
+        return pd.Series(default, index=chunk.index, dtype=object)
+    col = chunk[column].astype(object)
+    return col.where(col.notna() & (col != ""), default)
+
+def _money(chunk, column, factor=1.0):
+    if column is None:
+        return pd.Series(0.0, index=chunk.index)
+    return (pd.to_numeric(chunk[column], errors="coerce").fillna(0.0) * factor).round(2)
+
+def map_chunk(chunk, kind, layout):
+    # Raw ERP rows -> the vertical_* columns, vectorized over the whole chunk
+    chunk.columns = [str(c) for c in chunk.columns]
+    if kind == "materiais":
+        return pd.DataFrame({
+            "grupo": _text(chunk, layout["grupo"]),
+            "subgrupo": _text(chunk, layout["subgrupo"]),
+            "nome": _text(chunk, layout["nome"]),
+            "ncm": _text(chunk, layout["ncm"]),
+            "unidade": _text(chunk, layout["unidade"], "un"),
+            "preco_unitario": _money(chunk, layout["preco_unitario"]),
+            "fornecedor": _text(chunk, layout["fornecedor"]),
+            "data_atualizacao": pd.Timestamp.now().strftime("%Y-%m-%d"),
+        })
+    if layout["preco_hora"] is None and layout["preco_minuto"] is not None:
+        preco = _money(chunk, layout["preco_minuto"], 60.0)
+    else:
+        preco = _money(chunk, layout["preco_hora"])
+    return pd.DataFrame({
+        "grupo": _text(chunk, layout["grupo"]),
+        "subgrupo": _text(chunk, layout["subgrupo"]),
+        "nome": _text(chunk, layout["nome"]),
+        "preco_unitario_hora": preco,
+        "unidade": _text(chunk, layout["unidade"], "hora"),
+        "origem": "Planilha 1",
+    })
+
+def _count_csv_rows(f):
+    # Data rows by counting line breaks in one constant-memory pass; exact
+    # unless quoted fields span lines (then the fraction runs a little short)
+    pos = f.tell()
+    lines = 0
+    last = None
+    while True:
+        block = f.read(1 << 20)
+        if not block:
+            break
+        nl = b"\n" if isinstance(block, bytes) else "\n"
+        lines += block.count(nl)
+        last = block[-1:]
+    f.seek(pos)
+    if last is not None and last not in (b"\n", "\n"):
+        lines += 1
+    return max(lines - 1, 0)
+
+def iter_chunks(f, filename, chunksize=50000, track=True):
+    # Yields (DataFrame, fraction of data rows consumed or None); only one
+    # chunk is held in memory. track=False skips the row count (previews).
+    if filename.lower().endswith(".xlsx"):
+        wb = load_workbook(f, read_only=True, data_only=True)
+        try:
+            ws = wb.active
+            rows = ws.iter_rows(values_only=True)
+            header = [str(c) if c is not None else f"coluna_{i + 1}" for i, c in enumerate(next(rows, ()))]
+            total = (ws.max_row - 1) if ws.max_row else None
+            done = 0
+            while True:
+                batch = [r for r in islice(rows, chunksize) if any(v is not None for v in r)]
+                if not batch:
+                    break
+                done += len(batch)
+                yield pd.DataFrame(batch, columns=header), (min(done / total, 1.0) if total else None)
+        finally:
+            wb.close()
+    else:
+        # f.tell() would measure pandas' read-ahead buffer, not parsed rows
+        total = _count_csv_rows(f) if track else None
+        done = 0
+        with pd.read_csv(f, chunksize=chunksize) as reader:
+            for chunk in reader:
+                done += len(chunk)
+                yield chunk, (min(done / total, 1.0) if total else None)
+
+def preview_erp_file(f, filename, nrows=200):
+    chunks = iter_chunks(f, filename, chunksize=nrows, track=False)
+    try:
+        chunk, _fraction = next(chunks, (None, None))
+    finally:
+        chunks.close()
+        f.seek(0)
+    if chunk is None:
+        return None, pd.DataFrame()
+    kind, layout = detect_layout(chunk.columns)
+    return kind, map_chunk(chunk, kind, layout)
+
+@traced("import_erp_file")
+def import_erp_file(db, f, filename, chunksize=50000, progress=None):
+    # One db.transaction() per chunk: readers see whole chunks and the write
+    # lock is released between them. progress(linhas, fração ou None, linhas/s)
+    kind = layout = None
+    total = 0
+    start = time.perf_counter()
+    for chunk, fraction in iter_chunks(f, filename, chunksize):
+        if layout is None:
+            kind, layout = detect_layout(chunk.columns)
+        mapped = map_chunk(chunk, kind, layout)
+        with db.transaction() as conn:
+            if kind == "materiais":
+                conn.executemany(MATERIALS_INSERT, mapped.itertuples(index=False, name=None))
+                bump_versions(conn, "vertical_materials")
+            else:
+                conn.executemany(PROCESSES_INSERT, mapped.itertuples(index=False, name=None))
+                bump_versions(conn, "vertical_processes")
+        total += len(mapped)
+        if progress is not None:
+            progress(total, fraction, total / max(time.perf_counter() - start, 1e-9))
+    elapsed = time.perf_counter() - start
+    return {"tipo": kind, "linhas": total, "segundos": elapsed, "linhas_por_s": total / elapsed if elapsed else 0.0}
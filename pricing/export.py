@@ -0,0 +1,128 @@
+import argparse
+import csv
+import io
+import sys
+import zipfile
+from contextlib import contextmanager
+from openpyxl import Workbook
+from pricing.db import Database
+from pricing.instrument import traced
+
+# Streaming export of the pricing tables: one sheet per table (openpyxl
+# write-only mode) or one CSV per table inside a zip. Rows are read from a
+# cursor CHUNK_ROWS at a time and written straight out, so memory stays flat
+# whatever the catalog size.
+#   python -m pricing.export --out catalogo.xlsx
+#   python -m pricing.export --out catalogo.zip --tabela products --tabela materials_usage
+
+# Everything that prices the catalog; users, jobs and derived tables
+# (product_closure, search indexes) are left out
+EXPORT_TABLES = (
+    "vertical_materials", "vertical_processes", "third_party_items", "admin_costs", "clients", "ncm_taxes",
+    "products", "materials_usage", "processes_usage", "third_usage", "product_components",
+    "product_clients", "product_cost_history", "scenarios", "scenario_adjustments",
+)
+CHUNK_ROWS = 5000
+XLSX_MAX_ROWS = 1_048_576  # per sheet, header included
+
+def _chunks(conn, table):
+    # (columns, iterator of row lists) in id order
+    cur = conn.cursor()
+    cur.row_factory = None  # plain tuples
+    cur.execute(f"SELECT * FROM {table} ORDER BY rowid")
+    columns = [d[0] for d in cur.description]
+    def rows():
+        while True:
+            chunk = cur.fetchmany(CHUNK_ROWS)
+            if not chunk:
+                return
+            yield chunk
+    return columns, rows()
+
+@contextmanager
+def _read_snapshot(conn):
+    # COUNT(*) and the streaming SELECTs read one WAL snapshot, so rows
+    # committed meanwhile cannot push progress past 1.0
+    own = not conn.in_transaction
+    if own:
+        conn.execute("BEGIN")
+    try:
+        yield
+    finally:
+        if own:
+            conn.commit()
+
+def _totals(conn, tables):
+    return {t: conn.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in tables}
+
+def _check(tables):
+    unknown = [t for t in tables if t not in EXPORT_TABLES]
+    if unknown:
+        raise ValueError(f"Tabelas não exportáveis: {', '.join(unknown)}")
+
+@traced("export_xlsx")
+def export_xlsx(conn, target, tables=EXPORT_TABLES, progress=None):
+    # target: path or binary file object. Tables over the sheet limit go on
+    # to "<tabela> (2)", "<tabela> (3)"...; progress(tabela, linhas, fração)
+    _check(tables)
+    with _read_snapshot(conn):
+        totals = _totals(conn, tables)
+        grand, done = sum(totals.values()) or 1, 0
+        wb = Workbook(write_only=True)
+        for table in tables:
+            columns, chunks = _chunks(conn, table)
+            part, ws, used = 1, None, XLSX_MAX_ROWS
+            for chunk in chunks:
+                for row in chunk:
+                    if used >= XLSX_MAX_ROWS:
+                        ws = wb.create_sheet(table if part == 1 else f"{table} ({part})"[:31])
+                        ws.append(columns)
+                        part, used = part + 1, 1
+                    ws.append(row)
+                    used += 1
+                done += len(chunk)
+                if progress:
+                    progress(table, done, min(done / grand, 1.0))
+            if ws is None:
+                wb.create_sheet(table).append(columns)
+    wb.save(target)
+    return totals
+
+@traced("export_csv_zip")
+def export_csv_zip(conn, target, tables=EXPORT_TABLES, progress=None):
+    # One "<tabela>.csv" (UTF-8, header first) per table in a deflated zip
+    _check(tables)
+    with _read_snapshot(conn):
+        totals = _totals(conn, tables)
+        grand, done = sum(totals.values()) or 1, 0
+        with zipfile.ZipFile(target, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for table in tables:
+                columns, chunks = _chunks(conn, table)
+                with zf.open(f"{table}.csv", "w", force_zip64=True) as raw, io.TextIOWrapper(raw, encoding="utf-8", newline="") as text:
+                    writer = csv.writer(text)
+                    writer.writerow(columns)
+                    for chunk in chunks:
+                        writer.writerows(chunk)
+                        done += len(chunk)
+                        if progress:
+                            progress(table, done, min(done / grand, 1.0))
+    return totals
+
+EXPORTERS = {"xlsx": export_xlsx, "zip": export_csv_zip}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Exporta as tabelas de precificação (XLSX com uma aba por tabela, ou ZIP de CSVs)")
+    parser.add_argument("--db", help="arquivo SQLite (padrão: precificacao.db no diretório atual)")
+    parser.add_argument("--out", required=True, help="arquivo .xlsx ou .zip")
+    parser.add_argument("--tabela", action="append", help="tabela a exportar (repetível; padrão: todas)")
+    args = parser.parse_args(argv)
+    formato = args.out.rsplit(".", 1)[-1].lower()
+    if formato not in EXPORTERS:
+        parser.error("--out deve terminar em .xlsx ou .zip")
+    db = Database(args.db)
+    totals = EXPORTERS[formato](db.connection(), args.out, tuple(args.tabela or EXPORT_TABLES))
+    print(f"{sum(totals.values()):,} linhas de {len(totals)} tabelas em {args.out}", file=sys.stderr)
+    db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+from collections import deque
+import numpy as np
+import pandas as pd
+from pricing.db import MONEY_COLUMNS
+from pricing.engine import PRICE_GRID_MONEY, TaxResolver, suggest_sale_price, _d
+from pricing.instrument import stage, traced
+from pricing.rollup import CATEGORIES, USAGE_SQL, COMPONENTS_SQL
+
+# Scaled integers: money in centavos, quantities and rates in 1e-4, costs
+# (quantity x price) in micro-reais. Every value that does not fit its scale
+# exactly, or whose arithmetic could overflow int64, marks its rows inexact
+# and those are priced through the Decimal path instead.
+MONEY_SCALE = 100
+QTY_SCALE = 10_000
+COST_SCALE = MONEY_SCALE * QTY_SCALE
+_LIMIT = float(2 ** 62)
+
+PRICE_TABLES = {
+    "materiais": "vertical_materials",
+    "processos": "vertical_processes",
+    "terceiros": "third_party_items",
+}
+
+def to_fixed(values, scale):
+    # float -> (int64, exact): exact when the value is the float nearest to
+    # n / scale, i.e. when Decimal(str(value)) has no more digits than scale
+    values = np.asarray(values, dtype=float)
+    scaled = np.rint(values * scale)
+    exact = np.isfinite(values) & (np.abs(values) < 1e11) & (scaled / scale == values)
+    return np.where(exact, scaled, 0).astype(np.int64), exact
+
+def div_half_up(num, den):
+    # ROUND_HALF_UP of num / den for num >= 0, den > 0; also returns where the
+    # quotient sits exactly on a half unit
+    q, r = np.divmod(num, den)
+    return q + (2 * r >= den), 2 * r == den
+
+
+class FixedCostRollup:
+    # Same numbers as CostRollup, with every cost an int64 in micro-reais:
+    # own costs are quantity x price sums and component costs are added level
+    # by level, bottom-up. exact[i] is False when a price, a quantity or a
+    # component multiplication did not fit the integer scales.
+    def __init__(self, product_ids):
+        self.ids = np.asarray(product_ids, dtype=np.int64)
+        self.costs = np.zeros((len(CATEGORIES), len(self.ids)), dtype=np.int64)
+        self.exact = np.ones(len(self.ids), dtype=bool)
+        self.admin = 0
+        self.admin_exact = True
+
+    def positions(self, product_ids):
+        product_ids = np.asarray(product_ids, dtype=np.int64)
+        pos = np.searchsorted(self.ids, product_ids)
+        found = (pos < len(self.ids)) & (self.ids[np.minimum(pos, len(self.ids) - 1)] == product_ids) if len(self.ids) else np.zeros(len(product_ids), dtype=bool)
+        return pos, found
+
+    @classmethod
+    def load(cls, conn):
+        cur = conn.cursor()
+        rollup = cls([r[0] for r in cur.execute("SELECT id FROM products ORDER BY id").fetchall()])
+        for k, categoria in enumerate(CATEGORIES):
+            table = PRICE_TABLES[categoria]
+            column, centavos = MONEY_COLUMNS[table]
+            prices = np.array(cur.execute(f"SELECT id, {centavos}, {centavos} IS NOT NULL FROM {table} ORDER BY id").fetchall(), dtype=object).reshape(-1, 3)
+            price_ids = prices[:, 0].astype(np.int64)
+            price_ok = prices[:, 2].astype(bool)
+            cents = np.where(price_ok, prices[:, 1], 0).astype(np.int64)
+            usage = np.array(cur.execute(USAGE_SQL[categoria]).fetchall(), dtype=float).reshape(-1, 3)
+            if not len(usage):
+                continue
+            pos, found = rollup.positions(usage[:, 0])
+            item = np.searchsorted(price_ids, usage[:, 1].astype(np.int64))
+            # Rows pointing to deleted items are dropped, as in CostRollup
+            has_price = (item < len(price_ids)) & (price_ids[np.minimum(item, max(len(price_ids) - 1, 0))] == usage[:, 1]) if len(price_ids) else np.zeros(len(usage), dtype=bool)
+            keep = found & has_price
+            pos, item, qty = pos[keep], item[keep], usage[keep, 2]
+            q4, q_ok = to_fixed(qty, QTY_SCALE)
+            ok = q_ok & price_ok[item] & (np.abs(q4.astype(float) * cents[item]) < _LIMIT)
+            np.add.at(rollup.costs[k], pos, np.where(ok, q4 * cents[item], 0))
+            rollup.exact[pos[~ok]] = False
+        edges = np.array(cur.execute(COMPONENTS_SQL).fetchall(), dtype=float).reshape(-1, 3)
+        rollup._add_components(edges)
+        admin = cur.execute("SELECT SUM(valor) FROM admin_costs").fetchone()[0] or 0
+        admin_micro, admin_ok = to_fixed([admin], COST_SCALE)
+        rollup.admin, rollup.admin_exact = int(admin_micro[0]), bool(admin_ok[0])
+        return rollup
+
+    def _add_components(self, edges):
+        if not len(edges):
+            return
+        parent, p_found = self.positions(edges[:, 0])
+        child, c_found = self.positions(edges[:, 1])
+        keep = p_found & c_found
+        parent, child = parent[keep], child[keep]
+        q4, q_ok = to_fixed(edges[keep, 2], QTY_SCALE)
+        # Level of each product = longest chain of components below it
+        n = len(self.ids)
+        pending = np.bincount(parent, minlength=n)
+        by_child = {}
+        for e, c in enumerate(child.tolist()):
+            by_child.setdefault(c, []).append(e)
+        level = np.zeros(n, dtype=np.int64)
+        queue = deque(np.flatnonzero(pending == 0).tolist())
+        seen = 0
+        while queue:
+            node = queue.popleft()
+            seen += 1
+            for e in by_child.get(node, ()):
+                p = parent[e]
+                level[p] = max(level[p], level[node] + 1)
+                pending[p] -= 1
+                if pending[p] == 0:
+                    queue.append(p)
+        if seen != n:
+            # Products on a cycle (saved before cycles were rejected) are left
+            # to the Decimal path, which reports them
+            self.exact[pending > 0] = False
+        edge_level = level[parent]
+        for lv in range(1, int(level.max()) + 1):
+            at = (edge_level == lv) & (pending[parent] == 0)
+            p, c, q, ok = parent[at], child[at], q4[at], q_ok[at] & self.exact[child[at]]
+            for k in range(len(CATEGORIES)):
+                below = self.costs[k, c]
+                ok &= np.abs(below.astype(float) * q) < _LIMIT
+                contrib = below * q
+                ok &= contrib % QTY_SCALE == 0
+                np.add.at(self.costs[k], p, np.where(ok, contrib // QTY_SCALE, 0))
+            self.exact[p[~ok]] = False
+
+    def base_cost_micro(self, product_ids):
+        # (3 x P micro-reais, exact) for the given products; unknown ids cost 0
+        pos, found = self.positions(product_ids)
+        pos = np.minimum(pos, max(len(self.ids) - 1, 0))
+        costs = np.where(found, self.costs[:, pos] if len(self.ids) else 0, 0)
+        exact = np.where(found, self.exact[pos] if len(self.ids) else True, True)
+        return costs, exact
+
+
+@traced("price_grid_fixed")
+def price_grid_fixed(conn, product_ids, client_ids, margens, admin_pct=0.0, frete_pct=0.0, outros_pct=0.0, fixed=None, taxes=None, rollup=None):
+    # price_grid on scaled integers: same columns and the same cents as
+    # suggest_sale_price. Rows the integer path cannot decide exactly are
+    # redone in Decimal (rollup is then loaded if not given).
+    if fixed is None:
+        with stage("rollup"):
+            fixed = FixedCostRollup.load(conn)
+    product_ids = np.asarray(product_ids, dtype=np.int64).ravel()
+    client_ids = np.asarray(client_ids, dtype=np.int64).ravel()
+    margens = np.asarray(margens, dtype=float).ravel()
+    n_p, n_c, n_m = len(product_ids), len(client_ids), len(margens)
+
+    costs, exact_p = fixed.base_cost_micro(product_ids)
+    core = costs.sum(axis=0)
+    perc = (_d(admin_pct) + _d(frete_pct) + _d(outros_pct)) * 100
+    perc_ok = perc == perc.to_integral_value()
+    p4 = int(perc) if perc_ok else 0
+    if perc > 0:
+        ok_p = exact_p & perc_ok & (np.abs(core.astype(float)) * (QTY_SCALE + abs(p4)) < _LIMIT)
+        admin10 = np.where(ok_p, core * p4, 0)
+    else:
+        ok_p = exact_p & fixed.admin_exact & (np.abs(core.astype(float) + fixed.admin) * QTY_SCALE < _LIMIT)
+        admin10 = np.full(n_p, fixed.admin * QTY_SCALE, dtype=np.int64)
+    sem10 = np.where(ok_p, core * QTY_SCALE + admin10, 0)  # 1e-10 reais
+    ok_p &= (sem10 >= 0) & (costs >= 0).all(axis=0) & (admin10 >= 0)
+
+    base = {}
+    for k, categoria in enumerate(CATEGORIES):
+        base[categoria] = div_half_up(np.where(ok_p, costs[k], 0), COST_SCALE // MONEY_SCALE)[0] / MONEY_SCALE
+    base["administrativos"] = div_half_up(admin10, QTY_SCALE * COST_SCALE // MONEY_SCALE)[0] / MONEY_SCALE
+    base["sem_impostos"] = div_half_up(sem10, QTY_SCALE * COST_SCALE // MONEY_SCALE)[0] / MONEY_SCALE
+
+    with stage("impostos"):
+        if taxes is None:
+            taxes = TaxResolver.load(conn)
+        rates = taxes.grid(conn, product_ids, client_ids)
+    t4, ok_t = to_fixed(rates["total"], QTY_SCALE)
+    m4, ok_m = to_fixed(margens, QTY_SCALE / 100)
+
+    pi, ci, mi = (a.ravel() for a in np.meshgrid(np.arange(n_p), np.arange(n_c), np.arange(n_m), indexing="ij"))
+    sem = sem10[pi]
+    t = t4[pi, ci]
+    den4 = QTY_SCALE - m4[mi] - t  # 1 - margem - taxa, in 1e-4
+    ok = ok_p[pi] & ok_t[pi, ci] & ok_m[mi] & (den4 > 0)
+    d = np.where(ok, den4, 1) * QTY_SCALE
+    # preco (centavos) = sem10 / (den4 * 1e4) = q + r / d
+    q, r = np.divmod(sem, d)
+    preco = q + (2 * r >= d)
+    # impostos = preco * taxa / 1e4 = a1 + (b1 * d + r * t) / (d * 1e4), kept in int64
+    ok &= (t >= 0) & (q.astype(float) * np.abs(t) < _LIMIT)
+    a1, b1 = np.divmod(q * t, QTY_SCALE)
+    imp_extra, imp_tie = div_half_up(b1 * d + r * t, d * QTY_SCALE)
+    impostos = a1 + imp_extra
+    # A tie here may land either side in Decimal, whose preco is rounded to 28 digits
+    ok &= ~imp_tie
+    with np.errstate(invalid="ignore"):
+        margem_real = np.where(sem > 0, m4[mi] / 100.0, np.nan)
+
+    out = pd.DataFrame({
+        "product_id": product_ids[pi],
+        "client_id": client_ids[ci],
+        "margem": margens[mi],
+        "materiais": base["materiais"][pi],
+        "processos": base["processos"][pi],
+        "terceiros": base["terceiros"][pi],
+        "administrativos": base["administrativos"][pi],
+        "sem_impostos": base["sem_impostos"][pi],
+        "pis": rates["pis"][pi, ci],
+        "cofins": rates["cofins"][pi, ci],
+        "icms": rates["icms"][pi, ci],
+        "taxa_total": rates["total"][pi, ci],
+        "preco_venda": preco / MONEY_SCALE,
+        "impostos_valor": impostos / MONEY_SCALE,
+        "margem_real_percent": margem_real,
+    })
+    fallback = np.flatnonzero(~ok)
+    if len(fallback):
+        if rollup is None:
+            from pricing.rollup import CostRollup
+            rollup = CostRollup.load(conn)
+        fields = ["preco_venda", "impostos_valor", "margem_real_percent"] + PRICE_GRID_MONEY[:5]
+        values = out.loc[fallback, fields].to_numpy(dtype=float)
+        for i, row in enumerate(fallback):
+            try:
+                res = suggest_sale_price(conn, int(product_ids[pi[row]]), int(client_ids[ci[row]]), float(margens[mi[row]]), admin_pct, frete_pct, outros_pct, rollup=rollup, taxes=taxes)
+            except ArithmeticError:
+                values[i, :3] = np.nan
+                if not ok_p[pi[row]]:
+                    values[i, 3:] = np.nan
+                continue
+            values[i] = [float(res["preco_venda"]), float(res["impostos_valor"]), float(res["margem_real_percent"])] + [float(res["base"][k]) for k in PRICE_GRID_MONEY[:5]]
+        out.loc[fallback, fields] = values
+    out.attrs["fallback_rows"] = len(fallback)
+    return out
@@ -0,0 +1,110 @@
+import pandas as pd
+from pricing.db import EDITABLE_TABLES, filter_clause, has_search_index, read_versions
+
+# Reference data for the UI as compact DataFrames. Each frame names the tables
+# it reads; its stamp is their table_versions generations, so a cache keyed on
+# (name, stamp, params) is invalidated by every Database write (bump_versions).
+# Editor frames keep plain text columns so new groups/units can be typed;
+# read-only lists use categoricals for the repetitive text columns.
+
+def _editor_sql(table):
+    spec = EDITABLE_TABLES[table]
+    return f"SELECT id, {', '.join(spec['text'] + spec['numeric'])} FROM {table} ORDER BY id"
+
+FRAMES = {
+    "admin_editor": (("admin_costs",), _editor_sql("admin_costs"), ()),
+    "clients": (("clients",), "SELECT id, nome FROM clients ORDER BY id", ()),
+    "products_editor": (("products",), "SELECT id, codigo, nome, quantidade, destino_uf, ncm, local_fabricacao_uf, grupo, subgrupo FROM products ORDER BY id", ()),
+    "products": (("products",), "SELECT id, codigo, nome, grupo, subgrupo FROM products ORDER BY id", ("grupo", "subgrupo")),
+    # First page of the product pickers (params=(limit,)); typed text goes to db.search
+    "products_page": (("products",), "SELECT id, codigo, nome, grupo, subgrupo FROM products ORDER BY id LIMIT ?", ("grupo", "subgrupo")),
+    # Per product (params=(product_id,)) / per client (params=(client_id,))
+    "product_materials": (("materials_usage", "vertical_materials"), "SELECT vm.nome, mu.quantidade FROM materials_usage mu JOIN vertical_materials vm ON mu.material_id=vm.id WHERE mu.product_id=? ORDER BY mu.id", ()),
+    "product_processes": (("processes_usage", "vertical_processes"), "SELECT vp.nome, pu.horas FROM processes_usage pu JOIN vertical_processes vp ON pu.process_id=vp.id WHERE pu.product_id=? ORDER BY pu.id", ()),
+    "product_thirds": (("third_usage", "third_party_items"), "SELECT tp.nome, tu.quantidade FROM third_usage tu JOIN third_party_items tp ON tu.third_id=tp.id WHERE tu.product_id=? ORDER BY tu.id", ()),
+    "product_components": (("product_components", "products"), "SELECT COALESCE(p.codigo, '') || ' - ' || p.nome AS nome, pc.quantidade, pc.component_product_id AS component_id FROM product_components pc JOIN products p ON pc.component_product_id=p.id WHERE pc.parent_product_id=? ORDER BY pc.id", ()),
+    "client_products": (("product_clients", "products"), "SELECT p.id, p.codigo, p.nome FROM products p JOIN product_clients pc ON pc.product_id=p.id WHERE pc.client_id=? ORDER BY p.id", ()),
+    # Links of a client with the current cost and quote from the snapshot
+    # tables (pricing.snapshot); the metrics are one aggregate row. custo_orcado
+    # is the cost in the pair's latest product_cost_history row
+    "client_portfolio": (
+        ("product_clients", "products", "product_cost_snapshot", "product_quote_snapshot"),
+        "SELECT p.codigo, p.nome, pc.margem, pc.preco_final, q.preco_atual, s.custo_total_sem_impostos AS custo_atual, pc.data_vinculo "
+        "FROM product_clients pc JOIN products p ON p.id = pc.product_id "
+        "LEFT JOIN product_quote_snapshot q ON q.link_id = pc.id LEFT JOIN product_cost_snapshot s ON s.product_id = pc.product_id "
+        "WHERE pc.client_id=? ORDER BY pc.data_vinculo DESC",
+        (),
+    ),
+    "client_portfolio_metrics": (
+        ("product_clients", "product_cost_snapshot", "product_quote_snapshot", "product_cost_history"),
+        "SELECT COUNT(*) AS produtos, COALESCE(AVG(preco_final), 0) AS ticket_medio, COALESCE(SUM(preco_final), 0) AS valor_negociado, "
+        "SUM(preco_atual) AS valor_atual, COALESCE(SUM(preco_atual > preco_final + 0.005), 0) AS defasados, "
+        "SUM(custo_atual - custo_orcado) * 100.0 / NULLIF(SUM(CASE WHEN custo_atual IS NOT NULL THEN custo_orcado END), 0) AS deriva_custo_pct "
+        "FROM (SELECT pc.preco_final, q.preco_atual, s.custo_total_sem_impostos AS custo_atual, "
+        "(SELECT h.custo_total_sem_impostos FROM product_cost_history h WHERE h.product_id = pc.product_id AND h.client_id = pc.client_id "
+        "ORDER BY h.ts DESC, h.id DESC LIMIT 1) AS custo_orcado "
+        "FROM product_clients pc LEFT JOIN product_quote_snapshot q ON q.link_id = pc.id "
+        "LEFT JOIN product_cost_snapshot s ON s.product_id = pc.product_id WHERE pc.client_id=?)",
+        (),
+    ),
+    "scenarios": (("scenarios", "scenario_adjustments"), "SELECT s.id, s.nome, s.descricao, COUNT(a.id) AS ajustes FROM scenarios s LEFT JOIN scenario_adjustments a ON a.scenario_id=s.id GROUP BY s.id ORDER BY s.id", ()),
+    "scenario_adjustments": (("scenario_adjustments",), "SELECT categoria, alvo, valor, tipo, ajuste FROM scenario_adjustments WHERE scenario_id=? ORDER BY id", ()),
+}
+
+def compact(df, categorical=()):
+    # Integer ids downcast, repetitive text as categoricals; money stays float64
+    for c in df.columns:
+        if c == "id" or c.endswith("_id"):
+            df[c] = pd.to_numeric(df[c], downcast="integer")
+        elif c in categorical:
+            df[c] = df[c].fillna("").astype("category")
+    return df
+
+def load_frame(conn, name, params=()):
+    _tables, sql, categorical = FRAMES[name]
+    return compact(pd.read_sql(sql, conn, params=tuple(params)), categorical)
+
+def count_rows(conn, table, filtros=(), busca=""):
+    where, params = filter_clause(table, filtros, busca, has_search_index(conn, table))
+    return conn.execute(f"SELECT COUNT(*) FROM {table}{where}", params).fetchone()[0]
+
+def load_page(conn, table, filtros=(), busca="", offset=0, limit=100):
+    # One page of an editable table, in id order, with the editor's columns
+    where, params = filter_clause(table, filtros, busca, has_search_index(conn, table))
+    spec = EDITABLE_TABLES[table]
+    sql = f"SELECT id, {', '.join(spec['text'] + spec['numeric'])} FROM {table}{where} ORDER BY id LIMIT ? OFFSET ?"
+    return compact(pd.read_sql(sql, conn, params=tuple(params) + (limit, offset)))
+
+def filter_options(conn, table, column):
+    # Distinct values offered by a paginated editor filter ("" for empty)
+    if column not in EDITABLE_TABLES[table].get("filters", ()):
+        raise ValueError(f"Filtro inválido para {table}: {column}")
+    rows = conn.execute(f"SELECT DISTINCT COALESCE({column}, '') FROM {table} ORDER BY 1").fetchall()
+    return [r[0] for r in rows]
+
+
+class VersionStamp:
+    # table_versions read once per UI run and again only after this
+    # connection writes (sqlite3's total_changes moves); writes from other
+    # processes are seen on the next run
+    def __init__(self, conn):
+        self.conn = conn
+        self._changes = None
+        self._versions = {}
+
+    def __call__(self, name):
+        return self.of(FRAMES[name][0])
+
+    def of(self, tables):
+        if self._changes != self.conn.total_changes:
+            self._versions = read_versions(self.conn)
+            self._changes = self.conn.total_changes
+        return tuple(self._versions.get(t, 0) for t in tables)
+
+def version_stamp(conn):
+    # One VersionStamp per connection: Database connections are per thread and
+    # Streamlit runs every script or fragment rerun on a thread of its own
+    stamp = getattr(conn, "version_stamp", None)
+    if stamp is None:
+        stamp = conn.version_stamp = VersionStamp(conn)
+    return stamp
@@ -0,0 +1,118 @@
+import argparse
+import sys
+import pandas as pd
+from pricing.db import Database, HISTORY_VALUES, bump_versions
+from pricing.instrument import traced
+
+# product_cost_history as a time series per (product_id, client_id, ts),
+# aggregated by SQLite: each day/week/month bucket gives the last snapshot
+# plus min/max of price and cost, so the evolution chart gets a bounded
+# number of points however long the history is.
+#   history_series(conn, product_id, client_id)         # bucket chosen for <= 300 points
+#   python -m pricing.history --compactar --dias-brutos 90 --dias-diarios 730
+# Rows whose data_vinculo could not be read as a date (ts NULL) are left out.
+
+BUCKETS = {"dia": "%Y-%m-%d", "semana": "%Y-%W", "mes": "%Y-%m"}
+BUCKET_SECONDS = {"dia": 86400, "semana": 7 * 86400, "mes": 31 * 86400}
+MAX_POINTS = 300
+
+def pick_bucket(saves, first_ts, last_ts, max_points=MAX_POINTS):
+    # None (every save) while it fits, else the finest bucket that does
+    if saves <= max_points:
+        return None
+    span = (last_ts or 0) - (first_ts or 0)
+    for bucket in ("dia", "semana"):
+        if span // BUCKET_SECONDS[bucket] + 1 <= max_points:
+            return bucket
+    return "mes"
+
+@traced("history_series")
+def history_series(conn, product_id, client_id, bucket="auto", max_points=MAX_POINTS):
+    # -> DataFrame: periodo, ts (last save in it), saves, the last value of each
+    # HISTORY_VALUES column, preco_min/preco_max and custo_min/custo_max
+    if bucket == "auto":
+        saves, first_ts, last_ts = conn.execute(
+            "SELECT COUNT(*), MIN(ts), MAX(ts) FROM product_cost_history WHERE product_id=? AND client_id=? AND ts IS NOT NULL",
+            (product_id, client_id),
+        ).fetchone()
+        bucket = pick_bucket(saves, first_ts, last_ts, max_points)
+    cols = ", ".join(HISTORY_VALUES)
+    if bucket is None:
+        sql = f"""
+            SELECT data_vinculo AS periodo, ts, 1 AS saves, {cols},
+                   preco_final AS preco_min, preco_final AS preco_max,
+                   custo_total_sem_impostos AS custo_min, custo_total_sem_impostos AS custo_max
+            FROM product_cost_history
+            WHERE product_id=? AND client_id=? AND ts IS NOT NULL
+            ORDER BY ts, id"""
+    else:
+        periodo = f"strftime('{BUCKETS[bucket]}', ts, 'unixepoch')"
+        last = ", ".join(f"MAX(CASE WHEN rn = 1 THEN {c} END) AS {c}" for c in HISTORY_VALUES)
+        sql = f"""
+            WITH h AS (
+                SELECT {periodo} AS periodo, ts, {cols},
+                       ROW_NUMBER() OVER (PARTITION BY {periodo} ORDER BY ts DESC, id DESC) AS rn
+                FROM product_cost_history
+                WHERE product_id=? AND client_id=? AND ts IS NOT NULL
+            )
+            SELECT periodo, MAX(ts) AS ts, COUNT(*) AS saves, {last},
+                   MIN(preco_final) AS preco_min, MAX(preco_final) AS preco_max,
+                   MIN(custo_total_sem_impostos) AS custo_min, MAX(custo_total_sem_impostos) AS custo_max
+            FROM h GROUP BY periodo ORDER BY MAX(ts)"""
+    df = pd.read_sql(sql, conn, params=(product_id, client_id))
+    df["ts"] = pd.to_datetime(df["ts"], unit="s")
+    df.attrs["bucket"] = bucket
+    return df
+
+def compact_history(db, raw_days=90, daily_days=730):
+    # Retention: saves from the last raw_days stay as they are; older ones
+    # keep only the last save of each day per pair and, past daily_days, the
+    # last of each month. Then consecutive identical snapshots (saved before
+    # inserts were deduplicated) are removed. Returns rows removed per step.
+    now = "CAST(strftime('%s', 'now', 'localtime') AS INTEGER)"
+    def thin(conn, bucket, newer_than, older_than):
+        periodo = f"strftime('{BUCKETS[bucket]}', ts, 'unixepoch')"
+        window = "" if newer_than is None else f" AND ts >= {now} - {int(newer_than) * 86400}"
+        return conn.execute(f"""
+            DELETE FROM product_cost_history WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, ROW_NUMBER() OVER (PARTITION BY product_id, client_id, {periodo} ORDER BY ts DESC, id DESC) AS rn
+                    FROM product_cost_history
+                    WHERE ts < {now} - {int(older_than) * 86400}{window}
+                ) WHERE rn > 1
+            )""").rowcount
+    lags = ", ".join(f"LAG({c}) OVER w AS prev_{c}" for c in HISTORY_VALUES)
+    same = " AND ".join(f"{c} IS prev_{c}" for c in HISTORY_VALUES)
+    with db.transaction() as conn:
+        removed = {
+            "diarios": thin(conn, "dia", daily_days, raw_days),
+            "mensais": thin(conn, "mes", None, daily_days),
+        }
+        removed["duplicados"] = conn.execute(f"""
+            DELETE FROM product_cost_history WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, {', '.join(HISTORY_VALUES)}, LAG(id) OVER w AS prev_id, {lags}
+                    FROM product_cost_history
+                    WINDOW w AS (PARTITION BY product_id, client_id ORDER BY ts, id)
+                ) WHERE prev_id IS NOT NULL AND {same}
+            )""").rowcount
+        if any(removed.values()):
+            bump_versions(conn, "product_cost_history")
+    return removed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manutenção do histórico de custos (product_cost_history)")
+    parser.add_argument("--db", help="arquivo SQLite (padrão: precificacao.db no diretório atual)")
+    parser.add_argument("--compactar", action="store_true", help="aplica a retenção e remove snapshots repetidos")
+    parser.add_argument("--dias-brutos", type=int, default=90, help="dias mantidos com todos os salvamentos")
+    parser.add_argument("--dias-diarios", type=int, default=730, help="dias mantidos com um salvamento por dia (depois, um por mês)")
+    args = parser.parse_args(argv)
+    if not args.compactar:
+        parser.error("nada a fazer: use --compactar")
+    db = Database(args.db)
+    removed = compact_history(db, args.dias_brutos, args.dias_diarios)
+    print(", ".join(f"{n:,} {k}" for k, n in removed.items()) + " removidos", file=sys.stderr)
+    db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,230 @@
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from functools import wraps
+
+# Opt-in profiling of Database connections and the pricing engine.
+#   from pricing import instrument
+#   instrument.enable()
+#   ... suggest_sale_price(...) ...
+#   instrument.recorder.last_operations(10); instrument.recorder.slowest_queries(10)
+# Every statement SQLite runs (executemany rows and trigger bodies included)
+# is counted by a trace callback; execute/executemany/fetch* calls are timed
+# and their rows counted per SQL text (rows read by iterating a cursor are not
+# counted). Operations group statements and engine stages (rollup, impostos,
+# preco) run by one thread. Disabled, the cost is one flag check per call.
+
+_NULL = nullcontext()
+_IN_LIST = re.compile(r"\((\s*\?\s*,)+\s*\?\s*\)")
+_SPACES = re.compile(r"\s+")
+
+def normalize_sql(sql):
+    # One entry per statement shape: whitespace collapsed, IN (?,?,...) folded
+    return _IN_LIST.sub("(?, ...)", _SPACES.sub(" ", sql).strip())
+
+
+class Recorder:
+    def __init__(self, max_ops=50):
+        self.enabled = False
+        self.ops = deque(maxlen=max_ops)
+        self.queries = {}  # sql -> [execuções, segundos, máximo, linhas]
+        self.statements = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def enable(self, max_ops=None):
+        if max_ops is not None and max_ops != self.ops.maxlen:
+            with self._lock:
+                self.ops = deque(self.ops, maxlen=max_ops)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self.ops.clear()
+            self.queries = {}
+            self.statements = 0
+
+    def _current(self):
+        stack = getattr(self._local, "stack", None)
+        return stack[-1] if stack else None
+
+    def on_statement(self, _sql):
+        # sqlite3 trace callback
+        if not self.enabled:
+            return
+        self.statements += 1
+        op = self._current()
+        if op is not None:
+            op["sql"] += 1
+
+    def record_query(self, sql, seconds, rows):
+        op = self._current()
+        if op is not None:
+            op["sql_segundos"] += seconds
+            op["linhas"] += rows
+        key = normalize_sql(sql)
+        with self._lock:
+            stat = self.queries.get(key)
+            if stat is None:
+                self.queries[key] = [1, seconds, seconds, rows]
+            else:
+                stat[0] += 1
+                stat[1] += seconds
+                stat[2] = max(stat[2], seconds)
+                stat[3] += rows
+
+    def record_fetch(self, sql, seconds, rows):
+        # Rows read after execute(): time and rows go to the same entry
+        op = self._current()
+        if op is not None:
+            op["sql_segundos"] += seconds
+            op["linhas"] += rows
+        with self._lock:
+            stat = self.queries.get(normalize_sql(sql))
+            if stat is not None:
+                stat[1] += seconds
+                stat[3] += rows
+
+    @contextmanager
+    def _operation(self, nome, detalhe):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        if stack:
+            # Nested calls (price_grid -> suggest_sale_price) belong to the outer one
+            yield stack[-1]
+            return
+        op = {"nome": nome, "detalhe": detalhe, "inicio": datetime.now().strftime("%H:%M:%S"), "segundos": 0.0, "sql": 0, "sql_segundos": 0.0, "linhas": 0, "etapas": {}}
+        stack.append(op)
+        start = time.perf_counter()
+        try:
+            yield op
+        finally:
+            op["segundos"] = time.perf_counter() - start
+            stack.pop()
+            with self._lock:
+                self.ops.append(op)
+
+    def operation(self, nome, detalhe=""):
+        return self._operation(nome, detalhe) if self.enabled else _NULL
+
+    @contextmanager
+    def _stage(self, nome):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            op = self._current()
+            if op is not None:
+                op["etapas"][nome] = op["etapas"].get(nome, 0.0) + time.perf_counter() - start
+
+    def stage(self, nome):
+        return self._stage(nome) if self.enabled else _NULL
+
+    def last_operations(self, n=20):
+        with self._lock:
+            return list(self.ops)[-n:][::-1]
+
+    def slowest_queries(self, n=20, by="segundos"):
+        with self._lock:
+            rows = [
+                {"sql": sql, "execucoes": c, "segundos": s, "max_ms": m * 1000, "media_ms": s / c * 1000, "linhas": r}
+                for sql, (c, s, m, r) in self.queries.items()
+            ]
+        return sorted(rows, key=lambda r: r[by], reverse=True)[:n]
+
+
+recorder = Recorder()
+enable = recorder.enable
+disable = recorder.disable
+operation = recorder.operation
+stage = recorder.stage
+
+def traced(nome):
+    # Decorator: the call is one operation while instrumentation is enabled
+    def wrap(fn):
+        @wraps(fn)
+        def inner(*args, **kwargs):
+            if not recorder.enabled:
+                return fn(*args, **kwargs)
+            with recorder.operation(nome):
+                return fn(*args, **kwargs)
+        return inner
+    return wrap
+
+
+class TracedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        if not recorder.enabled:
+            return super().execute(sql, parameters)
+        self.connection.attach_trace()
+        start = time.perf_counter()
+        super().execute(sql, parameters)
+        self._sql = sql
+        recorder.record_query(sql, time.perf_counter() - start, max(self.rowcount, 0))
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        if not recorder.enabled:
+            return super().executemany(sql, seq_of_parameters)
+        self.connection.attach_trace()
+        start = time.perf_counter()
+        super().executemany(sql, seq_of_parameters)
+        self._sql = None
+        recorder.record_query(sql, time.perf_counter() - start, max(self.rowcount, 0))
+        return self
+
+    def _timed_fetch(self, fetch, *args):
+        sql = getattr(self, "_sql", None)
+        if not recorder.enabled or sql is None:
+            return fetch(*args)
+        start = time.perf_counter()
+        result = fetch(*args)
+        rows = len(result) if isinstance(result, list) else int(result is not None)
+        recorder.record_fetch(sql, time.perf_counter() - start, rows)
+        return result
+
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed_fetch(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+
+
+class TracedConnection(sqlite3.Connection):
+    # Factory for Database.connect(); the trace callback is attached on first
+    # use while enabled and removed on first use after disable()
+    traced = False
+
+    def cursor(self, factory=TracedCursor):
+        cur = super().cursor(factory)
+        if self.traced and not recorder.enabled:
+            self.set_trace_callback(None)
+            self.traced = False
+        return cur
+
+    # Connection.execute does not go through cursor(), so route it there
+    def execute(self, sql, parameters=()):
+        if not recorder.enabled:
+            return super().execute(sql, parameters)
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if not recorder.enabled:
+            return super().executemany(sql, seq_of_parameters)
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def attach_trace(self):
+        if not self.traced:
+            self.set_trace_callback(recorder.on_statement)
+            self.traced = True
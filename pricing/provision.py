@@ -0,0 +1,101 @@
+import argparse
+import csv
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pricing.auth import hash_password
+from pricing.db import Database
+
+# Bulk user provisioning from a CSV roster (columns nome, email, senha and,
+# optionally, role; "," or ";" separated). PBKDF2 hashing is the whole cost,
+# so passwords are hashed by a process pool (spawn) and the rows then go in
+# through Database.add_users in one transaction. Emails already registered
+# are skipped (and not hashed) unless --atualizar.
+#   python -m pricing.provision usuarios.csv --workers 8
+#   python -m pricing.provision usuarios.csv --atualizar
+
+ROLES = ("cliente", "admin")
+HASH_CHUNK = 64  # at most this many passwords per task sent to a worker
+
+def read_roster(path):
+    # -> (rows [(nome, email, senha, role)], errors [(linha, motivo)]); emails
+    # are stored lowercase, as the login form reads them; a repeated email
+    # keeps its first line
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;")
+        except csv.Error:
+            dialect = csv.excel
+        reader = csv.DictReader(f, dialect=dialect)
+        reader.fieldnames = [c.strip().lower() for c in reader.fieldnames or ()]
+        missing = [c for c in ("nome", "email", "senha") if c not in reader.fieldnames]
+        if missing:
+            raise ValueError(f"Colunas ausentes no CSV: {', '.join(missing)}")
+        rows, errors, seen = [], [], set()
+        for line, r in enumerate(reader, start=2):
+            nome, email, senha = (r.get("nome") or "").strip(), (r.get("email") or "").strip().lower(), r.get("senha") or ""
+            role = (r.get("role") or "").strip().lower() or "cliente"
+            if not nome or not email or not senha:
+                errors.append((line, "nome, email e senha são obrigatórios"))
+            elif "@" not in email:
+                errors.append((line, f"email inválido: {email}"))
+            elif role not in ROLES:
+                errors.append((line, f"role inválido: {role}"))
+            elif email in seen:
+                errors.append((line, f"email repetido no arquivo: {email}"))
+            else:
+                seen.add(email)
+                rows.append((nome, email, senha, role))
+    return rows, errors
+
+def hash_passwords(senhas, workers=None):
+    # Same order as senhas; small batches (or one worker) stay in this process
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(senhas) <= HASH_CHUNK:
+        return [hash_password(s) for s in senhas]
+    # Several chunks per worker so a slow one does not hold the pool's tail
+    chunksize = max(1, min(HASH_CHUNK, len(senhas) // (4 * workers)))
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+        return list(pool.map(hash_password, senhas, chunksize=chunksize))
+
+def provision(db, rows, update_existing=False, workers=None):
+    # rows: (nome, email, senha, role) -> Database.add_users counts
+    if not update_existing:
+        conn = db.connection()
+        emails = [r[1] for r in rows]
+        existing = set()
+        for i in range(0, len(emails), 900):
+            chunk = emails[i:i + 900]
+            existing.update(e[0] for e in conn.execute(f"SELECT email FROM users WHERE email IN ({','.join('?' * len(chunk))})", chunk).fetchall())
+        skipped = len(existing)
+        rows = [r for r in rows if r[1] not in existing]
+    else:
+        skipped = 0
+    hashes = hash_passwords([r[2] for r in rows], workers)
+    result = db.add_users([(nome, email, senha_hash, role) for (nome, email, _senha, role), senha_hash in zip(rows, hashes)], update_existing)
+    result["ignorados"] += skipped
+    return result
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cadastra usuários em lote a partir de um CSV (nome, email, senha[, role])")
+    parser.add_argument("csv", help="arquivo CSV separado por vírgula ou ponto e vírgula")
+    parser.add_argument("--db", help="arquivo SQLite (padrão: precificacao.db no diretório atual)")
+    parser.add_argument("--atualizar", action="store_true", help="atualiza nome, senha e role de emails já cadastrados")
+    parser.add_argument("--workers", type=int, help="processos para o hashing das senhas (padrão: número de CPUs)")
+    args = parser.parse_args(argv)
+    try:
+        rows, errors = read_roster(args.csv)
+    except ValueError as e:
+        parser.error(str(e))
+    for line, motivo in errors:
+        print(f"linha {line}: {motivo}", file=sys.stderr)
+    db = Database(args.db)
+    result = provision(db, rows, args.atualizar, args.workers)
+    print(f"{result['inseridos']:,} usuários criados, {result['atualizados']:,} atualizados, {result['ignorados']:,} ignorados, {len(errors):,} linhas com erro", file=sys.stderr)
+    db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+import argparse
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+from multiprocessing import get_context
+from pricing.db import CONNECTION_PRAGMAS, COST_HISTORY_INSERT, Database, bump_versions
+from pricing.engine import TaxResolver, suggest_sale_price
+from pricing.rollup import CostRollup
+
+# Reprices every product_clients link (or a filtered subset) at the link's own
+# margem after a price-table import, writing preco_final and one
+# product_cost_history row per link (none when it repeats the latest one).
+#   python -m pricing.reprice --cliente 3 --grupo CHAPAS --workers 4
+#   python -m pricing.reprice --retomar
+# A job is split into shards of link ids. Worker processes (spawn) each load
+# the catalog once (CostRollup, TaxResolver) and price whole shards; the parent
+# is the only writer and commits each shard's results together with the shard
+# being marked done, in one short transaction, so a restart resumes with the
+# shards still pending and interactive sessions only wait for one shard's
+# executemany. Links are priced with the default admin costs (the
+# percentages used when a link was saved are not stored).
+
+SHARD_SIZE = 2000
+HEARTBEAT_SECONDS = 10
+STALE_SECONDS = 60  # "executando" without a heartbeat for this long: interrupted
+
+LINKS_SQL = (
+    "SELECT pc.id, pc.product_id, pc.client_id, pc.margem FROM product_clients pc "
+    "JOIN products p ON p.id = pc.product_id WHERE pc.id BETWEEN ? AND ?"
+)
+
+def _now():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def link_filter(filtros):
+    # filtros: {"clientes": [ids], "produtos": [ids], "grupos": [grupo do produto]}
+    terms, params = [], []
+    for key, column in (("clientes", "pc.client_id"), ("produtos", "pc.product_id"), ("grupos", "COALESCE(p.grupo, '')")):
+        values = list(filtros.get(key) or ())
+        if values:
+            terms.append(f"{column} IN ({','.join('?' * len(values))})")
+            params += values
+    return "".join(" AND " + t for t in terms), params
+
+def create_job(db, clientes=(), grupos=(), produtos=(), shard_size=SHARD_SIZE):
+    filtros = {"clientes": [int(c) for c in clientes], "grupos": [str(g) for g in grupos], "produtos": [int(p) for p in produtos]}
+    where, params = link_filter(filtros)
+    with db.transaction() as conn:
+        ids = [r[0] for r in conn.execute(
+            f"SELECT pc.id FROM product_clients pc JOIN products p ON p.id = pc.product_id WHERE 1=1{where} ORDER BY pc.id", params
+        ).fetchall()]
+        job_id = conn.execute(
+            "INSERT INTO reprice_jobs (status, filtros, total_links, criado_em) VALUES ('pendente', ?, ?, ?)",
+            (json.dumps(filtros), len(ids), _now()),
+        ).lastrowid
+        conn.executemany(
+            "INSERT INTO reprice_shards (job_id, primeiro_id, ultimo_id, links) VALUES (?,?,?,?)",
+            [(job_id, chunk[0], chunk[-1], len(chunk)) for chunk in (ids[i:i + shard_size] for i in range(0, len(ids), shard_size))],
+        )
+    return job_id
+
+def _connect(path):
+    # Workers skip Database(): no schema checks or migrations per process
+    conn = sqlite3.connect(path, timeout=30.0)
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+_worker = {}
+
+def _init_worker(path):
+    conn = _connect(path)
+    _worker.update(conn=conn, rollup=CostRollup.load(conn), taxes=TaxResolver.load(conn))
+
+def _price_shard(shard_id, primeiro, ultimo, filtros):
+    # -> (shard_id, [(preco_final, link_id)], history rows, links skipped)
+    conn, rollup, taxes = _worker["conn"], _worker["rollup"], _worker["taxes"]
+    where, params = link_filter(filtros)
+    agora = _now()
+    updates, history, skipped = [], [], 0
+    for link_id, product_id, client_id, margem in conn.execute(LINKS_SQL + where, [primeiro, ultimo] + params).fetchall():
+        if margem is None:
+            skipped += 1
+            continue
+        try:
+            res = suggest_sale_price(conn, product_id, client_id, margem, rollup=rollup, taxes=taxes)
+        except (ArithmeticError, KeyError):
+            # margem + impostos = 100%, or a product/client deleted meanwhile
+            skipped += 1
+            continue
+        preco = float(res["preco_venda"])
+        if preco <= 0:
+            # margem + impostos above 100%: no valid price
+            skipped += 1
+            continue
+        base = res["base"]
+        custos = [float(base[k]) for k in ("materiais", "processos", "terceiros", "administrativos")]
+        updates.append((preco, link_id))
+        history.append((product_id, client_id, agora, *custos, float(res["impostos_valor"]), sum(custos), preco, float(margem)))
+    return shard_id, updates, history, skipped
+
+def _commit_shard(db, job_id, shard_id, updates, history, skipped):
+    with db.transaction() as conn:
+        conn.executemany("UPDATE product_clients SET preco_final=? WHERE id=?", updates)
+        conn.executemany(COST_HISTORY_INSERT, history)
+        conn.execute("UPDATE reprice_shards SET concluido_em=? WHERE id=?", (_now(), shard_id))
+        conn.execute(
+            "UPDATE reprice_jobs SET feitos=feitos+?, ignorados=ignorados+?, atualizado_em=? WHERE id=?",
+            (len(updates), skipped, _now(), job_id),
+        )
+        bump_versions(conn, "product_clients", "product_cost_history")
+
+def _set_status(db, job_id, status, erro=None):
+    with db.transaction() as conn:
+        conn.execute(
+            "UPDATE reprice_jobs SET status=?, erro=?, atualizado_em=?, "
+            "iniciado_em=CASE WHEN ?='executando' THEN COALESCE(iniciado_em, ?) ELSE iniciado_em END, "
+            "concluido_em=CASE WHEN ?='concluido' THEN ? ELSE concluido_em END WHERE id=?",
+            (status, erro, _now(), status, _now(), status, _now(), job_id),
+        )
+
+def run_job(db, job_id, workers=None):
+    conn = db.connection()
+    filtros = json.loads(conn.execute("SELECT filtros FROM reprice_jobs WHERE id=?", (job_id,)).fetchone()[0])
+    pending = conn.execute(
+        "SELECT id, primeiro_id, ultimo_id FROM reprice_shards WHERE job_id=? AND concluido_em IS NULL ORDER BY id", (job_id,)
+    ).fetchall()
+    _set_status(db, job_id, "executando")
+    try:
+        if pending:
+            workers = workers or max(1, min(os.cpu_count() or 1, len(pending)))
+            with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"), initializer=_init_worker, initargs=(db.path,)) as pool:
+                queue = iter(pending)
+                running = set()
+                while True:
+                    # At most two shards per worker in flight: results wait in memory until committed
+                    for shard in queue:
+                        running.add(pool.submit(_price_shard, shard[0], shard[1], shard[2], filtros))
+                        if len(running) >= 2 * workers:
+                            break
+                    if not running:
+                        break
+                    done, running = wait(running, timeout=HEARTBEAT_SECONDS, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        _commit_shard(db, job_id, *future.result())
+                    if not done:
+                        _set_status(db, job_id, "executando")
+        _set_status(db, job_id, "concluido")
+    except BaseException as e:
+        _set_status(db, job_id, "erro", f"{type(e).__name__}: {e}")
+        raise
+
+def job_status(conn, job_id=None):
+    # The job (default: the latest) with progress from its finished shards
+    row = conn.execute(
+        "SELECT id, status, filtros, total_links, feitos, ignorados, criado_em, iniciado_em, atualizado_em, concluido_em, erro FROM reprice_jobs "
+        + ("WHERE id=?" if job_id else "ORDER BY id DESC LIMIT 1"),
+        (job_id,) if job_id else (),
+    ).fetchone()
+    if row is None:
+        return None
+    job = dict(zip(("id", "status", "filtros", "total_links", "feitos", "ignorados", "criado_em", "iniciado_em", "atualizado_em", "concluido_em", "erro"), row))
+    done = conn.execute("SELECT COALESCE(SUM(links), 0) FROM reprice_shards WHERE job_id=? AND concluido_em IS NOT NULL", (job["id"],)).fetchone()[0]
+    total = job["total_links"]
+    job["progresso"] = done / total if total else 1.0
+    job["eta_s"] = None
+    now = datetime.now()
+    if job["iniciado_em"] and job["status"] == "executando" and 0 < done < total:
+        elapsed = (now - datetime.strptime(job["iniciado_em"], "%Y-%m-%d %H:%M:%S")).total_seconds()
+        job["eta_s"] = elapsed / done * (total - done)
+    # Failed, or no heartbeat for STALE_SECONDS (the process was killed or never started)
+    heartbeat = datetime.strptime(job["atualizado_em"] or job["criado_em"], "%Y-%m-%d %H:%M:%S")
+    job["interrompido"] = job["status"] == "erro" or (
+        job["status"] in ("pendente", "executando") and (now - heartbeat).total_seconds() > STALE_SECONDS
+    )
+    return job
+
+def start_background(db, job_id, workers=None):
+    # Runs the job in its own process, detached from the Streamlit server
+    args = [sys.executable, "-m", "pricing.reprice", "--db", db.path, "--job", str(job_id)]
+    if workers:
+        args += ["--workers", str(workers)]
+    return subprocess.Popen(
+        args, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True,
+    )
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reprecifica os vínculos produto-cliente")
+    parser.add_argument("--db", help="arquivo SQLite (padrão: precificacao.db no diretório atual)")
+    parser.add_argument("--job", type=int, help="executa (ou retoma) este job")
+    parser.add_argument("--retomar", action="store_true", help="retoma os jobs interrompidos")
+    parser.add_argument("--cliente", type=int, action="append", default=[], help="id do cliente (repetível)")
+    parser.add_argument("--grupo", action="append", default=[], help="grupo do produto (repetível)")
+    parser.add_argument("--produto", type=int, action="append", default=[], help="id do produto (repetível)")
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args(argv)
+    db = Database(args.db)
+    if args.job:
+        jobs = [args.job]
+    elif args.retomar:
+        ids = [r[0] for r in db.connection().execute("SELECT id FROM reprice_jobs WHERE status <> 'concluido' ORDER BY id").fetchall()]
+        jobs = [i for i in ids if job_status(db.connection(), i)["interrompido"]]
+    else:
+        jobs = [create_job(db, args.cliente, args.grupo, args.produto)]
+    for job_id in jobs:
+        run_job(db, job_id, args.workers)
+        job = job_status(db.connection(), job_id)
+        print(f"job {job_id}: {job['feitos']:,} vínculos reprecificados, {job['ignorados']:,} ignorados", file=sys.stderr)
+    db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+from collections import defaultdict, deque
+from pricing.engine import _d
+
+CATEGORIES = ("materiais", "processos", "terceiros")
+
+PRICE_SQL = {
+    "materiais": "SELECT id, preco_unitario FROM vertical_materials",
+    "processos": "SELECT id, preco_unitario_hora FROM vertical_processes",
+    "terceiros": "SELECT id, preco_unitario FROM third_party_items",
+}
+USAGE_SQL = {
+    "materiais": "SELECT product_id, material_id, quantidade FROM materials_usage",
+    "processos": "SELECT product_id, process_id, horas FROM processes_usage",
+    "terceiros": "SELECT product_id, third_id, quantidade FROM third_usage",
+}
+COMPONENTS_SQL = "SELECT parent_product_id, component_product_id, quantidade FROM product_components"
+
+def _chunks(ids, size=900):
+    ids = list(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+class CostRollup:
+    # In-memory BOM: every usage row, every price and the component DAG are
+    # loaded once and the whole catalog is costed in one bottom-up pass.
+    def __init__(self):
+        self.admin = _d(0)
+        self.prices = {"materiais": {}, "processos": {}, "terceiros": {}}
+        self.usage = {"materiais": defaultdict(list), "processos": defaultdict(list), "terceiros": defaultdict(list)}
+        self.used_in = {"materiais": defaultdict(set), "processos": defaultdict(set), "terceiros": defaultdict(set)}  # where-used
+        self.components = defaultdict(list)  # parent -> [(component, quantidade)]
+        self.parents = defaultdict(list)  # component -> [(parent, quantidade)]
+        self.order = []
+        self.costs = {}
+
+    @classmethod
+    def load(cls, conn):
+        rollup = cls()
+        cur = conn.cursor()
+        for categoria in CATEGORIES:
+            rollup.prices[categoria] = {r[0]: _d(r[1]) for r in cur.execute(PRICE_SQL[categoria]).fetchall()}
+            for product_id, item_id, qty in cur.execute(USAGE_SQL[categoria] + " ORDER BY id").fetchall():
+                rollup._add_usage(categoria, product_id, item_id, qty)
+        for parent_id, component_id, qty in cur.execute(COMPONENTS_SQL + " ORDER BY id").fetchall():
+            rollup._add_component(parent_id, component_id, qty)
+        cur.execute("SELECT SUM(valor) FROM admin_costs")
+        rollup.admin = _d(cur.fetchone()[0] or 0)
+        cur.execute("SELECT id FROM products")
+        rollup.compute([r[0] for r in cur.fetchall()])
+        return rollup
+
+    def _add_usage(self, categoria, product_id, item_id, qty):
+        self.usage[categoria][product_id].append((item_id, _d(qty)))
+        self.used_in[categoria][item_id].add(product_id)
+
+    def _add_component(self, parent_id, component_id, qty):
+        self.components[parent_id].append((component_id, _d(qty)))
+        self.parents[component_id].append((parent_id, _d(qty)))
+
+    def _own_cost(self, product_id, categoria):
+        prices = self.prices[categoria]
+        # Rows pointing to deleted items are dropped, as the JOINs in get_base_cost do
+        return sum((qty * prices[item_id] for item_id, qty in self.usage[categoria].get(product_id, ()) if item_id in prices), _d(0))
+
+    def _node_cost(self, product_id):
+        cost = {}
+        for categoria in CATEGORIES:
+            own = self._own_cost(product_id, categoria)
+            from_components = _d(0)
+            for component_id, qty in self.components.get(product_id, ()):
+                component = self.costs.get(component_id)
+                if component is not None:
+                    from_components += component[categoria] * qty
+            cost[categoria] = own + from_components
+            cost["own_" + categoria] = own
+        return cost
+
+    def compute(self, product_ids=()):
+        nodes = set(product_ids)
+        for categoria in CATEGORIES:
+            nodes.update(self.usage[categoria])
+        nodes.update(self.components)
+        nodes.update(self.parents)
+        pending = {n: len(self.components.get(n, ())) for n in nodes}
+        queue = deque(n for n in nodes if pending[n] == 0)
+        order = []
+        costs = {}
+        self.costs = costs
+        while queue:
+            node = queue.popleft()
+            costs[node] = self._node_cost(node)
+            order.append(node)
+            for parent_id, _qty in self.parents.get(node, ()):
+                pending[parent_id] -= 1
+                if pending[parent_id] == 0:
+                    queue.append(parent_id)
+        if len(order) != len(nodes):
+            stuck = sorted(n for n in nodes if n not in costs)
+            raise ValueError(f"Ciclo na composição de produtos envolvendo os IDs: {stuck[:20]}")
+        self.order = order
+        return costs
+
+    def base_cost(self, product_id):
+        cost = self.costs.get(product_id)
+        if cost is None:
+            cost = {k: _d(0) for k in CATEGORIES + tuple("own_" + c for c in CATEGORIES)}
+        total = cost["materiais"] + cost["processos"] + cost["terceiros"]
+        return {
+            "materiais": cost["materiais"],
+            "processos": cost["processos"],
+            "terceiros": cost["terceiros"],
+            "administrativos": self.admin,
+            "sem_impostos": total + self.admin,
+            "own_materiais": cost["own_materiais"],
+            "own_processos": cost["own_processos"],
+            "own_terceiros": cost["own_terceiros"],
+        }
+
+    def ancestors(self, product_ids):
+        seen = set(product_ids)
+        stack = list(seen)
+        while stack:
+            for parent_id, _qty in self.parents.get(stack.pop(), ()):
+                if parent_id not in seen:
+                    seen.add(parent_id)
+                    stack.append(parent_id)
+        return seen
+
+    def _reload_prices(self, cur, categoria, item_ids):
+        prices = self.prices[categoria]
+        for chunk in _chunks(item_ids):
+            marks = ",".join("?" * len(chunk))
+            found = {r[0]: _d(r[1]) for r in cur.execute(f"{PRICE_SQL[categoria]} WHERE id IN ({marks})", chunk).fetchall()}
+            for item_id in chunk:
+                if item_id in found:
+                    prices[item_id] = found[item_id]
+                else:
+                    prices.pop(item_id, None)
+
+    def _reload_compositions(self, cur, product_ids):
+        product_ids = set(product_ids)
+        for categoria in CATEGORIES:
+            for product_id in product_ids:
+                for item_id, _qty in self.usage[categoria].pop(product_id, ()):
+                    self.used_in[categoria][item_id].discard(product_id)
+        for product_id in product_ids:
+            for component_id, _qty in self.components.pop(product_id, ()):
+                self.parents[component_id] = [p for p in self.parents[component_id] if p[0] != product_id]
+        for chunk in _chunks(product_ids):
+            marks = ",".join("?" * len(chunk))
+            for categoria in CATEGORIES:
+                for product_id, item_id, qty in cur.execute(f"{USAGE_SQL[categoria]} WHERE product_id IN ({marks}) ORDER BY id", chunk).fetchall():
+                    self._add_usage(categoria, product_id, item_id, qty)
+            for parent_id, component_id, qty in cur.execute(f"{COMPONENTS_SQL} WHERE parent_product_id IN ({marks}) ORDER BY id", chunk).fetchall():
+                self._add_component(parent_id, component_id, qty)
+
+    def propagate(self, conn, material_ids=(), process_ids=(), third_ids=(), product_ids=()):
+        # Incremental update after price or composition changes: reloads only the
+        # touched prices/compositions, then recomputes the affected products and
+        # their ancestors (walking up the where-used index) in dependency order.
+        # Returns [{"product_id", "old", "new"}] for products whose cost changed.
+        cur = conn.cursor()
+        dirty = set(product_ids)
+        for categoria, ids in (("materiais", material_ids), ("processos", process_ids), ("terceiros", third_ids)):
+            if ids:
+                self._reload_prices(cur, categoria, ids)
+                for item_id in ids:
+                    dirty.update(self.used_in[categoria].get(item_id, ()))
+        if product_ids:
+            self._reload_compositions(cur, product_ids)
+        affected = self.ancestors(dirty)
+        pending = {n: sum(1 for c, _q in self.components.get(n, ()) if c in affected) for n in affected}
+        queue = deque(n for n in affected if pending[n] == 0)
+        old = {n: self.costs.get(n) for n in affected}
+        done = 0
+        while queue:
+            node = queue.popleft()
+            self.costs[node] = self._node_cost(node)
+            done += 1
+            for parent_id, _qty in self.parents.get(node, ()):
+                if parent_id in pending:
+                    pending[parent_id] -= 1
+                    if pending[parent_id] == 0:
+                        queue.append(parent_id)
+        if done != len(affected):
+            stuck = sorted(n for n in affected if pending[n] > 0)
+            raise ValueError(f"Ciclo na composição de produtos envolvendo os IDs: {stuck[:20]}")
+        changes = []
+        for node in affected:
+            before = old[node]
+            after = self.costs[node]
+            if before is None or any(before[k] != after[k] for k in CATEGORIES):
+                changes.append({
+                    "product_id": node,
+                    "old": {k: before[k] if before else _d(0) for k in CATEGORIES},
+                    "new": {k: after[k] for k in CATEGORIES},
+                })
+        changes.sort(key=lambda c: c["product_id"])
+        return changes
+
+    # Lookup protocol shared with get_base_cost(conn, product_id, rollup=...);
+    # a product created after load() is not known here and goes to SQL
+    def get(self, product_id):
+        if product_id not in self.costs:
+            return None
+        return self.base_cost(product_id)
+
+    def put(self, product_id, cost):
+        pass
@@ -0,0 +1,180 @@
+from collections import deque
+import numpy as np
+import pandas as pd
+from pricing.db import SCENARIO_TARGETS
+from pricing.rollup import CATEGORIES, USAGE_SQL, COMPONENTS_SQL
+
+# What-if scenarios ("aço +12%, horas de CNC +5%") evaluated against the base
+# catalog in memory: the adjustments live in scenario_adjustments and are
+# applied to copies of the price vectors only, nothing is written.
+# Cost is linear in the item prices, so every scenario is one column of a
+# products x scenarios matrix: own costs by np.add.at over the usage rows, then
+# components added level by level, bottom-up, for all columns at once.
+#   rollup = ScenarioRollup.load(conn)
+#   por_produto, resumo = compare_scenarios(conn, [1, 2], rollup=rollup)
+# Deltas are what-if estimates in float64, rounded to centavos; quotes still
+# go through suggest_sale_price.
+
+ITEMS_SQL = {
+    "materiais": "SELECT id, preco_unitario, COALESCE(grupo, ''), COALESCE(fornecedor, '') FROM vertical_materials ORDER BY id",
+    "processos": "SELECT id, preco_unitario_hora, COALESCE(grupo, ''), '' FROM vertical_processes ORDER BY id",
+    "terceiros": "SELECT id, preco_unitario, '', COALESCE(fornecedor, '') FROM third_party_items ORDER BY id",
+}
+BASE = "Base"
+
+def _positions(ids, values):
+    pos = np.searchsorted(ids, values)
+    found = (pos < len(ids)) & (ids[np.minimum(pos, max(len(ids) - 1, 0))] == values) if len(ids) else np.zeros(len(values), dtype=bool)
+    return pos, found
+
+def _rows(cur, sql, width):
+    return np.array(cur.execute(sql).fetchall(), dtype=object).reshape(-1, width)
+
+
+class ScenarioRollup:
+    def __init__(self, product_ids):
+        self.ids = np.asarray(product_ids, dtype=np.int64)
+        self.admin = 0.0
+        self.items = {}  # categoria -> {"ids", "precos", "grupo", "fornecedor"}
+        self.usage = {}  # categoria -> (posição do produto, posição do item, quantidade)
+        self.levels = []  # [(pais, componentes, quantidade)] de baixo para cima
+
+    @classmethod
+    def load(cls, conn):
+        cur = conn.cursor()
+        rollup = cls([r[0] for r in cur.execute("SELECT id FROM products ORDER BY id").fetchall()])
+        for categoria in CATEGORIES:
+            items = _rows(cur, ITEMS_SQL[categoria], 4)
+            ids = items[:, 0].astype(np.int64)
+            rollup.items[categoria] = {
+                "ids": ids,
+                "precos": pd.to_numeric(pd.Series(items[:, 1]), errors="coerce").fillna(0.0).to_numpy(float),
+                "grupo": items[:, 2].astype(str),
+                "fornecedor": items[:, 3].astype(str),
+            }
+            usage = np.array(cur.execute(USAGE_SQL[categoria]).fetchall(), dtype=float).reshape(-1, 3)
+            pos, found = _positions(rollup.ids, usage[:, 0].astype(np.int64))
+            item, has_item = _positions(ids, usage[:, 1].astype(np.int64))
+            # Rows pointing to deleted items are dropped, as in CostRollup
+            keep = found & has_item
+            rollup.usage[categoria] = (pos[keep], item[keep], np.nan_to_num(usage[keep, 2]))
+        rollup._add_components(np.array(cur.execute(COMPONENTS_SQL).fetchall(), dtype=float).reshape(-1, 3))
+        rollup.admin = float(cur.execute("SELECT SUM(valor) FROM admin_costs").fetchone()[0] or 0)
+        return rollup
+
+    def _add_components(self, edges):
+        parent, p_found = _positions(self.ids, edges[:, 0].astype(np.int64))
+        child, c_found = _positions(self.ids, edges[:, 1].astype(np.int64))
+        keep = p_found & c_found
+        parent, child, qty = parent[keep], child[keep], np.nan_to_num(edges[keep, 2])
+        # Level of each product = longest chain of components below it
+        n = len(self.ids)
+        pending = np.bincount(parent, minlength=n)
+        by_child = {}
+        for e, c in enumerate(child.tolist()):
+            by_child.setdefault(c, []).append(e)
+        level = np.zeros(n, dtype=np.int64)
+        queue = deque(np.flatnonzero(pending == 0).tolist())
+        seen = 0
+        while queue:
+            node = queue.popleft()
+            seen += 1
+            for e in by_child.get(node, ()):
+                p = parent[e]
+                level[p] = max(level[p], level[node] + 1)
+                pending[p] -= 1
+                if pending[p] == 0:
+                    queue.append(p)
+        if seen != n:
+            stuck = self.ids[pending > 0]
+            raise ValueError(f"Ciclo na composição de produtos envolvendo os IDs: {sorted(stuck.tolist())[:20]}")
+        edge_level = level[parent]
+        self.levels = [
+            (parent[at], child[at], qty[at])
+            for at in (edge_level == lv for lv in range(1, int(level.max(initial=0)) + 1))
+        ]
+
+    def adjusted_prices(self, categoria, ajustes):
+        # Item prices of one category with a scenario's adjustments: every
+        # matching percentage multiplies, then absolute amounts are added
+        items = self.items[categoria]
+        fator = np.ones(len(items["ids"]))
+        soma = np.zeros(len(items["ids"]))
+        for a in ajustes:
+            if a["categoria"] != categoria:
+                continue
+            if a["alvo"] == "id":
+                alvo = items["ids"] == int(a["valor"])
+            else:
+                alvo = items[a["alvo"]] == str(a["valor"])
+            if a["tipo"] == "pct":
+                fator[alvo] *= 1 + float(a["ajuste"]) / 100
+            else:
+                soma[alvo] += float(a["ajuste"])
+        return np.maximum(items["precos"] * fator + soma, 0.0)
+
+    def evaluate(self, scenarios):
+        # scenarios: [ajustes] -> costs[categoria] of shape (produtos, 1 + cenários);
+        # column 0 is the base catalog
+        costs = {}
+        for categoria in CATEGORIES:
+            precos = np.column_stack([self.items[categoria]["precos"]] + [self.adjusted_prices(categoria, a) for a in scenarios])
+            pos, item, qty = self.usage[categoria]
+            own = np.zeros((len(self.ids), precos.shape[1]))
+            np.add.at(own, pos, qty[:, None] * precos[item])
+            for parent, child, q in self.levels:
+                np.add.at(own, parent, own[child] * q[:, None])
+            costs[categoria] = own
+        return costs
+
+def load_scenarios(conn, scenario_ids):
+    # {nome: [ajustes]} in the order of scenario_ids
+    out = {}
+    for scenario_id in scenario_ids:
+        row = conn.execute("SELECT nome FROM scenarios WHERE id=?", (int(scenario_id),)).fetchone()
+        if row is None:
+            raise KeyError(f"Cenário {scenario_id} não encontrado")
+        rows = conn.execute(
+            "SELECT categoria, alvo, valor, tipo, ajuste FROM scenario_adjustments WHERE scenario_id=? ORDER BY id", (int(scenario_id),)
+        ).fetchall()
+        out[row[0]] = [dict(zip(("categoria", "alvo", "valor", "tipo", "ajuste"), r)) for r in rows]
+    return out
+
+def compare_scenarios(conn, scenario_ids, product_ids=None, rollup=None):
+    # -> (por_produto, resumo). por_produto has one row per product and
+    # scenario (base included) with the costs by category, custo (sem impostos,
+    # admin included) and delta/delta_pct against the base; resumo sums them
+    # per scenario over the products evaluated (default: the whole catalog)
+    rollup = rollup or ScenarioRollup.load(conn)
+    scenarios = load_scenarios(conn, scenario_ids)
+    costs = rollup.evaluate(list(scenarios.values()))
+    if product_ids is None:
+        pos = np.arange(len(rollup.ids))
+    else:
+        pos, found = _positions(rollup.ids, np.asarray(list(product_ids), dtype=np.int64))
+        pos = pos[found]
+    nomes = [BASE] + list(scenarios)
+    frames = []
+    for s, nome in enumerate(nomes):
+        df = pd.DataFrame({"cenario": nome, "product_id": rollup.ids[pos]})
+        for categoria in CATEGORIES:
+            df[categoria] = costs[categoria][pos, s]
+        df["custo"] = df[list(CATEGORIES)].sum(axis=1) + rollup.admin
+        frames.append(df)
+    por_produto = pd.concat(frames, ignore_index=True)
+    base = np.tile(frames[0]["custo"].to_numpy(), len(nomes))
+    por_produto["delta"] = por_produto["custo"] - base
+    por_produto["delta_pct"] = np.divide(por_produto["delta"] * 100, base, out=np.zeros(len(base)), where=base != 0)
+    money = list(CATEGORIES) + ["custo", "delta", "delta_pct"]
+    por_produto[money] = por_produto[money].round(2)
+    por_produto["cenario"] = pd.Categorical(por_produto["cenario"], categories=nomes)
+    resumo = por_produto.groupby("cenario", observed=False).agg(
+        produtos_afetados=("delta", lambda d: int((d != 0).sum())),
+        custo_total=("custo", "sum"),
+        delta_total=("delta", "sum"),
+        maior_delta=("delta", "max"),
+    ).reset_index()
+    custo_base = resumo["custo_total"].iloc[0]
+    resumo["delta_pct"] = (resumo["delta_total"] * 100 / custo_base).round(2) if custo_base else 0.0
+    resumo[["custo_total", "delta_total"]] = resumo[["custo_total", "delta_total"]].round(2)
+    return por_produto, resumo
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+from pricing.engine import _round_cents, _tax_rate_for_product, get_base_cost, suggest_sale_price
+from pricing.instrument import stage, traced
+
+# Volume x margin sensitivity of one product for one client: price, real
+# margin and tax value for every combination of margins, admin/frete/outros
+# percentages and order volumes, in one NumPy evaluation over a base cost
+# taken once from the rollup.
+# Without percentages the admin cost is the fixed admin_costs total, spread
+# over the order volume; with percentages it is proportional to the direct
+# cost and volume only scales receita/lucro. Volume 1 is suggest_sale_price.
+
+@traced("sensitivity_grid")
+def sensitivity_grid(conn, product_id, client_id, margens, admin_pcts=(0.0,), frete_pcts=(0.0,), outros_pcts=(0.0,), volumes=(1,), rollup=None, taxes=None):
+    with stage("rollup"):
+        base = get_base_cost(conn, product_id, rollup)
+    with stage("impostos"):
+        taxa = float(_tax_rate_for_product(conn, product_id, client_id, taxes)["total"])
+    with stage("preco"):
+        axes = [np.asarray(a, dtype=float).ravel() for a in (margens, admin_pcts, frete_pcts, outros_pcts, volumes)]
+        if (axes[4] <= 0).any():
+            raise ValueError("Volumes devem ser maiores que zero")
+        margem, admin_pct, frete_pct, outros_pct, volume = (a.ravel() for a in np.meshgrid(*axes, indexing="ij"))
+        core = float(base["materiais"] + base["processos"] + base["terceiros"])
+        perc = admin_pct + frete_pct + outros_pct
+        sem = core + np.where(perc > 0, core * perc / 100.0, float(base["administrativos"]) / volume)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            preco = sem / (1.0 - margem / 100.0 - taxa)
+            impostos = preco * taxa
+            margem_real = (preco - sem - impostos) / preco * 100.0
+        # margem + impostos >= 100%: no price
+        valid = np.isfinite(preco) & (preco > 0)
+        preco, impostos, margem_real = (np.where(valid, x, np.nan) for x in (preco, impostos, margem_real))
+        preco_r, amb_p = _round_cents(preco)
+        impostos_r, amb_i = _round_cents(impostos)
+        margem_real_r, amb_m = _round_cents(margem_real)
+        out = pd.DataFrame({
+            "margem": margem,
+            "admin_pct": admin_pct,
+            "frete_pct": frete_pct,
+            "outros_pct": outros_pct,
+            "volume": volume,
+            "custo_unitario": _round_cents(sem)[0],
+            "preco_venda": preco_r,
+            "impostos_valor": impostos_r,
+            "margem_real_percent": margem_real_r,
+        })
+        # Half-cent ties at volume 1 are redone in Decimal, as price_grid does
+        for row in np.flatnonzero((amb_p | amb_i | amb_m) & valid & (volume == 1)):
+            res = suggest_sale_price(conn, product_id, client_id, margem[row], admin_pct[row], frete_pct[row], outros_pct[row], rollup=rollup, taxes=taxes)
+            out.loc[row, ["preco_venda", "impostos_valor", "margem_real_percent"]] = [float(res["preco_venda"]), float(res["impostos_valor"]), float(res["margem_real_percent"])]
+        out["receita"] = (out["preco_venda"] * volume).round(2)
+        out["lucro"] = ((out["preco_venda"] - out["custo_unitario"] - out["impostos_valor"]) * volume).round(2)
+    return out
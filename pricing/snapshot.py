@@ -0,0 +1,102 @@
+import argparse
+import sys
+from datetime import datetime
+from decimal import ROUND_HALF_UP
+from pricing.db import Database, bump_versions
+from pricing.engine import TaxResolver, _d, get_base_cost, suggest_sale_price
+from pricing.instrument import traced
+from pricing.rollup import CostRollup, _chunks
+
+# Materialized current costs: product_cost_snapshot holds the rolled-up cost
+# of every product and product_quote_snapshot the quote of every
+# product_clients link at its own margem, so the portfolio views read stored
+# rows (frames "client_portfolio" / "client_portfolio_metrics") instead of
+# pricing links on each rerun. Writes to any input mark the products they
+# touch in snapshot_dirty (triggers from pricing.db.SNAPSHOT_SOURCES);
+# refresh_snapshot recomputes those and their ancestors only.
+#   refresh_snapshot(db)                    # one SELECT when nothing is marked
+#   python -m pricing.snapshot --completo   # recompute everything
+# Quotes use the default admin costs, as the reprice job does.
+
+FULL_ROLLUP_AT = 200  # marked products above which the whole catalog is costed in memory
+
+COST_SNAPSHOT_UPSERT = (
+    "INSERT OR REPLACE INTO product_cost_snapshot (product_id, custo_materiais, custo_processos, custo_terceiros, "
+    "custos_admin, custo_total_sem_impostos, atualizado_em) VALUES (?,?,?,?,?,?,?)"
+)
+QUOTE_SNAPSHOT_UPSERT = (
+    "INSERT OR REPLACE INTO product_quote_snapshot (link_id, margem, preco_atual, impostos_atual, margem_real_atual, atualizado_em) "
+    "VALUES (?,?,?,?,?,?)"
+)
+
+
+class _Memo(dict):
+    # get/put lookup for get_base_cost: shared components are costed once per refresh
+    def put(self, product_id, cost):
+        self[product_id] = cost
+
+def _cents(value):
+    return float(value.quantize(_d("0.01"), rounding=ROUND_HALF_UP))
+
+def _quote(conn, product_id, client_id, margem, rollup, taxes):
+    # (preco, impostos, margem real), all None when there is no valid price
+    if margem is None:
+        return None, None, None
+    try:
+        res = suggest_sale_price(conn, product_id, client_id, margem, rollup=rollup, taxes=taxes)
+    except ArithmeticError:
+        return None, None, None
+    if res["preco_venda"] <= 0:
+        return None, None, None
+    return float(res["preco_venda"]), float(res["impostos_valor"]), float(res["margem_real_percent"])
+
+def mark_all(db):
+    with db.transaction() as conn:
+        conn.execute("INSERT OR IGNORE INTO snapshot_dirty (product_id) SELECT id FROM products")
+
+@traced("refresh_snapshot")
+def refresh_snapshot(db):
+    # Returns how many products were recomputed. Runs in one write
+    # transaction, so a product marked meanwhile waits for the next refresh
+    # instead of being cleared unseen
+    if db.connection().execute("SELECT 1 FROM snapshot_dirty LIMIT 1").fetchone() is None:
+        return 0
+    with db.transaction() as conn:
+        ids = [r[0] for r in conn.execute(
+            "SELECT d.product_id FROM snapshot_dirty d JOIN products p ON p.id = d.product_id "
+            "UNION SELECT c.ancestor_id FROM product_closure c JOIN snapshot_dirty d ON d.product_id = c.descendant_id"
+        ).fetchall()]
+        full = len(ids) > FULL_ROLLUP_AT
+        rollup = CostRollup.load(conn) if full else _Memo()
+        taxes = TaxResolver.load(conn) if full else None
+        agora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        costs = []
+        for product_id in ids:
+            base = get_base_cost(conn, product_id, rollup)
+            core = [_cents(base[k]) for k in ("materiais", "processos", "terceiros", "administrativos")]
+            costs.append((product_id, *core, _cents(base["sem_impostos"]), agora))
+        conn.executemany(COST_SNAPSHOT_UPSERT, costs)
+        quotes = []
+        for chunk in _chunks(ids):
+            for link_id, product_id, client_id, margem in conn.execute(
+                f"SELECT id, product_id, client_id, margem FROM product_clients WHERE product_id IN ({','.join('?' * len(chunk))})", chunk
+            ).fetchall():
+                quotes.append((link_id, margem, *_quote(conn, product_id, client_id, margem, rollup, taxes), agora))
+        conn.executemany(QUOTE_SNAPSHOT_UPSERT, quotes)
+        conn.execute("DELETE FROM snapshot_dirty")
+        bump_versions(conn, "product_cost_snapshot", "product_quote_snapshot")
+    return len(ids)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Atualiza os custos e cotações atuais (product_cost_snapshot / product_quote_snapshot)")
+    parser.add_argument("--db", help="arquivo SQLite (padrão: precificacao.db no diretório atual)")
+    parser.add_argument("--completo", action="store_true", help="recalcula todos os produtos, não só os alterados")
+    args = parser.parse_args(argv)
+    db = Database(args.db)
+    if args.completo:
+        mark_all(db)
+    print(f"{refresh_snapshot(db):,} produtos atualizados", file=sys.stderr)
+    db.close()
+
+if __name__ == "__main__":
+    main()
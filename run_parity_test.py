@@ -0,0 +1,527 @@
+import io
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import zipfile
+from decimal import ROUND_HALF_UP, InvalidOperation
+import numpy as np
+import pandas as pd
+from pricing.db import Database, MONEY_COLUMNS, COST_HISTORY_INSERT, bump_versions, has_search_index
+from pricing.engine import get_base_cost, price_grid, check_price_parity, suggest_sale_price, TaxResolver, _d
+from pricing.rollup import CostRollup, CATEGORIES
+from pricing.cache import RollupCache
+from pricing.fixedpoint import price_grid_fixed
+from pricing.scenarios import compare_scenarios
+from pricing.sensitivity import sensitivity_grid
+from pricing.history import compact_history, history_series
+from pricing.snapshot import refresh_snapshot
+from pricing.frames import load_frame
+from pricing.auth import LEGACY_ITERATIONS, hash_password, needs_rehash, verify_password
+from pricing.provision import provision, read_roster
+from pricing import export
+from pricing.erp_import import import_erp_file
+
+# Small catalog: PRD-0001 (seed) plus a 3-level DAG with a shared component
+#   CONJ-A -> SUB-1 (x2), SUB-2 (x1); SUB-1 -> PEÇA (x3); SUB-2 -> PEÇA (x0.5)
+#   CONJ-B -> CONJ-A (x4), PEÇA (x1)
+
+def build(db):
+    db.seed_demo()
+    conn = db.connection()
+    mat_id = conn.execute("SELECT id FROM vertical_materials LIMIT 1").fetchone()[0]
+    proc_id = conn.execute("SELECT id FROM vertical_processes LIMIT 1").fetchone()[0]
+    third_id = conn.execute("SELECT id FROM third_party_items LIMIT 1").fetchone()[0]
+    ids = {}
+    for codigo in ("PECA", "SUB-1", "SUB-2", "CONJ-A", "CONJ-B"):
+        ids[codigo] = db.add_product(codigo, codigo, 1, "SP", "7208.38.90", "SP")
+    db.add_material_usage(ids["PECA"], mat_id, 2.35)
+    db.add_process_usage(ids["PECA"], proc_id, 0.75)
+    db.add_process_usage(ids["SUB-1"], proc_id, 1.5)
+    db.add_third_usage(ids["SUB-2"], third_id, 1)
+    db.add_component_usage(ids["SUB-1"], ids["PECA"], 3)
+    db.add_component_usage(ids["SUB-2"], ids["PECA"], 0.5)
+    db.add_component_usage(ids["CONJ-A"], ids["SUB-1"], 2)
+    db.add_component_usage(ids["CONJ-A"], ids["SUB-2"], 1)
+    db.add_material_usage(ids["CONJ-A"], mat_id, 10)
+    db.add_component_usage(ids["CONJ-B"], ids["CONJ-A"], 4)
+    db.add_component_usage(ids["CONJ-B"], ids["PECA"], 1)
+    return ids
+
+def all_products(conn):
+    return [r[0] for r in conn.execute("SELECT id FROM products ORDER BY id").fetchall()]
+
+def check_rollup(conn, rollup):
+    for pid in all_products(conn):
+        expected = get_base_cost(conn, pid)
+        got = rollup.base_cost(pid)
+        assert all(got[k] == expected[k] for k in expected), (pid, got, expected)
+
+def check_grid(conn, **pcts):
+    products = all_products(conn)
+    clients = [r[0] for r in conn.execute("SELECT id FROM clients").fetchall()]
+    grid = price_grid(conn, products, clients, [0, 12.5, 25, 33.3, 60], **pcts)
+    bad = check_price_parity(conn, grid, **pcts)
+    assert bad.empty, bad
+
+def check_fixed(conn, **pcts):
+    # Integer path: cent-exact against suggest_sale_price, including the rows
+    # it hands back to Decimal; returns how many rows needed the fallback
+    products = all_products(conn)
+    clients = [r[0] for r in conn.execute("SELECT id FROM clients").fetchall()]
+    grid = price_grid_fixed(conn, products, clients, [0, 12.5, 25, 33.3, 60], **pcts)
+    bad = check_price_parity(conn, grid, **pcts)
+    assert bad.empty, bad
+    return grid.attrs["fallback_rows"]
+
+def check_money_columns(conn):
+    for table, (column, centavos) in MONEY_COLUMNS.items():
+        for value, cents in conn.execute(f"SELECT {column}, {centavos} FROM {table}").fetchall():
+            exact = _d(value) * 100 == (_d(value) * 100).to_integral_value()
+            assert cents == (int(_d(value) * 100) if exact else None), (table, value, cents)
+
+def recursive_explode(conn, product_id, depth=1, factor=_d(1), acc=None):
+    acc = {} if acc is None else acc
+    for component_id, qty in conn.execute("SELECT component_product_id, quantidade FROM product_components WHERE parent_product_id=?", (product_id,)).fetchall():
+        total = factor * _d(qty)
+        d, q = acc.get(component_id, (depth, _d(0)))
+        acc[component_id] = (min(d, depth), q + total)
+        recursive_explode(conn, component_id, depth + 1, total, acc)
+    return acc
+
+def check_explode(db, conn):
+    for pid in all_products(conn):
+        expected = recursive_explode(conn, pid)
+        got = {r["product_id"]: (r["depth"], _d(r["quantidade"])) for r in db.explode(pid)}
+        assert set(got) == set(expected), (pid, got, expected)
+        for cid, (depth, qty) in expected.items():
+            assert got[cid][0] == depth and abs(got[cid][1] - qty) < _d("1e-9"), (pid, cid, got[cid], depth, qty)
+        used = {r["product_id"] for r in db.where_used(pid)}
+        assert used == {a for a in all_products(conn) if pid in recursive_explode(conn, a)}, pid
+
+def check_propagate(db, conn, ids):
+    rollup = CostRollup.load(conn)
+    mat_id = conn.execute("SELECT id FROM vertical_materials LIMIT 1").fetchone()[0]
+    with db.transaction():
+        conn.execute("UPDATE vertical_materials SET preco_unitario=? WHERE id=?", (9.37, mat_id))
+    changes = rollup.propagate(conn, material_ids=[mat_id])
+    assert {c["product_id"] for c in changes} >= {ids["PECA"], ids["CONJ-B"]}, changes
+    fresh = CostRollup.load(conn)
+    for pid in all_products(conn):
+        assert all(rollup.base_cost(pid)[k] == fresh.base_cost(pid)[k] for k in CATEGORIES), pid
+    db.replace_composition(ids["SUB-2"], materials=[("Chapa A36 3mm", 4)], components=[(ids["PECA"], 2)])
+    rollup.propagate(conn, product_ids=[ids["SUB-2"]])
+    fresh = CostRollup.load(conn)
+    for pid in all_products(conn):
+        assert all(rollup.base_cost(pid)[k] == fresh.base_cost(pid)[k] for k in CATEGORIES), pid
+    return fresh
+
+def build_random(db, seed, n_products=40):
+    # Random 2-decimal prices, 1-3 decimal quantities and a layered DAG
+    rng = random.Random(seed)
+    db.seed_demo()
+    conn = db.connection()
+    with db.transaction():
+        conn.executemany("INSERT INTO vertical_materials (nome, preco_unitario) VALUES (?,?)", [(f"M{i}", rng.randint(1, 500000) / 100) for i in range(30)])
+        conn.executemany("INSERT INTO vertical_processes (nome, preco_unitario_hora) VALUES (?,?)", [(f"P{i}", rng.randint(1, 40000) / 100) for i in range(10)])
+        conn.executemany("INSERT INTO clients (codigo, nome, uf, regime, pis, cofins, icms) VALUES (?,?,?,?,?,?,?)",
+                         [(str(i), f"C{i}", rng.choice(["SP", "RS"]), "real", 0.0165, 0.076, rng.choice([0.07, 0.12, 0.18])) for i in range(4)])
+    mats = [r[0] for r in conn.execute("SELECT id FROM vertical_materials").fetchall()]
+    procs = [r[0] for r in conn.execute("SELECT id FROM vertical_processes").fetchall()]
+    made = []
+    for i in range(n_products):
+        pid = db.add_product(f"R{i}", f"R{i}", 1, rng.choice(["SP", "MG"]), "7208.38.90", "SP")
+        for _ in range(rng.randint(1, 4)):
+            db.add_material_usage(pid, rng.choice(mats), round(rng.uniform(0.001, 50), rng.randint(1, 3)))
+        db.add_process_usage(pid, rng.choice(procs), round(rng.uniform(0.01, 8), 2))
+        for component_id in rng.sample(made[-10:], min(len(made[-10:]), rng.randint(0, 2))):
+            db.add_component_usage(pid, component_id, rng.randint(1, 4) / rng.choice([1, 2, 4]))
+        made.append(pid)
+
+def check_sensitivity(conn):
+    # Volume 1 is suggest_sale_price to the cent; fixed admin costs shrink with volume
+    client_id = conn.execute("SELECT MIN(id) FROM clients").fetchone()[0]
+    rollup = CostRollup.load(conn)
+    margens = [0, 12.5, 25, 33.3, 60, 95]
+    for pid in all_products(conn):
+        grid = sensitivity_grid(conn, pid, client_id, margens, admin_pcts=[0, 3.5], frete_pcts=[0, 1.25], volumes=[1, 10, 250], rollup=rollup)
+        for r in grid[grid["volume"] == 1].itertuples():
+            try:
+                res = suggest_sale_price(conn, pid, client_id, r.margem, r.admin_pct, r.frete_pct, r.outros_pct)
+            except ArithmeticError:
+                assert np.isnan(r.preco_venda), r
+                continue
+            if res["preco_venda"] <= 0:
+                assert np.isnan(r.preco_venda), r
+                continue
+            got = [_d(v).quantize(_d("0.01"), rounding=ROUND_HALF_UP) for v in (r.preco_venda, r.impostos_valor, r.margem_real_percent)]
+            assert got == [res["preco_venda"], res["impostos_valor"], res["margem_real_percent"]], (pid, r, res)
+        fixo = grid[(grid["admin_pct"] == 0) & (grid["frete_pct"] == 0) & (grid["margem"] == 25)].sort_values("volume")
+        assert fixo["custo_unitario"].is_monotonic_decreasing, fixo
+
+def check_history(db, conn):
+    # Repeated snapshots are skipped, long histories come back bucketed and
+    # retention keeps the last save of each older day/month
+    pid, cid = all_products(conn)[0], conn.execute("SELECT MIN(id) FROM clients").fetchone()[0]
+    conn.execute("DELETE FROM product_cost_history")
+    assert db.add_cost_history(pid, cid, 10, 5, 1, 2, 3, 30, 25, data_vinculo="2023-01-01 08:00:00")
+    assert not db.add_cost_history(pid, cid, 10, 5, 1, 2, 3, 30, 25, data_vinculo="2023-01-01 09:00:00")
+    rows = [(pid, cid, f"2023-{1 + d // 28:02d}-{1 + d % 28:02d} {h:02d}:00:00", 10 + d, 5, 1, 2, 3, 18 + d, 30 + d + h / 100, 25) for d in range(1, 300) for h in (8, 12, 17)]
+    with db.transaction():
+        conn.executemany(COST_HISTORY_INSERT, rows)
+    total = conn.execute("SELECT COUNT(*) FROM product_cost_history").fetchone()[0]
+    assert total == 1 + len(rows), total
+    serie = history_series(conn, pid, cid)
+    assert serie.attrs["bucket"] == "semana" and len(serie) <= 300, (serie.attrs, len(serie))
+    serie = history_series(conn, pid, cid, max_points=400)
+    assert serie.attrs["bucket"] == "dia" and len(serie) == 300, (serie.attrs, len(serie))
+    dia = serie[serie["periodo"] == "2023-01-02"].iloc[0]
+    assert (dia["saves"], dia["preco_final"], dia["preco_min"], dia["preco_max"]) == (3, 31.17, 31.08, 31.17), dia
+    assert len(history_series(conn, pid, cid, bucket=None)) == total
+    assert len(history_series(conn, pid, cid, bucket="mes")) == 11
+    removed = compact_history(db, raw_days=0, daily_days=100000)
+    assert removed["diarios"] == 2 * 299 and removed["mensais"] == 0, removed
+    assert len(history_series(conn, pid, cid, bucket=None)) == 300
+
+def check_rollup_unknown(db, conn):
+    # Products created after load() are costed from SQL, not as zero
+    rollup = CostRollup.load(conn)
+    mat_id = conn.execute("SELECT MIN(id) FROM vertical_materials").fetchone()[0]
+    pid = db.add_product("NOVO", "NOVO", 1, "SP", "7208.38.90", "SP")
+    db.add_material_usage(pid, mat_id, 2)
+    assert rollup.get(pid) is None
+    assert get_base_cost(conn, pid, rollup) == get_base_cost(conn, pid) and get_base_cost(conn, pid)["materiais"] > 0
+    db.delete_product_cascade(pid)
+
+def check_null_rates(db, conn):
+    # A client with NULL rates fails its own quotes only, with or without the resolver
+    pid, cid = all_products(conn)[0], conn.execute("SELECT MIN(id) FROM clients").fetchone()[0]
+    with db.transaction():
+        vazio = conn.execute("INSERT INTO clients (codigo, nome, uf, regime) VALUES ('NULO', 'Sem alíquotas', 'SP', 'real')").lastrowid
+    taxes = TaxResolver.load(conn)
+    assert suggest_sale_price(conn, pid, cid, 25, taxes=taxes) == suggest_sale_price(conn, pid, cid, 25)
+    for resolver in (taxes, None):
+        try:
+            suggest_sale_price(conn, pid, vazio, 25, taxes=resolver)
+        except InvalidOperation:
+            continue
+        raise AssertionError("cliente sem alíquotas precificado")
+    with db.transaction():
+        conn.execute("DELETE FROM clients WHERE id=?", (vazio,))
+
+def check_snapshot_rows(conn):
+    rollup, taxes = CostRollup.load(conn), TaxResolver.load(conn)
+    rows = conn.execute("SELECT product_id, custo_materiais, custo_processos, custo_terceiros, custos_admin, custo_total_sem_impostos FROM product_cost_snapshot").fetchall()
+    assert len(rows) == len(all_products(conn)), len(rows)
+    for pid, *custos in rows:
+        b = rollup.base_cost(pid)
+        expected = [float(b[k].quantize(_d("0.01"), rounding=ROUND_HALF_UP)) for k in ("materiais", "processos", "terceiros", "administrativos", "sem_impostos")]
+        assert list(custos) == expected, (pid, custos, expected)
+    quotes = conn.execute(
+        "SELECT pc.product_id, pc.client_id, pc.margem, q.margem, q.preco_atual, q.impostos_atual FROM product_clients pc "
+        "LEFT JOIN product_quote_snapshot q ON q.link_id = pc.id"
+    ).fetchall()
+    assert len(quotes) == conn.execute("SELECT COUNT(*) FROM product_quote_snapshot").fetchone()[0]
+    for pid, cid, margem, q_margem, preco, impostos in quotes:
+        res = suggest_sale_price(conn, pid, cid, margem, rollup=rollup, taxes=taxes)
+        assert (q_margem, preco, impostos) == (margem, float(res["preco_venda"]), float(res["impostos_valor"])), (pid, cid)
+
+def check_snapshot(db, conn):
+    # Triggers mark what each write touches; a refresh recomputes only that
+    # (plus ancestors) and leaves the snapshot equal to a full recomputation
+    pids = all_products(conn)
+    clients = [r[0] for r in conn.execute("SELECT id FROM clients ORDER BY id").fetchall()]
+    for i, pid in enumerate(pids):
+        db.link_product_client(pid, clients[i % len(clients)], 10 + i % 20, 100.0 + i)
+    assert refresh_snapshot(db) == len(pids)
+    assert refresh_snapshot(db) == 0
+    check_snapshot_rows(conn)
+    mat_id = conn.execute("SELECT material_id FROM materials_usage ORDER BY id LIMIT 1").fetchone()[0]
+    users = {r[0] for r in conn.execute("SELECT product_id FROM materials_usage WHERE material_id=?", (mat_id,)).fetchall()}
+    users |= {r[0] for r in conn.execute(
+        f"SELECT ancestor_id FROM product_closure WHERE descendant_id IN ({','.join('?' * len(users))})", list(users)
+    ).fetchall()}
+    with db.transaction():
+        conn.execute("UPDATE vertical_materials SET preco_unitario=preco_unitario+1.11 WHERE id=?", (mat_id,))
+    assert refresh_snapshot(db) == len(users) < len(pids), len(users)
+    check_snapshot_rows(conn)
+    with db.transaction():
+        conn.execute("UPDATE clients SET icms=0.04 WHERE id=?", (clients[1],))
+    refresh_snapshot(db)
+    check_snapshot_rows(conn)
+    db.unlink_product_client(pids[0], clients[0])
+    assert refresh_snapshot(db) == 0
+    check_snapshot_rows(conn)
+    db.add_cost_history(pids[1], clients[1], 1, 1, 1, 1, 1, 50, 10)
+    m = load_frame(conn, "client_portfolio_metrics", (clients[1],)).iloc[0]
+    links = load_frame(conn, "client_portfolio", (clients[1],))
+    assert m["produtos"] == len(links) and abs(m["ticket_medio"] - links["preco_final"].mean()) < 1e-9, m
+    assert abs(m["valor_negociado"] - links["preco_final"].sum()) < 1e-9 and abs(m["valor_atual"] - links["preco_atual"].sum()) < 0.005, m
+    custo = conn.execute("SELECT custo_total_sem_impostos FROM product_cost_snapshot WHERE product_id=?", (pids[1],)).fetchone()[0]
+    assert abs(m["deriva_custo_pct"] - (custo - 4) * 100 / 4) < 1e-9, m
+
+def check_scenarios(db, conn):
+    # Overlays leave the base tables alone and match a real edit of the prices
+    mats = [r[0] for r in conn.execute("SELECT id FROM vertical_materials ORDER BY id LIMIT 5").fetchall()]
+    proc_id = conn.execute("SELECT MIN(id) FROM vertical_processes").fetchone()[0]
+    pct = db.save_scenario("Materiais +12%", [{"categoria": "materiais", "alvo": "id", "valor": m, "tipo": "pct", "ajuste": 12} for m in mats])
+    soma = db.save_scenario("Processo +R$5", [{"categoria": "processos", "alvo": "id", "valor": proc_id, "tipo": "abs", "ajuste": 5}])
+    before = conn.execute("SELECT SUM(preco_unitario) FROM vertical_materials").fetchone()[0]
+    por_produto, resumo = compare_scenarios(conn, [pct, soma])
+    assert conn.execute("SELECT SUM(preco_unitario) FROM vertical_materials").fetchone()[0] == before
+    assert list(resumo["cenario"]) == ["Base", "Materiais +12%", "Processo +R$5"], resumo
+    custo = por_produto.set_index(["cenario", "product_id"])["custo"]
+    base = CostRollup.load(conn)
+    for pid in all_products(conn):
+        assert abs(custo["Base", pid] - float(base.base_cost(pid)["sem_impostos"])) < 0.01, pid
+    for nome, sql, params in (
+        ("Materiais +12%", f"UPDATE vertical_materials SET preco_unitario=preco_unitario*1.12 WHERE id IN ({','.join('?' * len(mats))})", mats),
+        ("Processo +R$5", "UPDATE vertical_processes SET preco_unitario_hora=preco_unitario_hora+5 WHERE id=?", [proc_id]),
+    ):
+        with db.transaction():
+            conn.execute("SAVEPOINT cenario")
+            conn.execute(sql, params)
+            edited = CostRollup.load(conn)
+            conn.execute("ROLLBACK TO cenario")
+            conn.execute("RELEASE cenario")
+        for pid in all_products(conn):
+            assert abs(custo[nome, pid] - float(edited.base_cost(pid)["sem_impostos"])) < 0.01, (nome, pid)
+
+def check_export(db, conn):
+    # Products committed by another connection mid-export stay out of both
+    # the counts and the rows, so the fraction ends at exactly 1.0
+    fractions = []
+    def progress(table, done, fracao):
+        if not fractions:
+            t = threading.Thread(target=lambda: db.add_product("NOVO-EXP", "Novo", 1, "SP", "7208.38.90", "SP"))
+            t.start()
+            t.join()
+        fractions.append(fracao)
+    before = conn.execute("SELECT COUNT(*) FROM products").fetchone()[0]
+    fd, path = tempfile.mkstemp(suffix=".zip")
+    os.close(fd)
+    try:
+        totals = export.export_csv_zip(conn, path, progress=progress)
+        with zipfile.ZipFile(path) as zf:
+            exported = zf.read("products.csv").decode("utf-8").count("\n") - 1
+    finally:
+        os.remove(path)
+    assert totals["products"] == exported == before, (totals["products"], exported, before)
+    assert fractions == sorted(fractions) and fractions[-1] == 1.0, fractions
+    assert conn.execute("SELECT COUNT(*) FROM products").fetchone()[0] == before + 1 and not conn.in_transaction
+
+def check_apply_changes(db, conn):
+    # Editor save with an update, a delete and new rows with and without an
+    # explicit id: inserted ids are exactly the new rows, in id order
+    original = pd.read_sql_query("SELECT * FROM vertical_materials ORDER BY id", conn)
+    top = int(original["id"].max())
+    edited = original.iloc[1:].copy()
+    edited.loc[edited.index[0], "preco_unitario"] = 99.5
+    blank = {c: None for c in original.columns}
+    new = [dict(blank, nome=f"Novo {i}", codigo=f"NOVO-{i}", preco_unitario=float(i)) for i in range(3)]
+    new[1]["id"] = top + 10
+    edited = pd.concat([edited, pd.DataFrame(new)], ignore_index=True)
+    result = db.apply_changes("vertical_materials", original, edited)
+    assert result["deleted"] == [int(original["id"].iloc[0])] and result["updated"] == [int(original["id"].iloc[1])], result
+    assert sorted(result["inserted"]) == [top + 10, top + 11, top + 12], result
+    names = dict(conn.execute(f"SELECT id, nome FROM vertical_materials WHERE id > {top}").fetchall())
+    assert names == {top + 10: "Novo 1", top + 11: "Novo 0", top + 12: "Novo 2"}, names
+    copy_id = db.duplicate_material(top + 11)
+    assert tuple(conn.execute("SELECT codigo, nome, preco_unitario FROM vertical_materials WHERE id=?", (copy_id,)).fetchone()) == ("NOVO-0_COPY", "Novo 0", 0.0)
+
+def check_erp_import(db, conn):
+    # ~3 chunks of a generated CSV: counts, monotonic progress ending at 1.0;
+    # a chunk failing mid-insert leaves the earlier chunks and none of its rows
+    def csv_file(nomes):
+        text = "nome_insumo,custo_unitario,unidade\n" + "".join(f"{n},{i % 97 + 0.5},kg\n" for i, n in enumerate(nomes))
+        return io.BytesIO(text.encode("utf-8"))
+    def count():
+        return conn.execute("SELECT COUNT(*) FROM vertical_materials WHERE nome LIKE 'ERP-%'").fetchone()[0]
+    calls = []
+    result = import_erp_file(db, csv_file([f"ERP-{i}" for i in range(250)]), "erp.csv", chunksize=100, progress=lambda *a: calls.append(a))
+    assert result["tipo"] == "materiais" and result["linhas"] == 250 == count(), result
+    assert [c[0] for c in calls] == [100, 200, 250] and [c[1] for c in calls] == [0.4, 0.8, 1.0], calls
+    conn.execute("CREATE TEMP TRIGGER erp_ruim BEFORE INSERT ON vertical_materials WHEN NEW.nome = 'ERP-RUIM' BEGIN SELECT RAISE(ABORT, 'linha ruim'); END")
+    calls.clear()
+    nomes = [f"ERP-B{i}" for i in range(250)]
+    nomes[150] = "ERP-RUIM"
+    try:
+        import_erp_file(db, csv_file(nomes), "erp.csv", chunksize=100, progress=lambda *a: calls.append(a))
+        raise AssertionError("chunk inválido importado")
+    except sqlite3.IntegrityError:
+        pass
+    finally:
+        conn.execute("DROP TRIGGER erp_ruim")
+    assert [c[0] for c in calls] == [100] and count() == 350 and not conn.in_transaction, (calls, count())
+    assert conn.execute("SELECT COUNT(*) FROM vertical_materials WHERE nome IN ('ERP-B99', 'ERP-B100', 'ERP-B149')").fetchone()[0] == 1
+
+def check_search(db):
+    # FTS triggers: prefix matches on insert, the new words (and not the old
+    # ones) after a rename, nothing after a delete
+    db.seed_demo()
+    conn = db.connection()
+    assert has_search_index(conn, "products")
+    def found(text):
+        return [r["id"] for r in db.search("products", text)]
+    chapa = db.add_product("ZX-100", "Chapa dobrada", 1, "SP", "7208.38.90", "SP", grupo="Caldeiraria")
+    perfil = db.add_product("ZX-200", "Perfil soldado", 1, "SP", "7208.38.90", "SP")
+    assert sorted(found("zx")) == [chapa, perfil]
+    assert found("zx-1") == found("cha dob") == found("caldeir") == [chapa]
+    db.update_product(chapa, "ZX-100", "Tubo calandrado", 1, "SP", "7208.38.90", "SP")
+    assert found("dobr") == found("caldeir") == [] and found("calan") == [chapa]
+    db.delete_product_cascade(chapa)
+    assert found("calan") == [] and found("zx") == [perfil]
+
+def check_users(db):
+    # CSV roster hashed by the process pool and inserted once; existing
+    # emails skipped or updated; legacy hashes verify and get replaced
+    db.seed_demo()
+    fd, path = tempfile.mkstemp(suffix=".csv")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write("Nome;Email;Senha;Role\n")
+        f.write("".join(f"Usuário {i};U{i}@Cliente.com;senha{i};\n" for i in range(150)))
+        f.write("Sem senha;x@cliente.com;;\nRepetido;u1@cliente.com;outra;\nChefe;chefe@cliente.com;s;gerente\nAdmin;admin@costi.com;nova;admin\n")
+    try:
+        rows, errors = read_roster(path)
+    finally:
+        os.remove(path)
+    assert len(rows) == 151 and [e[0] for e in errors] == [152, 153, 154], errors
+    assert provision(db, rows, workers=2) == {"inseridos": 150, "atualizados": 0, "ignorados": 1}
+    u = db.get_user_by_email("u7@cliente.com")
+    assert u["role"] == "cliente" and verify_password("senha7", u["senha_hash"]) and not needs_rehash(u["senha_hash"])
+    assert provision(db, rows[:3], update_existing=True, workers=2) == {"inseridos": 0, "atualizados": 3, "ignorados": 0}
+    assert verify_password("senha0", db.get_user_by_email("u0@cliente.com")["senha_hash"])
+    legacy = hash_password("antiga", LEGACY_ITERATIONS).split("$", 2)[2]
+    db.set_password_hash(u["id"], legacy)
+    rehashed = []
+    assert not verify_password("errada", legacy, on_rehash=rehashed.append) and not rehashed
+    assert verify_password("antiga", legacy, on_rehash=lambda h: rehashed.append(db.set_password_hash(u["id"], h)))
+    stored = db.get_user_by_email("u7@cliente.com")["senha_hash"]
+    assert rehashed and stored.startswith("pbkdf2_sha256$") and verify_password("antiga", stored) and not needs_rehash(stored)
+
+def fresh_db(run):
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    db = Database(path)
+    try:
+        run(db)
+    finally:
+        db.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+def check_quarantine(db):
+    # A cycle saved by an old version (no quarantine table yet) is moved out on
+    # the next start; later starts no longer scan product_components
+    def raw(*sql):
+        with sqlite3.connect(db.path) as conn:
+            for stmt in sql:
+                conn.execute(*stmt)
+        conn.close()
+    def start():
+        reopened = Database(db.path)
+        reopened.close()
+        return reopened.quarantined_links
+    def link(parent, component):
+        return "INSERT INTO product_components (parent_product_id, component_product_id, quantidade) VALUES (?,?,1)", (ids[parent], ids[component])
+    ids = build(db)
+    raw(link("PECA", "CONJ-B"), ("DROP TABLE product_components_quarantine",))
+    moved = start()
+    assert moved and all(comp == ids["PECA"] for _id, _pai, comp, _q in moved), moved
+    check_rollup(db.connection(), CostRollup.load(db.connection()))
+    raw(link("CONJ-B", "PECA"))
+    assert start() == []
+
+def check_cache_race(db, conn, product_id):
+    # Thread A syncs and computes; thread B writes a price and syncs; A's put
+    # of the cost it read before B's write is dropped, B's own put is kept
+    cache = RollupCache()
+    cache.sync(conn)
+    stale = get_base_cost(conn, product_id)
+    fresh = {}
+    def writer():
+        with db.transaction() as c:
+            c.execute("UPDATE vertical_materials SET preco_unitario=preco_unitario+1")
+            bump_versions(c, "vertical_materials")
+        c = db.connection()
+        cache.sync(c)
+        fresh["cost"] = get_base_cost(c, product_id, cache)
+    t = threading.Thread(target=writer)
+    t.start()
+    t.join()
+    assert fresh["cost"]["sem_impostos"] > stale["sem_impostos"]
+    cache.put(product_id, stale)
+    stats = cache.stats()
+    assert stats["stale_puts"] == 1 and cache.get(product_id)["sem_impostos"] == fresh["cost"]["sem_impostos"], stats
+    cache.sync(conn)
+    cache.put(product_id, get_base_cost(conn, product_id))
+    assert cache.stats()["stale_puts"] == 1 and cache.get(product_id)["sem_impostos"] == fresh["cost"]["sem_impostos"]
+
+def check_catalog(db):
+    ids = build(db)
+    conn = db.connection()
+    check_rollup(conn, CostRollup.load(conn))
+    check_rollup_unknown(db, conn)
+    print("ROLLUP: ok")
+    check_grid(conn)
+    check_grid(conn, admin_pct=3.5, frete_pct=1.25, outros_pct=0.4)
+    print("PARIDADE price_grid: ok")
+    check_null_rates(db, conn)
+    print("IMPOSTOS NULOS: ok")
+    check_explode(db, conn)
+    print("EXPLODE/WHERE_USED: ok")
+    check_rollup(conn, check_propagate(db, conn, ids))
+    check_grid(conn)
+    print("PROPAGATE: ok")
+    check_money_columns(conn)
+    assert check_fixed(conn) == 0
+    assert check_fixed(conn, admin_pct=3.5, frete_pct=1.25, outros_pct=0.4) == 0
+    # A price with fractions of a centavo cannot be held in centavos: the
+    # products using it (and their ancestors) must fall back to Decimal
+    with db.transaction():
+        conn.execute("UPDATE third_party_items SET preco_unitario=? WHERE id=(SELECT MIN(id) FROM third_party_items)", (300.005,))
+    check_money_columns(conn)
+    assert check_fixed(conn) > 0
+    print("PARIDADE price_grid_fixed: ok")
+    check_cache_race(db, conn, ids["CONJ-B"])
+    print("CACHE: ok")
+
+def check_random(db):
+    build_random(db, seed=7)
+    conn = db.connection()
+    check_rollup(conn, CostRollup.load(conn))
+    check_explode(db, conn)
+    check_grid(conn, admin_pct=2.5)
+    check_money_columns(conn)
+    check_fixed(conn)
+    check_fixed(conn, admin_pct=2.5, frete_pct=1.1)
+    print("CATALOGO ALEATORIO: ok")
+    check_apply_changes(db, conn)
+    print("APPLY_CHANGES: ok")
+    check_erp_import(db, conn)
+    print("IMPORTACAO ERP: ok")
+    check_sensitivity(conn)
+    print("SENSIBILIDADE: ok")
+    check_scenarios(db, conn)
+    print("CENARIOS: ok")
+    check_history(db, conn)
+    print("HISTORICO: ok")
+    check_snapshot(db, conn)
+    print("SNAPSHOT: ok")
+    check_export(db, conn)
+    print("EXPORTACAO: ok")
+
+def main():
+    fresh_db(check_catalog)
+    fresh_db(check_random)
+    fresh_db(check_users)
+    print("USUARIOS: ok")
+    fresh_db(check_quarantine)
+    print("QUARENTENA: ok")
+    fresh_db(check_search)
+    print("BUSCA: ok")
+
+if __name__ == "__main__":
+    main()